@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Memory footprint benchmark for information model objects
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measures the memory held by 10000 statements of each kind, as a
+supervisor would hold them in a BaseClient. Run it against two
+revisions of the tree to compare object layouts, e.g.:
+
+    PYTHONPATH=. python3 bench/model_memory.py
+
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+import mplane.model
+
+def _rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4
+
+def make_capability(i):
+    cap = mplane.model.Capability(label="ping-average-ip4-"+str(i),
+                                  when="now ... future / 1s")
+    cap.add_parameter("source.ip4", "10.0.27."+str(i % 250))
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("delay.twoway.icmp.us.min")
+    cap.add_result_column("delay.twoway.icmp.us.mean")
+    cap.add_result_column("delay.twoway.icmp.us.max")
+    cap.add_result_column("delay.twoway.icmp.count")
+    return cap
+
+def make_receipt(i):
+    spec = mplane.model.Specification(capability=make_capability(i))
+    spec.set_parameter_value("destination.ip4", "10.0.37."+str(i % 250))
+    spec.set_when("now + 1m / 1s")
+    return mplane.model.Receipt(specification=spec)
+
+def make_result(i):
+    spec = mplane.model.Specification(capability=make_capability(i))
+    spec.set_parameter_value("destination.ip4", "10.0.37."+str(i % 250))
+    spec.set_when("now + 1m / 1s")
+    res = mplane.model.Result(specification=spec,
+                              when="2015-01-01 00:00:00 ... 2015-01-01 00:01:00")
+    res.set_result_value("delay.twoway.icmp.us.min", 1000)
+    res.set_result_value("delay.twoway.icmp.us.mean", 2000)
+    res.set_result_value("delay.twoway.icmp.us.max", 3000)
+    res.set_result_value("delay.twoway.icmp.count", 60)
+    return res
+
+def measure(factory, count):
+    gc.collect()
+    rss_before = _rss_kb()
+    tracemalloc.start()
+    held = [factory(i) for i in range(count)]
+    gc.collect()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = _rss_kb()
+    del held
+    return (current, rss_after - rss_before)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mplane model memory benchmark")
+    parser.add_argument('--count', type=int, default=10000,
+                        help='number of statements of each kind')
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    print("%-12s %14s %14s" % ("kind", "traced KiB", "RSS delta KiB"))
+    for (name, factory) in (("capability", make_capability),
+                            ("receipt", make_receipt),
+                            ("result", make_result)):
+        (traced, rss) = measure(factory, args.count)
+        print("%-12s %14d %14d" % (name, traced // 1024, rss))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Time index benchmark
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measures how fast mplane.timeindex answers time-ranged queries over a
+large repository (100M rows by default), against a scan of the bounds
+of every block. Rows are synthetic: each block's times are a range()
+with one row per second, so no row data is materialized and find_rows()
+bisects the ranges directly. Run e.g.:
+
+    PYTHONPATH=. python3 bench/timeindex.py --rows 100000000
+
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime
+
+import mplane.model
+import mplane.timeindex
+
+def build(rows, keys, block_rows, period_us, t0):
+    idx = mplane.timeindex.TimeIndex()
+    per_key = rows // keys
+    for k in range(keys):
+        key = mplane.timeindex.index_key("bench",
+                {"source.ip4": "10.0.27.1",
+                 "destination.ip4": "10.0.%d.%d" % (k // 250, k % 250 + 1)})
+        for first in range(0, per_key, block_rows):
+            n = min(block_rows, per_key - first)
+            start = t0 + first * period_us
+            times = range(start, start + n * period_us, period_us)
+            idx.add(key, times[0], times[-1], times)
+    return idx
+
+def query_index(idx, key, start, end):
+    selected = 0
+    for (tmin, tmax, times) in idx.blocks(key, start, end):
+        (lo, hi) = mplane.timeindex.find_rows(times, start, end)
+        selected += hi - lo
+    return selected
+
+def query_scan(idx, key, start, end):
+    # what a store without an index does: look at every block
+    selected = 0
+    for (other, bl) in idx._keys.items():
+        for (tmin, tmax, times) in zip(bl.mins, bl.maxes, bl.blocks):
+            if other == key and tmax >= start and tmin <= end:
+                (lo, hi) = mplane.timeindex.find_rows(times, start, end)
+                selected += hi - lo
+    return selected
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mplane time index benchmark")
+    parser.add_argument('--rows', type=int, default=100000000,
+                        help='number of stored rows')
+    parser.add_argument('--keys', type=int, default=100,
+                        help='number of distinct parameter value sets')
+    parser.add_argument('--block-rows', type=int, default=10000,
+                        help='rows per block')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='number of queries to run')
+    parser.add_argument('--window', type=int, default=3600,
+                        help='query temporal scope in seconds')
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+    period_us = 1000000
+    t0 = mplane.timeindex.to_us(datetime(2015, 1, 1))
+
+    t = time.perf_counter()
+    idx = build(args.rows, args.keys, args.block_rows, period_us, t0)
+    print("indexed %d rows in %d blocks in %.2f s" %
+          (args.rows, len(idx), time.perf_counter() - t))
+
+    keys = list(idx.keys("bench"))
+    span = (args.rows // args.keys) * period_us
+    window = args.window * 1000000
+    rnd = random.Random(0)
+    queries = []
+    for i in range(args.queries):
+        start = t0 + rnd.randrange(max(1, span - window))
+        queries.append((rnd.choice(keys), start, start + window))
+
+    for (name, fn) in (("index", query_index), ("scan", query_scan)):
+        t = time.perf_counter()
+        selected = sum(fn(idx, key, start, end) for (key, start, end) in queries)
+        elapsed = time.perf_counter() - t
+        print("%-6s %10.1f us/query %12d rows selected" %
+              (name, elapsed / len(queries) * 1e6, selected))
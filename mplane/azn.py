@@ -37,13 +37,27 @@ class AuthorizationOff(object):
     def check(self, cap, identity):
         return True
 
+    def reload(self, config):
+        pass
+
 always_authorized = AuthorizationOff()
 
 class AuthorizationOn(object):
     
     def __init__(self, config):
+        self.reload(config)
+
+    def reload(self, config):
+        """
+        (Re)loads roles and authorizations from the configuration,
+        recompiling the label index and dropping cached decisions.
+
+        """
         self.id_role = self._load_roles(config["Roles"])
         self.cap_role = self._load_roles(config["Authorizations"])
+        self._label_trie = self._compile_labels(self.cap_role)
+        self._label_roles = {}
+        self._decisions = {}
 
     def _load_roles(self, config_obj):
         """ Loads user-role-capability associations and keeps them in cache """
@@ -52,22 +66,72 @@ class AuthorizationOn(object):
             roles = set(config_obj[elem].split(','))
             r[elem] = roles
         return r
-            
+
+    def _compile_labels(self, cap_role):
+        """
+        Builds a character trie of the authorized labels. A node in
+        which a label ends holds the label's position in the
+        configuration under the None key.
+
+        """
+        trie = {}
+        for (order, label) in enumerate(cap_role):
+            node = trie
+            for c in label:
+                node = node.setdefault(c, {})
+            node[None] = order
+        return trie
+
+    def _roles_for_label(self, cap_label):
+        """
+        Returns the roles authorized for a capability label. As with
+        the authorizations file, a rule applies to every label which
+        contains it (e.g. with a serial number suffix); if several
+        rules apply, the one appearing last in the configuration wins.
+
+        """
+        try:
+            return self._label_roles[cap_label]
+        except KeyError:
+            pass
+
+        best = -1
+        best_label = None
+        trie = self._label_trie
+        for start in range(len(cap_label)):
+            node = trie
+            for end in range(start, len(cap_label)):
+                node = node.get(cap_label[end])
+                if node is None:
+                    break
+                if None in node and node[None] > best:
+                    best = node[None]
+                    best_label = cap_label[start:end+1]
+
+        if best_label is None:
+            roles = frozenset()
+        else:
+            roles = frozenset(self.cap_role[best_label])
+        self._label_roles[cap_label] = roles
+        return roles
+
     def check(self, cap, identity): 
         """
         Return true if the given identiy is authorized to use the given
         capability by this set of authorization rules, false otherwise.
 
         """
-        # Remove the suffix serial number from the specification label
-        # in order to make controls on the original label
-        cap_label = None
-        for label in self.cap_role:
-            if label in cap._label:
-                cap_label = label
-
-        if ((cap_label in self.cap_role) and (identity in self.id_role)): # Deny unless explicitly allowed in .conf files
-            intersection = self.cap_role[cap_label] & self.id_role[identity]
-            if len(intersection) > 0:
-                return True
-        return False
+        # Deny unless explicitly allowed in .conf files
+        if identity not in self.id_role or cap._label is None:
+            return False
+
+        key = (cap._label, identity)
+        try:
+            return self._decisions[key]
+        except KeyError:
+            pass
+
+        decision = len(self._roles_for_label(cap._label) &
+                       self.id_role[identity]) > 0
+        self._decisions[key] = decision
+        return decision
@@ -23,9 +23,11 @@
 
 import mplane.model
 import mplane.utils
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import hashlib
 import html.parser
+import time
 import urllib3
 
 # FIXME HACK
@@ -36,12 +38,18 @@ try:
 except:
     pass
 
-from threading import Thread
+from threading import Thread, Lock, Event
 import queue
 
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
+import tornado.gen
+import tornado.concurrent
+import tornado.websocket
+import tornado.httpclient
+import tornado.locks
+import urllib.parse
 
 CAPABILITY_PATH_ELEM = "capability"
 
@@ -53,6 +61,23 @@ DEFAULT_HOST = "127.0.0.1"
 DEFAULT_REGISTRATION_PATH = "register/capability"
 DEFAULT_SPECIFICATION_PATH = "show/specification"
 DEFAULT_RESULT_PATH = "register/result"
+DEFAULT_WEBSOCKET_PATH = "ws"
+
+# Upper bound in seconds on how long a specification request may be held
+# open waiting for something to send to the component (the ?wait= argument)
+MAX_SPECIFICATION_WAIT = 60
+
+# When the supervisor cannot take more messages: seconds a component is
+# asked to wait before retrying, and how often a WebSocket checks again
+BUSY_RETRY_AFTER = 1
+BUSY_POLL_INTERVAL = 0.05
+
+# Bounds in seconds on the interval between redemptions of a receipt
+REDEEM_MIN_INTERVAL = 1
+REDEEM_MAX_INTERVAL = 60
+
+# Number of requests an AsyncHttpInitiatorClient has in flight at most
+DEFAULT_FANOUT_CONCURRENCY = 16
 
 class BaseClient(object):
     """
@@ -76,6 +101,14 @@ class BaseClient(object):
         if self._supervisor:
             self._exporter = exporter
 
+    def _export(self, msg, identity):
+        """
+        Pass a message on to the supervisor's exporter, waiting while
+        the exporter is full.
+
+        """
+        self._exporter.put([msg, identity])
+
     def _add_capability(self, msg, identity):
         """
         Add a capability to internal state. The capability will be recallable
@@ -252,7 +285,7 @@ class BaseClient(object):
                 (start, end) = msg.when().datetimes()
                 if end < datetime.utcnow():
                     if self._supervisor:
-                        self._exporter.put_nowait([msg, identity])
+                        self._export(msg, identity)
 
                     receipt = self._receipts[msg.get_token()]
                     self._remove_receipt(receipt)
@@ -308,7 +341,7 @@ class BaseClient(object):
 
         if (self._supervisor and
             not isinstance(msg, mplane.model.Envelope)):
-            self._exporter.put_nowait([msg, identity])
+            self._export(msg, identity)
 
         if isinstance(msg, mplane.model.Capability):
             self._add_capability(msg, identity)
@@ -407,6 +440,86 @@ class CrawlParser(html.parser.HTMLParser):
         if tag == "a" and "href" in attrs:
             self.urls.append(attrs["href"])
 
+class RedemptionSchedule(object):
+    """
+    Decides when a client should next redeem each of its outstanding
+    receipts. A receipt is first due when the temporal scope of its
+    specification ends, or after min_interval for open-ended and
+    repeated scopes. Each redemption which brings nothing new doubles
+    the wait for the next one, up to max_interval.
+
+    """
+    def __init__(self, min_interval=REDEEM_MIN_INTERVAL,
+                 max_interval=REDEEM_MAX_INTERVAL):
+        self._min = min_interval
+        self._max = max_interval
+        self._lock = Lock()
+        self._wakeup = Event()
+        # [due (monotonic time), current interval] by receipt token
+        self._due = {}
+
+    def add(self, receipt):
+        """
+        Schedule the first redemption of a receipt. Receipts already
+        scheduled (e.g. returned again by a redemption) keep their place.
+
+        """
+        with self._lock:
+            if receipt.get_token() in self._due:
+                return
+        delay = self._min
+        when = receipt.when()
+        if when is not None and not when.is_repeated():
+            end = when.datetimes()[1]
+            if end is not None:
+                delay = max(delay, (end - datetime.utcnow()).total_seconds())
+        with self._lock:
+            self._due[receipt.get_token()] = [time.monotonic() + delay, self._min]
+        self._wakeup.set()
+
+    def remove(self, token):
+        """Stop redeeming a receipt."""
+        with self._lock:
+            self._due.pop(token, None)
+
+    def backoff(self, token):
+        """Redeem a receipt again after twice the last interval."""
+        with self._lock:
+            if token in self._due:
+                interval = min(self._due[token][1] * 2, self._max)
+                self._due[token] = [time.monotonic() + interval, interval]
+
+    def reset(self, token):
+        """Redeem a receipt again after min_interval."""
+        with self._lock:
+            if token in self._due:
+                self._due[token] = [time.monotonic() + self._min, self._min]
+
+    def due(self):
+        """Return the tokens of the receipts due for redemption."""
+        now = time.monotonic()
+        with self._lock:
+            return [token for (token, (due, interval)) in self._due.items()
+                    if due <= now]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._due)
+
+    def wait(self, timeout):
+        """
+        Wait until the next redemption is due, a receipt is added, or
+        timeout seconds pass, whichever comes first.
+
+        """
+        with self._lock:
+            if self._due:
+                timeout = min(timeout, min(due for (due, interval)
+                                           in self._due.values()) - time.monotonic())
+        if timeout > 0:
+            self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
 class HttpInitiatorClient(BaseClient):
     """
     Core implementation of an mPlane JSON-over-HTTP(S) client.
@@ -430,6 +543,26 @@ class HttpInitiatorClient(BaseClient):
         # used to create labels programmatically
         self._ssn = 0
 
+        # component URL each receipt came from, and when to redeem it
+        self._receipt_urls = {}
+        if config is not None and "client" in config:
+            self._redemptions = RedemptionSchedule(
+                float(config["client"].get("redeem-min-interval", REDEEM_MIN_INTERVAL)),
+                float(config["client"].get("redeem-max-interval", REDEEM_MAX_INTERVAL)))
+        else:
+            self._redemptions = RedemptionSchedule()
+
+        # digests and ETags of the capability pages last crawled, by URL
+        self._crawl_digests = {}
+        self._crawl_etags = {}
+
+        # components which answered with gzip, and so take it too
+        self._gzip_peers = set()
+        self._compress_min_bytes = mplane.utils.COMPRESS_MIN_BYTES
+        if config is not None and "client" in config:
+            self._compress_min_bytes = int(config["client"].get(
+                    "compress-min-bytes", self._compress_min_bytes))
+
     def set_default_url(self, url):
         if isinstance(url, str):
             self._default_url = urllib3.util.parse_url(url)
@@ -441,6 +574,14 @@ class HttpInitiatorClient(BaseClient):
         send a message, store any result in client state.
 
         """
+        (reply, component_identity) = self._post_message(msg, dst_url)
+        if reply is not None:
+            self.handle_message(reply, component_identity)
+
+    def _post_message(self, msg, dst_url=None):
+        # POST a message; return the mPlane reply, if any, and the
+        # identity of the component which sent it
+
         # figure out where to send the message
         if not dst_url:
             dst_url = self._default_url
@@ -450,7 +591,8 @@ class HttpInitiatorClient(BaseClient):
 
         pool = self._tls_state.pool_for(dst_url.scheme, dst_url.host, dst_url.port)
 
-        headers = {"Content-Type": "application/x-mplane+json"}
+        headers = {"Content-Type": "application/x-mplane+json",
+                   "Accept-Encoding": "gzip"}
         if self._tls_state.forged_identity():
             headers[FORGED_DN_HEADER] = self._tls_state.forged_identity()
 
@@ -458,16 +600,35 @@ class HttpInitiatorClient(BaseClient):
             path = dst_url.path
         else:
             path = "/"
+
+        # receipts will be redeemed where the specification went
+        if isinstance(msg, mplane.model.Specification):
+            self._receipt_urls[msg.get_token()] = dst_url
+
         res = pool.urlopen('POST', path,
-                           body=mplane.model.unparse_json(msg).encode("utf-8"),
+                           body=self._request_body(msg, dst_url, headers),
                            headers=headers)
+        self._note_encoding(dst_url, res.headers.get("Content-Encoding"))
         if (res.status == 200 and
             res.getheader("Content-Type") == "application/x-mplane+json"):
             component_identity = self._tls_state.extract_peer_identity(dst_url)
-            self.handle_message(mplane.model.parse_json(res.data.decode("utf-8")), component_identity)
+            return (mplane.model.parse_json(res.data.decode("utf-8")), component_identity)
         else:
             # Didn't get an mPlane reply. What now?
-            pass
+            return (None, None)
+
+    def _request_body(self, msg, url, headers):
+        # serialize a message to send to a component, compressed if
+        # the component is known to handle gzip
+        body = mplane.model.unparse_json(msg).encode("utf-8")
+        if (url.host, url.port) in self._gzip_peers:
+            body = mplane.utils.compress_body(body, headers,
+                                              self._compress_min_bytes)
+        return body
+
+    def _note_encoding(self, url, encoding):
+        if encoding == "gzip":
+            self._gzip_peers.add((url.host, url.port))
 
     def result_for(self, token_or_label):
         """
@@ -495,7 +656,8 @@ class HttpInitiatorClient(BaseClient):
             return rr
 
         # if we're here, we have a receipt. try to redeem it.
-        self.send_message(mplane.model.Redemption(receipt=rr))
+        self.send_message(mplane.model.Redemption(receipt=rr),
+                          self._receipt_urls.get(rr.get_token()))
 
         # see if we got a result
         if token_or_label in self._result_labels:
@@ -506,6 +668,87 @@ class HttpInitiatorClient(BaseClient):
             # Nope. Return the receipt.
             return rr
 
+    def _add_receipt(self, msg, identity):
+        super()._add_receipt(msg, identity)
+        self._redemptions.add(msg)
+
+    def _remove_receipt(self, msg):
+        super()._remove_receipt(msg)
+        self._redemptions.remove(msg.get_token())
+
+    def redeem_due(self):
+        """
+        Redeem the outstanding receipts which are due, component by
+        component. Returns the number of receipts redeemed.
+
+        """
+        redeemed = 0
+        for (url, receipts) in self._due_batches():
+            redeemed += self._redeem(url, receipts)
+        return redeemed
+
+    def _due_batches(self):
+        # group the receipts due for redemption by component URL
+        batches = {}
+        for token in self._redemptions.due():
+            receipt = self._receipts.get(token)
+            if receipt is None:
+                self._redemptions.remove(token)
+                continue
+            url = self._receipt_urls.get(token, self._default_url)
+            batches.setdefault(str(url), (url, []))[1].append(receipt)
+        return list(batches.values())
+
+    def _redemption_for(self, receipts):
+        # one redemption, or an envelope of them for several receipts
+        if len(receipts) == 1:
+            return mplane.model.Redemption(receipt=receipts[0])
+        env = mplane.model.Envelope()
+        for receipt in receipts:
+            env.append_message(mplane.model.Redemption(receipt=receipt))
+        return env
+
+    def _redeem(self, url, receipts):
+        # redeem a batch of receipts from one component, in one envelope
+        # of redemptions; returns the number redeemed
+        last = {r.get_token(): self._results.get(r.get_token()) for r in receipts}
+        try:
+            (reply, component_identity) = self._post_message(
+                                    self._redemption_for(receipts), url)
+        except urllib3.exceptions.HTTPError as e:
+            print("Component at " + str(url) + " unreachable (" + repr(e) + ")")
+            self._reschedule({token: None for token in last}, failed=True)
+            return 0
+
+        if len(receipts) > 1 and isinstance(reply, mplane.model.Exception):
+            # the component does not take envelopes; redeem one by one
+            return sum(self._redeem(url, [receipt]) for receipt in receipts)
+        if reply is not None:
+            self.handle_message(reply, component_identity)
+        self._reschedule(last)
+        return len(receipts)
+
+    def _reschedule(self, last, failed=False):
+        # schedule the next redemption of receipts just redeemed, given
+        # the results held for each token before redeeming
+        for (token, result) in last.items():
+            if token not in self._receipts:
+                # done; _remove_receipt unscheduled it
+                pass
+            elif not failed and self._results.get(token) is not result:
+                # a repeated specification produced more results
+                self._redemptions.reset(token)
+            else:
+                self._redemptions.backoff(token)
+
+    def wait_for_redemptions(self, timeout):
+        """
+        Block until a receipt is due for redemption or a new receipt
+        arrives, for at most timeout seconds.
+
+        """
+        self._redemptions.wait(timeout)
+
     def invoke_capability(self, cap_tol, when, params, relabel=None):
         """
         Given a capability token or label, a temporal scope, a dictionary
@@ -523,16 +766,38 @@ class HttpInitiatorClient(BaseClient):
         # get the receipt
         rr = super().result_for(cap_tol)
         interrupt = mplane.model.Interrupt(specification=rr)
-        dst_url = urllib3.util.Url(scheme=self._default_url.scheme,
-                                   host=self._default_url.host,
-                                   port=self._default_url.port,
-                                   path=self._default_url.path)
+        dst_url = self._receipt_urls.get(rr.get_token())
+        if dst_url is None:
+            dst_url = urllib3.util.Url(scheme=self._default_url.scheme,
+                                       host=self._default_url.host,
+                                       port=self._default_url.port,
+                                       path=self._default_url.path)
         self.send_message(interrupt, dst_url)
 
-    def retrieve_capabilities(self, url, urlchain=[], pool=None, identity=None):
+    def _crawl_headers(self, url, force):
+        # ask for all capabilities in one envelope, falling back to a
+        # page of links; unchanged envelopes are not sent again
+        headers = {"Accept": "application/x-mplane+json, text/html",
+                   "Accept-Encoding": "gzip"}
+        etag = self._crawl_etags.get(str(url))
+        if etag is not None and not force:
+            headers["If-None-Match"] = etag
+        return headers
+
+    def _crawled(self, url, digest, etag):
+        # only remember a page once everything on it was processed
+        self._crawl_digests[str(url)] = digest
+        if etag is not None:
+            self._crawl_etags[str(url)] = etag
+
+    def retrieve_capabilities(self, url, urlchain=[], pool=None, identity=None,
+                              force=False):
         """
         connect to the given URL, retrieve and process the
-        capabilities/withdrawals found there
+        capabilities/withdrawals found there. Components which can are
+        asked for all their capabilities in one envelope. Pages which
+        have not changed since they were last processed are skipped,
+        along with the pages they link to, unless force is True.
         """
 
         # detect loops in capability links
@@ -559,9 +824,14 @@ class HttpInitiatorClient(BaseClient):
             path = url.path
         else:
             path = "/"
-        res = pool.request('GET', path)
+        res = pool.request('GET', path, headers=self._crawl_headers(url, force))
+        self._note_encoding(url, res.headers.get("Content-Encoding"))
 
         if res.status == 200:
+            digest = hashlib.md5(res.data).hexdigest()
+            if not force and self._crawl_digests.get(str(url)) == digest:
+                return
+
             ctype = res.getheader("Content-Type")
             if ctype == "application/x-mplane+json":
                 # Probably an envelope. Process the message.
@@ -569,13 +839,248 @@ class HttpInitiatorClient(BaseClient):
                     mplane.model.parse_json(res.data.decode("utf-8")), identity)
             elif ctype == "text/html":
                 # Treat as a list of links to capability messages.
-                parser = CrawlParser(strict=False)
+                parser = CrawlParser()
                 parser.feed(res.data.decode("utf-8"))
                 parser.close()
                 for capurl in parser.urls:
                     self.retrieve_capabilities(url=capurl,
                                                urlchain=urlchain + [url],
-                                               pool=pool, identity=identity)
+                                               pool=pool, identity=identity,
+                                               force=force)
+
+            self._crawled(url, digest, res.getheader("ETag"))
+
+class AsyncHttpInitiatorClient(HttpInitiatorClient):
+    """
+    Client-initiated client which talks to many components at once.
+    The *_async methods are coroutines which send their requests
+    concurrently with Tornado's AsyncHTTPClient, with at most
+    concurrency requests in flight, using the TLS configuration of the
+    client's TlsState; run them on an IOLoop, e.g. with
+    IOLoop.run_sync().
+
+    Replies are handled on the IOLoop thread as they arrive, one at a
+    time, so client state stays consistent as long as the synchronous
+    methods inherited from HttpInitiatorClient are not used from other
+    threads at the same time.
+
+    """
+
+    def __init__(self, config, tls_state, default_url=None,
+                 supervisor=False, exporter=None, concurrency=None):
+        super().__init__(config, tls_state, default_url=default_url,
+                         supervisor=supervisor, exporter=exporter)
+        if concurrency is None:
+            concurrency = DEFAULT_FANOUT_CONCURRENCY
+            if config is not None and "client" in config:
+                concurrency = int(config["client"].get("fanout-concurrency",
+                                                       concurrency))
+        self._concurrency = concurrency
+        self._semaphore = tornado.locks.Semaphore(concurrency)
+        self._http = None
+        self._http_loop = None
+
+    def _http_client(self):
+        # one AsyncHTTPClient per IOLoop, allowed as many connections
+        # as we allow requests
+        loop = tornado.ioloop.IOLoop.current()
+        if self._http_loop is not loop:
+            self._http = tornado.httpclient.AsyncHTTPClient(
+                                force_instance=True, max_clients=self._concurrency)
+            self._http_loop = loop
+        return self._http
+
+    @tornado.gen.coroutine
+    def _fetch(self, url, method="GET", body=None, headers=None):
+        # make a request to a URL, waiting for a slot if too many are
+        # in flight; raises on connection errors
+        if url.scheme is None:
+            if self._tls_state.client_ssl_context() is not None:
+                url = url._replace(scheme="https")
+            else:
+                url = url._replace(scheme="http")
+        ssl_options = None
+        if url.scheme == "https":
+            # Tornado does not match the hostname against the certificate
+            ssl_options = self._tls_state.client_ssl_context(check_hostname=True)
+            if ssl_options is None:
+                raise ValueError("SSL requested without providing certificate")
+        elif url.scheme != "http":
+            raise ValueError("Unsupported scheme "+str(url.scheme))
+
+        headers = dict(headers or {})
+        if body is not None:
+            headers["Content-Type"] = "application/x-mplane+json"
+        if self._tls_state.forged_identity():
+            headers[FORGED_DN_HEADER] = self._tls_state.forged_identity()
+
+        request = tornado.httpclient.HTTPRequest(url.url, method=method,
+                                                 headers=headers, body=body,
+                                                 ssl_options=ssl_options)
+        with (yield self._semaphore.acquire()):
+            res = yield self._http_client().fetch(request, raise_error=False)
+        # the response was decompressed on the way in
+        self._note_encoding(url, res.headers.get("X-Consumed-Content-Encoding",
+                                                 res.headers.get("Content-Encoding")))
+        return res
+
+    @tornado.gen.coroutine
+    def _peer_identity(self, url):
+        # may connect to the peer to learn its identity; keep that off
+        # the IOLoop
+        identity = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                            None, self._tls_state.extract_peer_identity, url)
+        return identity
+
+    @tornado.gen.coroutine
+    def _post_message_async(self, msg, dst_url=None):
+        if not dst_url:
+            dst_url = self._default_url
+        if isinstance(dst_url, str):
+            dst_url = urllib3.util.parse_url(dst_url)
+
+        # receipts will be redeemed where the specification went
+        if isinstance(msg, mplane.model.Specification):
+            self._receipt_urls[msg.get_token()] = dst_url
+
+        headers = {}
+        body = self._request_body(msg, dst_url, headers)
+        res = yield self._fetch(dst_url, "POST", body, headers)
+        if (res.code == 200 and
+            res.headers.get("Content-Type") == "application/x-mplane+json"):
+            component_identity = yield self._peer_identity(dst_url)
+            return (mplane.model.parse_json(res.body.decode("utf-8")), component_identity)
+        return (None, None)
+
+    @tornado.gen.coroutine
+    def send_message_async(self, msg, dst_url=None):
+        """
+        Send a message, store any reply in client state, and return the
+        reply (or None).
+
+        """
+        (reply, component_identity) = yield self._post_message_async(msg, dst_url)
+        if reply is not None:
+            self.handle_message(reply, component_identity)
+        return reply
+
+    @tornado.gen.coroutine
+    def invoke_capability_async(self, cap_tol, when, params, relabel=None):
+        """
+        Like invoke_capability(): derive a specification from a
+        capability and send it where the capability came from.
+
+        """
+        (cap, spec) = self._spec_for(cap_tol, when, params, relabel)
+        spec.validate()
+        yield self.send_message_async(spec, cap.get_link())
+        return spec
+
+    @tornado.gen.coroutine
+    def invoke_capabilities_async(self, invocations):
+        """
+        Invoke many capabilities concurrently. invocations is a list of
+        (cap_tol, when, params) or (cap_tol, when, params, relabel)
+        tuples. Returns the specifications sent, in order, with None for
+        those which could not be sent.
+
+        """
+        specs = yield [self._try(self.invoke_capability_async, *invocation)
+                       for invocation in invocations]
+        return specs
+
+    @tornado.gen.coroutine
+    def redeem_due_async(self):
+        """
+        Like redeem_due(), with the components redeemed from concurrently.
+        Returns the number of receipts redeemed.
+
+        """
+        redeemed = yield [self._redeem_async(url, receipts)
+                          for (url, receipts) in self._due_batches()]
+        return sum(redeemed)
+
+    @tornado.gen.coroutine
+    def _redeem_async(self, url, receipts):
+        last = {r.get_token(): self._results.get(r.get_token()) for r in receipts}
+        try:
+            (reply, component_identity) = yield self._post_message_async(
+                                    self._redemption_for(receipts), url)
+        except (OSError, tornado.httpclient.HTTPClientError) as e:
+            print("Component at " + str(url) + " unreachable (" + repr(e) + ")")
+            self._reschedule({token: None for token in last}, failed=True)
+            return 0
+
+        if len(receipts) > 1 and isinstance(reply, mplane.model.Exception):
+            # the component does not take envelopes; redeem one by one
+            redeemed = yield [self._redeem_async(url, [receipt])
+                              for receipt in receipts]
+            return sum(redeemed)
+        if reply is not None:
+            self.handle_message(reply, component_identity)
+        self._reschedule(last)
+        return len(receipts)
+
+    @tornado.gen.coroutine
+    def retrieve_capabilities_async(self, urls, force=False):
+        """
+        Like retrieve_capabilities(), for a list of URLs crawled
+        concurrently, along with the capability links found on them.
+        Unreachable URLs are reported and skipped.
+
+        """
+        yield [self._try(self._crawl_async, url, [], None, force)
+               for url in urls]
+
+    @tornado.gen.coroutine
+    def _crawl_async(self, url, urlchain, identity, force):
+        if isinstance(url, str):
+            url = urllib3.util.parse_url(url)
+
+        # detect loops in capability links
+        if str(url) in urlchain:
+            return
+
+        if not self._default_url:
+            self.set_default_url(url)
+
+        res = yield self._fetch(url, headers=self._crawl_headers(url, force))
+        if res.code != 200:
+            return
+        digest = hashlib.md5(res.body).hexdigest()
+        if not force and self._crawl_digests.get(str(url)) == digest:
+            return
+
+        if identity is None:
+            identity = yield self._peer_identity(url)
+
+        ctype = res.headers.get("Content-Type")
+        if ctype == "application/x-mplane+json":
+            # Probably an envelope. Process the message.
+            self.handle_message(
+                mplane.model.parse_json(res.body.decode("utf-8")), identity)
+        elif ctype == "text/html":
+            # Treat as a list of links to capability messages.
+            parser = CrawlParser()
+            parser.feed(res.body.decode("utf-8"))
+            parser.close()
+            yield [self._crawl_async(urllib.parse.urljoin(str(url), capurl),
+                                     urlchain + [str(url)], identity, force)
+                   for capurl in parser.urls]
+
+        self._crawled(url, digest, res.headers.get("ETag"))
+
+    @tornado.gen.coroutine
+    def _try(self, fn, *args):
+        # run one of many concurrent requests, so that one failure does
+        # not fail the others
+        try:
+            result = yield fn(*args)
+        except (OSError, ValueError, KeyError,
+                tornado.httpclient.HTTPClientError) as e:
+            print("Request failed: " + repr(e))
+            result = None
+        return result
 
 class HttpListenerClient(BaseClient):
     """
@@ -598,18 +1103,32 @@ class HttpListenerClient(BaseClient):
             registration_path = config["client"]["registration-path"]
 
         specification_path = DEFAULT_SPECIFICATION_PATH
-        if "registration-path" in config["client"]:
+        if "specification-path" in config["client"]:
             specification_path = config["client"]["specification-path"]
 
         result_path = DEFAULT_RESULT_PATH
         if "result-path" in config["client"]:
             result_path = config["client"]["result-path"]
 
+        websocket_path = DEFAULT_WEBSOCKET_PATH
+        if "websocket-path" in config["client"]:
+            websocket_path = config["client"]["websocket-path"]
+
+        self._max_spec_wait = MAX_SPECIFICATION_WAIT
+        if "specification-max-wait" in config["client"]:
+            self._max_spec_wait = float(config["client"]["specification-max-wait"])
+
         # link to which results must be sent
         self._link = config["client"]["listen-spec-link"]
 
         # Outgoing messages per component identifier
         self._outgoing = {}
+        self._outgoing_lock = Lock()
+
+        # Pending long-poll specification requests and open WebSockets
+        # per component identifier, and the IOLoop they are served on
+        self._spec_waiters = {}
+        self._websockets = {}
 
         # specification serial number
         # used to create labels programmatically
@@ -619,6 +1138,10 @@ class HttpListenerClient(BaseClient):
         self._callback_capability = {}
 
         # Create a request handler pointing at this client
+        compress_min_bytes = int(config["client"].get("compress-min-bytes",
+                                         mplane.utils.COMPRESS_MIN_BYTES))
+        self._parse_inline_max = int(config["client"].get("parse-inline-max-bytes",
+                                             mplane.utils.PARSE_INLINE_MAX_BYTES))
         self._tornado_application = tornado.web.Application([
             (r"/" + registration_path, RegistrationHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (r"/" + registration_path + "/", RegistrationHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
@@ -626,11 +1149,17 @@ class HttpListenerClient(BaseClient):
             (r"/" + specification_path + "/", SpecificationHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (r"/" + result_path, ResultHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (r"/" + result_path + "/", ResultHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
-        ])
-        http_server = tornado.httpserver.HTTPServer(self._tornado_application, ssl_options=tls_state.get_ssl_options())
-
-        # run the server
+            (r"/" + websocket_path, MessageWebSocketHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
+        ], transforms=mplane.utils.compression_transforms(compress_min_bytes))
+        # components may send gzip-compressed results
+        http_server = tornado.httpserver.HTTPServer(self._tornado_application,
+                                                    ssl_options=tls_state.get_ssl_options(),
+                                                    decompress_request=True)
+
+        # run the server; remember its IOLoop now, so that messages
+        # pushed before the first component connects still wake it
         http_server.listen(listen_port)
+        self._io_loop = tornado.ioloop.IOLoop.current()
         if io_loop is not None:
             cli_t = Thread(target=self.listen_in_background(io_loop))
         else:
@@ -646,10 +1175,99 @@ class HttpListenerClient(BaseClient):
         if io_loop is None:
             tornado.ioloop.IOLoop.instance().start()
 
+    def _export(self, msg, identity):
+        # called on the IOLoop; handlers check _has_room() first, so this
+        # only blocks for envelopes larger than the exporter's queue
+        try:
+            self._exporter.put_nowait([msg, identity])
+        except queue.Full:
+            self._exporter.put([msg, identity])
+
+    def _has_room(self, identity, msg):
+        """
+        Return True if the supervisor can take msg from identity now.
+        Handlers refuse messages otherwise, so that a busy supervisor
+        pushes back on components instead of queueing without bound.
+
+        """
+        if not self._supervisor or not hasattr(self._exporter, "room_for"):
+            return True
+        count = len(msg) + 1 if isinstance(msg, mplane.model.Envelope) else 1
+        return self._exporter.room_for(identity, count)
+
     def _push_outgoing(self, identity, msg):
-        if identity not in self._outgoing:
-            self._outgoing[identity] = []
-        self._outgoing[identity].append(msg)
+        with self._outgoing_lock:
+            if identity not in self._outgoing:
+                self._outgoing[identity] = []
+            self._outgoing[identity].append(msg)
+
+        # push to the component's WebSocket, or wake up a specification
+        # request held open for it; this may be called from any thread,
+        # so hop onto the IOLoop first.
+        self._io_loop.add_callback(self._deliver_outgoing, identity)
+
+    def _deliver_outgoing(self, identity):
+        if identity in self._websockets:
+            msgs = self._pop_outgoing(identity)
+            for (i, msg) in enumerate(msgs):
+                try:
+                    self._websockets[identity].send_message(msg)
+                except tornado.websocket.WebSocketClosedError:
+                    # keep the rest for the next connection or request
+                    with self._outgoing_lock:
+                        self._outgoing[identity] = msgs[i:] + self._outgoing.get(identity, [])
+                    self._websockets.pop(identity, None)
+                    break
+        else:
+            self._wake_spec_waiters(identity)
+
+    def _attach_websocket(self, identity, handler):
+        """
+        Route messages for identity over a WebSocket it opened, starting
+        with any already queued. Must be called on the IOLoop.
+
+        """
+        old = self._websockets.get(identity)
+        self._websockets[identity] = handler
+        if old is not None:
+            old.close()
+        self._deliver_outgoing(identity)
+
+    def _detach_websocket(self, identity, handler):
+        if self._websockets.get(identity) is handler:
+            del self._websockets[identity]
+
+    def _pop_outgoing(self, identity):
+        with self._outgoing_lock:
+            return self._outgoing.pop(identity, [])
+
+    def _has_outgoing(self, identity):
+        with self._outgoing_lock:
+            return len(self._outgoing.get(identity, [])) > 0
+
+    def _wait_for_outgoing(self, identity):
+        """
+        Return a Future resolved when a message is queued for the
+        given identity. Must be called on the IOLoop.
+
+        """
+        waiter = tornado.concurrent.Future()
+        self._spec_waiters.setdefault(identity, []).append(waiter)
+        return waiter
+
+    def _cancel_wait(self, identity, waiter):
+        waiters = self._spec_waiters.get(identity, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self._spec_waiters.pop(identity, None)
+        if not waiter.done():
+            waiter.set_result(False)
+
+    def _wake_spec_waiters(self, identity):
+        for waiter in self._spec_waiters.pop(identity, []):
+            if not waiter.done():
+                waiter.set_result(True)
 
     def invoke_capability(self, cap_tol, when, params, relabel=None, callback_when=None):
         """
@@ -715,8 +1333,7 @@ class MPlaneHandler(tornado.web.RequestHandler):
         """
         self.set_status(200)
         self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
-        self.finish()
+        mplane.utils.write_message(self, msg)
 
     def _respond_plain_text(self, code, text = None):
         """
@@ -729,6 +1346,14 @@ class MPlaneHandler(tornado.web.RequestHandler):
             self.write(text)
         self.finish()
 
+    def _respond_busy(self):
+        """
+        Returns a 503 response asking the component to retry later
+
+        """
+        self.set_header("Retry-After", str(BUSY_RETRY_AFTER))
+        self._respond_plain_text(503, "Busy, retry later")
+
     def _respond_json_text(self, code, text = None):
         """
         Returns an HTTP response containing a plain text message
@@ -751,16 +1376,21 @@ class RegistrationHandler(MPlaneHandler):
         self._tls = tlsState
 
 
+    @tornado.gen.coroutine
     def post(self):
         # unwrap json message from body
         if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            env = mplane.model.parse_json(self.request.body.decode("utf-8"))
+            env = yield mplane.utils.parse_body(self.request.body,
+                                                self._listenerclient._parse_inline_max)
         else:
             self._respond_plain_text(400, "Invalid format")
             return
 
-        self._listenerclient.handle_message(env,
-                            self._tls.extract_peer_identity(self.request))
+        identity = self._tls.extract_peer_identity(self.request)
+        if not self._listenerclient._has_room(identity, env):
+            self._respond_busy()
+            return
+        self._listenerclient.handle_message(env, identity)
 
         # reply to the component
         response = ""
@@ -778,14 +1408,45 @@ class SpecificationHandler(MPlaneHandler):
     Exposes the specifications, that will be periodically pulled by the
     components
 
+    A component may pass ?wait=<seconds> to long-poll: if nothing is
+    queued for it, the request is held open until something is, or
+    until the wait (capped by the client) expires.
+
     """
     def initialize(self, listenerclient, tlsState):
         self._listenerclient = listenerclient
         self._tls = tlsState
+        self._waiter = None
+        self._closed = False
 
+    @tornado.gen.coroutine
     def get(self):
         identity = self._tls.extract_peer_identity(self.request)
-        specs = self._listenerclient._outgoing.pop(identity, [])
+
+        try:
+            wait = min(float(self.get_argument("wait", 0)),
+                       self._listenerclient._max_spec_wait)
+        except ValueError:
+            self._respond_plain_text(400, "Invalid wait")
+            return
+
+        if wait > 0 and not self._listenerclient._has_outgoing(identity):
+            self._waiter = self._listenerclient._wait_for_outgoing(identity)
+            try:
+                yield tornado.gen.with_timeout(timedelta(seconds=wait),
+                                               self._waiter)
+            except tornado.gen.TimeoutError:
+                pass
+            finally:
+                self._listenerclient._cancel_wait(identity, self._waiter)
+                self._waiter = None
+
+        # component went away while we were waiting: leave its
+        # messages queued for the next request
+        if self._closed:
+            return
+
+        specs = self._listenerclient._pop_outgoing(identity)
         env = mplane.model.Envelope()
         for spec in specs:
             env.append_message(spec)
@@ -795,6 +1456,53 @@ class SpecificationHandler(MPlaneHandler):
                 print("Interrupt " + spec.get_token() + " successfully pulled by " + identity)
         self._respond_json_text(200, mplane.model.unparse_json(env))
 
+    def on_connection_close(self):
+        self._closed = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(False)
+
+class MessageWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Exchanges messages with a component over a WebSocket it opened:
+    capabilities, receipts and results arrive as they are sent, and
+    specifications and interrupts are pushed as soon as they are queued,
+    one JSON message per WebSocket message.
+
+    """
+    def initialize(self, listenerclient, tlsState):
+        self._listenerclient = listenerclient
+        self._tls = tlsState
+        self._identity = None
+
+    def prepare(self):
+        # the TLS connection is detached from the request once upgraded
+        self._identity = self._tls.extract_peer_identity(self.request)
+
+    def open(self):
+        print("WebSocket opened by " + self._identity)
+        self._listenerclient._attach_websocket(self._identity, self)
+
+    @tornado.gen.coroutine
+    def on_message(self, text):
+        try:
+            msg = mplane.model.parse_json(text)
+        except ValueError as e:
+            print("Invalid message from " + self._identity + ": " + repr(e))
+            return
+        # no further messages are read from this socket while we wait
+        while not self._listenerclient._has_room(self._identity, msg):
+            yield tornado.gen.sleep(BUSY_POLL_INTERVAL)
+        self._listenerclient.handle_message(msg, self._identity)
+
+    def on_close(self):
+        if self._identity is not None:
+            self._listenerclient._detach_websocket(self._identity, self)
+
+    def send_message(self, msg):
+        if isinstance(msg, mplane.model.Specification):
+            print("Specification " + msg.get_label() + " pushed to " + self._identity)
+        self.write_message(mplane.model.unparse_json(msg))
+
 class ResultHandler(MPlaneHandler):
     """
     Receives results of specifications
@@ -805,15 +1513,20 @@ class ResultHandler(MPlaneHandler):
         self._listenerclient = listenerclient
         self._tls = tlsState
 
+    @tornado.gen.coroutine
     def post(self):
         # unwrap json message from body
         if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            env = mplane.model.parse_json(self.request.body.decode("utf-8"))
+            env = yield mplane.utils.parse_body(self.request.body,
+                                                self._listenerclient._parse_inline_max)
         else:
             self._respond_plain_text(400, "Invalid format")
             return
 
-        self._listenerclient.handle_message(env,
-                            self._tls.extract_peer_identity(self.request))
+        identity = self._tls.extract_peer_identity(self.request)
+        if not self._listenerclient._has_room(identity, env):
+            self._respond_busy()
+            return
+        self._listenerclient.handle_message(env, identity)
         self._respond_plain_text(200)
         return
@@ -27,9 +27,16 @@ import mplane.utils
 import mplane.model
 import mplane.azn
 import mplane.tls
+import mplane.spool
 import importlib
 import tornado.web
 import tornado.httpserver
+import tornado.httpclient
+import tornado.ioloop
+import tornado.gen
+import tornado.websocket
+import tornado.netutil
+import tornado.process
 from datetime import datetime
 import time
 from time import sleep
@@ -43,19 +50,56 @@ try:
 except:
     pass
 
-from threading import Thread
+from threading import Thread, Lock, Event
+import collections
+import queue
 import json
+import os
+import shutil
+import atexit
+import tempfile
 
 DEFAULT_MPLANE_PORT = 1228
 SLEEP_QUANTUM = 0.250
 CAPABILITY_PATH_ELEM = "capability"
 SPECIFICATION_PATH_ELEM = "/"
 
+# Seconds between specification polls when not long-polling
+DEFAULT_IDLE_TIME = 5
+# Seconds to ask the Client/Supervisor to hold a specification request open
+DEFAULT_SPECIFICATION_WAIT = 30
+
+# Result upload pipeline defaults for component-initiated workflows
+DEFAULT_UPLOAD_WORKERS = 2
+DEFAULT_UPLOAD_QUEUE_SIZE = 1000
+DEFAULT_UPLOAD_BATCH_SIZE = 20
+DEFAULT_UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF_BASE = 0.5
+UPLOAD_BACKOFF_MAX = 30
+# Seconds between checks of an empty spool
+SPOOL_IDLE_TIME = 5
+# Path on the Client/Supervisor accepting WebSocket connections
+DEFAULT_WEBSOCKET_PATH = "ws"
+# Messages kept for the Client/Supervisor while the WebSocket is down
+WEBSOCKET_BACKLOG_SIZE = 10000
+
+def _remove_job_dir(job_dir, pid):
+    # forked workers inherit the exit handler, but only the process
+    # which created the directory may remove it
+    if os.getpid() == pid:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
 class BaseComponent(object):
 
     def __init__(self, config):
         self.config = config
 
+        # compiled registry cache
+        if "registry_cache" in config["component"]:
+            mplane.model.set_registry_cache(
+                config["component"]["registry_cache"],
+                offline=config["component"].getboolean("registry_offline", fallback=False))
+
         # preload any registries necessary
         if "registry_preload" in config["component"]:
             mplane.model.preload_registry(
@@ -68,8 +112,11 @@ class BaseComponent(object):
             registry_uri = None
         mplane.model.initialize_registry(registry_uri)
 
-        self.tls = mplane.tls.TlsState(self.config)
-        self.scheduler = mplane.scheduler.Scheduler(config)
+        self.tls = mplane.tls.TlsState(
+            self.config,
+            num_pools=int(config["component"].get("connection_pools",
+                                                  mplane.tls.POOL_NUM_POOLS)))
+        self.scheduler = mplane.scheduler.Scheduler(config, tls_state=self.tls)
 
         for service in self._services():
             if config["component"]["workflow"] == "client-initiated" and \
@@ -93,6 +140,15 @@ class BaseComponent(object):
         return services
 
 class ListenerHttpComponent(BaseComponent):
+    """
+    Component answering specifications, redemptions and capability
+    requests from clients over HTTP(S). With processes set to more than
+    one (or to 0, for one per CPU), the component forks into worker
+    processes sharing the listening socket; the workers' schedulers
+    share job replies through a JobStore in job_dir, so a redemption
+    reaching any worker finds its job.
+
+    """
 
     def __init__(self, config, io_loop=None):
         if "listen-port" in config["component"]:
@@ -101,18 +157,43 @@ class ListenerHttpComponent(BaseComponent):
             self._port = DEFAULT_MPLANE_PORT
         self._path = SPECIFICATION_PATH_ELEM
 
+        processes = int(config["component"].get("processes", 1))
+        if processes != 1 and "job_dir" not in config["component"]:
+            job_dir = tempfile.mkdtemp(prefix="mplane-jobs-")
+            config["component"]["job_dir"] = job_dir
+            # the parent outlives the workers, and removes it on exit
+            atexit.register(_remove_job_dir, job_dir, os.getpid())
+
         super(ListenerHttpComponent, self).__init__(config)
 
+        if processes != 1:
+            # bind before forking, so every worker accepts on the socket
+            sockets = tornado.netutil.bind_sockets(self._port)
+            task_id = tornado.process.fork_processes(processes)
+            print("ListenerHttpComponent worker "+str(task_id)+" running on port "+str(self._port))
+        else:
+            sockets = None
+
+        compress_min_bytes = int(config["component"].get("compress_min_bytes",
+                                         mplane.utils.COMPRESS_MIN_BYTES))
+        parse_inline_max = int(config["component"].get("parse_inline_max_bytes",
+                                       mplane.utils.PARSE_INLINE_MAX_BYTES))
         application = tornado.web.Application([
-            (r"/", MessagePostHandler, {'scheduler': self.scheduler, 'tlsState': self.tls}),
+            (r"/", MessagePostHandler, {'scheduler': self.scheduler, 'tlsState': self.tls,
+                                        'parse_inline_max': parse_inline_max}),
             (r"/"+CAPABILITY_PATH_ELEM, DiscoveryHandler, {'scheduler': self.scheduler, 'tlsState': self.tls}),
             (r"/"+CAPABILITY_PATH_ELEM+"/.*", DiscoveryHandler, {'scheduler': self.scheduler, 'tlsState': self.tls})
-        ])
+        ], transforms=mplane.utils.compression_transforms(compress_min_bytes))
+        # clients and exporters may send gzip-compressed messages
         http_server = tornado.httpserver.HTTPServer(
                         application,
-                        ssl_options=self.tls.get_ssl_options())
-        http_server.listen(self._port)
-        print("ListenerHttpComponent running on port "+str(self._port))
+                        ssl_options=self.tls.get_ssl_options(),
+                        decompress_request=True)
+        if sockets is not None:
+            http_server.add_sockets(sockets)
+        else:
+            http_server.listen(self._port)
+            print("ListenerHttpComponent running on port "+str(self._port))
         comp_t = Thread(target=self.listen_in_background(io_loop))
         comp_t.setDaemon(True)
         comp_t.start()
@@ -131,14 +212,21 @@ class MPlaneHandler(tornado.web.RequestHandler):
     def _respond_message(self, msg):
         self.set_status(200)
         self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
+        mplane.utils.write_message(self, msg)
+
+    def _respond_json(self, body):
+        self.set_status(200)
+        self.set_header("Content-Type", "application/x-mplane+json")
+        self.write(body)
         self.finish()
 
 class DiscoveryHandler(MPlaneHandler):
     """
     Exposes the capabilities registered with a given scheduler.
     URIs ending with "capability" will result in an HTML page
-    listing links to each capability.
+    listing links to each capability, or, for clients accepting
+    application/x-mplane+json, in an Envelope of all the capabilities
+    at once, which is only sent again when it changes (ETag).
 
     """
 
@@ -159,6 +247,10 @@ class DiscoveryHandler(MPlaneHandler):
             raise ValueError("I only know how to handle /"+CAPABILITY_PATH_ELEM+" URLs via HTTP GET")
 
     def _respond_capability_links(self):
+        if "application/x-mplane+json" in self.request.headers.get("Accept", ""):
+            self._respond_capability_envelope()
+            return
+
         self.set_status(200)
         self.set_header("Content-Type", "text/html")
         self.write("<html><head><title>Capabilities</title></head><body>")
@@ -168,21 +260,34 @@ class DiscoveryHandler(MPlaneHandler):
         self.write("</body></html>")
         self.finish()
 
+    def _respond_capability_envelope(self):
+        (body, etag) = self.scheduler.capability_envelope(
+                            self.tls.extract_peer_identity(self.request))
+        self.set_header("Etag", etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        self._respond_json(body)
+
     def _respond_capability(self, key):
-        self._respond_message(self.scheduler.capability_for_key(key))
+        self._respond_json(self.scheduler.capability_json(key))
 
 class MessagePostHandler(MPlaneHandler):
     """
     Receives mPlane messages POSTed from a client, and passes them to a
     scheduler for processing. After waiting for a specified delay to see
     if a Result is immediately available, returns a receipt for future
-    redemption.
+    redemption. Envelopes of messages (e.g. batched redemptions) are
+    processed in one pass and answered with an envelope of replies.
 
     """
-    def initialize(self, scheduler, tlsState, immediate_ms = 5000):
+    def initialize(self, scheduler, tlsState, immediate_ms = 5000,
+                   parse_inline_max = mplane.utils.PARSE_INLINE_MAX_BYTES):
         self.scheduler = scheduler
         self.tls = tlsState
         self.immediate_ms = immediate_ms
+        self.parse_inline_max = parse_inline_max
 
     def get(self):
         # message
@@ -194,36 +299,295 @@ class MessagePostHandler(MPlaneHandler):
         for key in self.scheduler.capability_keys():
             if self.scheduler.azn.check(self.scheduler.capability_for_key(key), self.tls.extract_peer_identity(self.request)):
                 self.write("<br/><pre>")
-                self.write(mplane.model.unparse_json(self.scheduler.capability_for_key(key)))
+                self.write(self.scheduler.capability_json(key))
         self.write("</body></html>")
         self.finish()
 
+    @tornado.gen.coroutine
     def post(self):
         # unwrap json message from body
         if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
-            msg = mplane.model.parse_json(self.request.body.decode("utf-8"))
+            msg = yield mplane.utils.parse_body(self.request.body, self.parse_inline_max)
         else:
             # FIXME how do we tell tornado we don't want to handle this?
             raise ValueError("I only know how to handle mPlane JSON messages via HTTP POST")
 
-        # hand message to scheduler
-        reply = self.scheduler.process_message(self.tls.extract_peer_identity(self.request), msg)
+        # hand message to scheduler; large envelopes of results to
+        # collect are stored off the IOLoop too, as collecting only
+        # touches the collectors, but jobs are only handled on the IOLoop
+        user = self.tls.extract_peer_identity(self.request)
+        if len(self.request.body) > self.parse_inline_max and \
+           (isinstance(msg, mplane.model.Result) or
+            (isinstance(msg, mplane.model.Envelope) and
+             all(isinstance(m, mplane.model.Result) for m in msg.messages()))):
+            reply = yield mplane.utils.run_off_loop(self.scheduler.collect, user, msg)
+        else:
+            reply = self.scheduler.process_message(user, msg)
 
-        # wait for immediate delay
+        # wait for immediate delay, serving other requests meanwhile
+        # (unless the job runs in another process of this component)
+        job = None
         if self.immediate_ms > 0 and \
            isinstance(msg, mplane.model.Specification) and \
            isinstance(reply, mplane.model.Receipt):
             job = self.scheduler.job_for_message(reply)
+        if job is not None:
             wait_start = datetime.utcnow()
             while (datetime.utcnow() - wait_start).total_seconds() * 1000 < self.immediate_ms:
-                time.sleep(SLEEP_QUANTUM)
+                yield tornado.gen.sleep(SLEEP_QUANTUM)
                 if job.failed() or job.finished():
                     reply = job.get_reply()
                     break
 
+        # collected results get no reply message
+        if reply is None:
+            self.set_status(200)
+            self.finish()
+            return
+
         # return reply
         self._respond_message(reply)
 
+class ResultUploader(object):
+    """
+    Returns replies (results, exceptions, ...) to the Client/Supervisor
+    from a small pool of worker threads, so job threads never block on
+    the network.
+
+    Replies wait in a bounded queue; a full queue blocks submit(),
+    pushing back on the jobs producing them. Each worker takes whatever
+    is waiting (up to batch_size replies), wraps the replies bound for
+    the same URL in one Envelope, and POSTs it (gzip-compressed if it
+    is at least compress_min_bytes long), retrying with exponential
+    backoff on connection errors and 5xx responses.
+
+    Given a mplane.spool.Spool, replies that still cannot be delivered
+    are written to it instead of being dropped, as are all replies
+    while it holds anything, so that order is kept. A replay thread
+    sends spooled replies, oldest first, as soon as the peer is back.
+
+    """
+    def __init__(self, tls_state, workers=DEFAULT_UPLOAD_WORKERS,
+                 queue_size=DEFAULT_UPLOAD_QUEUE_SIZE,
+                 batch_size=DEFAULT_UPLOAD_BATCH_SIZE,
+                 retries=DEFAULT_UPLOAD_RETRIES, spool=None,
+                 compress_min_bytes=mplane.utils.COMPRESS_MIN_BYTES):
+        self._tls = tls_state
+        self._spool = spool
+        self._compress_min_bytes = compress_min_bytes
+        self._replay_wakeup = Event()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch_size = max(1, batch_size)
+        self._retries = retries
+
+        self._stats_lock = Lock()
+        self._stats = collections.Counter()
+        self._latency_max = 0.0
+
+        self._workers = []
+        for i in range(max(1, workers)):
+            t = Thread(target=self._work, name="result-upload-" + str(i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+        if spool is not None:
+            t = Thread(target=self._replay, name="result-replay")
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, url, msg):
+        """
+        Queue a message for POSTing to url (a urllib3 Url).
+        Blocks while the queue is full.
+
+        """
+        self._queue.put((url, msg, time.monotonic()))
+        self._count("submitted")
+
+    def send(self, url, msg):
+        """
+        POST a message to url from the calling thread, without retrying.
+        Returns True if it was delivered; if not, it is spooled if
+        there is a spool.
+
+        """
+        self._count("submitted")
+        return self._upload(url, [(msg, time.monotonic())], retries=0)
+
+    def stats(self):
+        """
+        Return a dictionary of upload counters, the current queue depth,
+        and mean/max latency (seconds from submit() to upload).
+
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            uploaded = stats.pop("latency_count", 0)
+            total = stats.pop("latency_total", 0)
+            stats["latency_mean"] = total / uploaded if uploaded else 0.0
+            stats["latency_max"] = self._latency_max
+        stats["queue_depth"] = self._queue.qsize()
+        if self._spool is not None:
+            for (key, value) in self._spool.stats().items():
+                stats["spool_" + key] = value
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # one POST per destination, in submission order
+            by_url = collections.OrderedDict()
+            for (url, msg, submitted) in batch:
+                by_url.setdefault(url, []).append((msg, submitted))
+            for url in by_url:
+                try:
+                    self._upload(url, by_url[url])
+                except Exception as e:
+                    # never let a bad message kill the worker
+                    print("Error returning results to " + str(url) + ": " + repr(e))
+                    self._count("failed", len(by_url[url]))
+
+            for i in range(len(batch)):
+                self._queue.task_done()
+
+    def _upload(self, url, items, retries=None):
+        # stay behind anything already waiting in the spool
+        if self._spool is not None and self._spool.pending():
+            self._spool_items(url, items)
+            return False
+
+        delivered = self._post(url, items, self._retries if retries is None else retries)
+        if delivered is None and self._spool is not None:
+            self._spool_items(url, items)
+        elif not delivered:
+            self._count("failed", len(items))
+        return bool(delivered)
+
+    def _spool_items(self, url, items):
+        for (msg, submitted) in items:
+            self._spool.append(url.url, msg)
+        self._count("spooled", len(items))
+        self._replay_wakeup.set()
+
+    def _post(self, url, items, retries):
+        """
+        POST items to url as one message. Returns True if delivered,
+        False if the peer refused them, None if it could not be reached.
+
+        """
+        if len(items) == 1:
+            reply = items[0][0]
+        else:
+            reply = mplane.model.Envelope()
+            for (msg, submitted) in items:
+                reply.append_message(msg)
+        headers = {"content-type": "application/x-mplane+json",
+                   "accept-encoding": "gzip"}
+        body = mplane.utils.compress_body(mplane.model.unparse_json(reply).encode("utf-8"),
+                                          headers, self._compress_min_bytes)
+        pool = self._tls.pool_for(url.scheme, url.host, url.port)
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self._count("retries")
+                sleep(min(UPLOAD_BACKOFF_BASE * 2 ** (attempt - 1),
+                          UPLOAD_BACKOFF_MAX))
+            try:
+                res = pool.urlopen('POST', url.path or "/", body=body,
+                                   headers=headers)
+            except urllib3.exceptions.HTTPError as e:
+                print("Client/Supervisor unreachable (" + repr(e) + ")")
+                continue
+
+            if res.status == 200:
+                self._uploaded(items)
+                return True
+            print("Error returning results, Client/Supervisor said: " +
+                  str(res.status) + " - " + res.data.decode("utf-8"))
+            if res.status < 500:
+                # the Client/Supervisor will not take these; don't insist
+                return False
+
+        return None
+
+    def _replay(self):
+        delay = SPOOL_IDLE_TIME
+        backoff = UPLOAD_BACKOFF_BASE
+        while True:
+            self._replay_wakeup.wait(delay)
+            self._replay_wakeup.clear()
+
+            # appends only apply the spool's caps when a segment fills
+            # up, so apply them here before replaying after a pause
+            if delay:
+                self._spool.compact()
+
+            records = self._spool.peek(self._batch_size)
+            if len(records) == 0:
+                delay = SPOOL_IDLE_TIME
+                continue
+
+            # send the oldest run of records bound for the same URL
+            url = records[0][1]
+            run = []
+            for (position, rurl, msg) in records:
+                if rurl != url:
+                    break
+                run.append((position, msg))
+            try:
+                delivered = self._post(urllib3.util.parse_url(url),
+                                       [(msg, None) for (position, msg) in run], 0)
+            except Exception as e:
+                print("Error replaying spooled results to " + url + ": " + repr(e))
+                delivered = None
+
+            if delivered is None:
+                # still unreachable: back off
+                delay = backoff
+                backoff = min(backoff * 2, UPLOAD_BACKOFF_MAX)
+                continue
+            if not delivered:
+                self._count("failed", len(run))
+            self._spool.ack(run[-1][0])
+            self._count("replayed", len(run))
+            delay = 0
+            backoff = UPLOAD_BACKOFF_BASE
+
+    def _uploaded(self, items):
+        now = time.monotonic()
+        with self._stats_lock:
+            self._stats["uploaded"] += len(items)
+            self._stats["batches"] += 1
+            for (msg, submitted) in items:
+                if submitted is None:
+                    continue
+                latency = now - submitted
+                self._stats["latency_count"] += 1
+                self._stats["latency_total"] += latency
+                self._latency_max = max(self._latency_max, latency)
+
+        for (msg, submitted) in items:
+            if isinstance(msg, mplane.model.Envelope):
+                for msg in msg.messages():
+                    break
+            if isinstance(msg, mplane.model.Exception):
+                print("Exception for " + msg.get_token() + " successfully returned!")
+            elif not isinstance(msg, mplane.model.Receipt):
+                print("Result for " + str(msg.get_label() or msg.get_token()) +
+                      " successfully returned!")
+
 class InitiatorHttpComponent(BaseComponent):
 
     def __init__(self, config, supervisor=False):
@@ -255,8 +619,37 @@ class InitiatorHttpComponent(BaseComponent):
         if not self.result_path.startswith("/"):
             self.result_path = "/" + self.result_path
 
+        # long-poll for specifications; 0 falls back to fixed-interval polling
+        self.spec_wait = DEFAULT_SPECIFICATION_WAIT
+        if "specification_wait" in self.config["component"]:
+            self.spec_wait = float(self.config["component"]["specification_wait"])
+
         self.pool = self.tls.pool_for(self.url.scheme, self.url.host, self.url.port)
         self._result_url = dict()
+        # the Client/Supervisor takes gzip-compressed messages
+        self._compress_min_bytes = int(self.config["component"].get("compress_min_bytes",
+                                            mplane.utils.COMPRESS_MIN_BYTES))
+        self._default_result_url = urllib3.util.Url(scheme=self.url.scheme,
+                host=self.url.host, port=self.url.port, path=self.result_path)
+
+        # replies that cannot be delivered are kept on disk, if configured
+        ccfg = self.config["component"]
+        spool = None
+        if "spool_dir" in ccfg:
+            spool = mplane.spool.Spool(ccfg["spool_dir"],
+                    max_bytes=ccfg.getint("spool_max_bytes", mplane.spool.DEFAULT_MAX_BYTES),
+                    max_age=ccfg.getint("spool_max_age", mplane.spool.DEFAULT_MAX_AGE),
+                    sync=ccfg.getboolean("spool_sync", fallback=False))
+
+        # results are returned asynchronously, in batches; anything
+        # spooled by a previous run is replayed as soon as possible
+        self.uploader = ResultUploader(self.tls,
+                workers=ccfg.getint("upload_workers", DEFAULT_UPLOAD_WORKERS),
+                queue_size=ccfg.getint("upload_queue_size", DEFAULT_UPLOAD_QUEUE_SIZE),
+                batch_size=ccfg.getint("upload_batch_size", DEFAULT_UPLOAD_BATCH_SIZE),
+                retries=ccfg.getint("upload_retries", DEFAULT_UPLOAD_RETRIES),
+                spool=spool, compress_min_bytes=self._compress_min_bytes)
+
         self.register_to_client()
 
         # periodically poll the Client/Supervisor for Specifications
@@ -272,13 +665,16 @@ class InitiatorHttpComponent(BaseComponent):
         env = mplane.model.Envelope()
 
         connected = False
+        retry_delay = UPLOAD_BACKOFF_BASE
         while not connected:
             try:
                 self._client_identity = self.tls.extract_peer_identity(self.url)
                 connected = True
             except:
-                print("Client/Supervisor unreachable. Retrying connection in 5 seconds")
-                sleep(5)
+                retry_delay = min(retry_delay * 2, UPLOAD_BACKOFF_MAX)
+                print("Client/Supervisor unreachable. Retrying connection in " +
+                      str(retry_delay) + " seconds")
+                sleep(retry_delay)
 
         # If caps is not None, register that
         if caps is not None:
@@ -302,10 +698,20 @@ class InitiatorHttpComponent(BaseComponent):
             callback_cap = mplane.model.Capability(label="callback", when = "now ... future")
             env.append_message(callback_cap)
 
-        # send the envelope to the client
-        res = self.pool.urlopen('POST',self.registration_path,
-                    body=mplane.model.unparse_json(env).encode("utf-8"),
-                    headers={"content-type": "application/x-mplane+json"})
+        # send the envelope to the client, waiting while it is busy
+        headers = {"content-type": "application/x-mplane+json",
+                   "accept-encoding": "gzip"}
+        body = mplane.utils.compress_body(mplane.model.unparse_json(env).encode("utf-8"),
+                                          headers, self._compress_min_bytes)
+        while True:
+            res = self.pool.urlopen('POST', self.registration_path,
+                                    body=body, headers=headers)
+            if res.status != 503:
+                break
+            retry_after = float(res.headers.get("Retry-After", UPLOAD_BACKOFF_BASE))
+            print("Client/Supervisor busy. Retrying registration in " +
+                  str(retry_after) + " seconds")
+            sleep(retry_after)
 
         # handle response message
         if res.status == 200:
@@ -328,17 +734,40 @@ class InitiatorHttpComponent(BaseComponent):
         """
         while(True):
             # FIXME configurable default idle time.
-            self.idle_time = 5
+            self.idle_time = DEFAULT_IDLE_TIME
+            # with long-polling, poll again straight away unless a callback
+            # asks us to sleep, or the Client/Supervisor answered an empty
+            # request without holding it (i.e. it does not long-poll)
+            sleep_time = 0 if self.spec_wait > 0 else self.idle_time
+
             # send a request for specifications
-            res = self.pool.request('GET', self.specification_path)
+            started = time.monotonic()
+            try:
+                if self.spec_wait > 0:
+                    res = self.pool.request('GET', self.specification_path,
+                                            fields={"wait": str(self.spec_wait)},
+                                            headers={"accept-encoding": "gzip"},
+                                            timeout=self.spec_wait + self.idle_time)
+                else:
+                    res = self.pool.request('GET', self.specification_path,
+                                            headers={"accept-encoding": "gzip"})
+            except urllib3.exceptions.HTTPError as e:
+                print("Error polling Client/Supervisor for Specifications: " + repr(e))
+                sleep(self.idle_time)
+                continue
+
             if res.status == 200:
 
                 # specs retrieved: split them if there is more than one
                 env = mplane.model.parse_json(res.data.decode("utf-8"))
+                if (sleep_time == 0 and len(env) == 0 and
+                        time.monotonic() - started < self.spec_wait / 2):
+                    sleep_time = self.idle_time
                 for spec in env.messages():
                     # handle callbacks
                     if spec.get_label()  == "callback":
                         self.idle_time = spec.when().timer_delays()[1]
+                        sleep_time = self.idle_time
                         break
 
                     # hand spec to scheduler
@@ -346,17 +775,18 @@ class InitiatorHttpComponent(BaseComponent):
                     if not isinstance(spec, mplane.model.Interrupt):
                         self._result_url[spec.get_token()] = spec.get_link()
 
-                    # send receipt to the Client/Supervisor
-                    res = self.pool.urlopen('POST', self.result_path,
-                            body=mplane.model.unparse_json(reply).encode("utf-8"),
-                            headers={"content-type": "application/x-mplane+json"})
+                    # send receipt to the Client/Supervisor, ahead of
+                    # any result for it (spooled if it is unreachable)
+                    self.uploader.send(self._default_result_url, reply)
 
             # not registered on supervisor, need to re-register
             elif res.status == 428:
                 print("\nRe-registering capabilities on Client/Supervisor")
-                self.register_to_supervisor()
+                self.register_to_client()
+            else:
+                sleep_time = self.idle_time
 
-            sleep(self.idle_time)
+            sleep(sleep_time)
 
     def return_results(self, receipt):
         """
@@ -371,32 +801,173 @@ class InitiatorHttpComponent(BaseComponent):
             job.failed() is not True):
             return
 
-        result_url = urllib3.util.parse_url(self._result_url[reply.get_token()])
-        # send result to the Client/Supervisor
-        if result_url != "" and self.pool.is_same_host(mplane.utils.parse_url(result_url)):
-            res = self.pool.urlopen('POST', self.result_path,
-                    body=mplane.model.unparse_json(reply).encode("utf-8"),
-                    headers={"content-type": "application/x-mplane+json"})
+        # send result to the Client/Supervisor: to the link in the
+        # specification if it names another host, else to result_path
+        link = self._result_url.pop(reply.get_token(), "")
+        result_url = urllib3.util.parse_url(link) if link else None
+        if result_url is None or self.pool.is_same_host(mplane.utils.parse_url(result_url)):
+            result_url = self._default_result_url
+        self.uploader.submit(result_url, reply)
+
+class InitiatorWebSocketComponent(BaseComponent):
+    """
+    Component-initiated workflow over a single WebSocket to the
+    Client/Supervisor. Capabilities are registered when the connection
+    opens; specifications and interrupts are pushed by the peer as they
+    are issued, and receipts and results are sent back as soon as they
+    are available. The connection is reopened, with backoff, when lost.
+
+    """
+    def __init__(self, config, supervisor=False):
+        self._supervisor = supervisor
+        super(InitiatorWebSocketComponent, self).__init__(config)
+
+        if "TLS" not in self.config.sections():
+            (scheme, ws_scheme) = ("http", "ws")
         else:
-            pool = self.tls.pool_for(result_url.scheme, result_url.host, result_url.port)
-            res = pool.urlopen('POST', result_url.path,
-                    body=mplane.model.unparse_json(reply).encode("utf-8"),
-                    headers={"content-type": "application/x-mplane+json"})
-
-        # handle response
-        if isinstance(reply, mplane.model.Envelope):
-            for msg in reply.messages():
-                label = msg.get_label()
+            (scheme, ws_scheme) = ("https", "wss")
+
+        host = self.config["component"]["client_host"]
+
+        if "client_port" in config["component"]:
+            port = int(config["component"]["client_port"])
+        else:
+            port = DEFAULT_MPLANE_PORT
+
+        path = self.config["component"].get("websocket_path", DEFAULT_WEBSOCKET_PATH)
+        if not path.startswith("/"):
+            path = "/" + path
+
+        self.url = urllib3.util.url.Url(scheme=scheme, host=host, port=port)
+        self.ws_url = urllib3.util.url.Url(scheme=ws_scheme, host=host, port=port, path=path)
+
+        self._client_identity = None
+        self._conn = None
+        self._backlog = collections.deque(maxlen=WEBSOCKET_BACKLOG_SIZE)
+        self._io_loop = None
+        self._closing = False
+
+        print("Connecting to " + self.ws_url.url + "...")
+        t = Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        self._io_loop = tornado.ioloop.IOLoop()
+        self._io_loop.run_sync(self._connect)
+        self._io_loop.close()
+
+    def close(self):
+        """
+        Close the connection to the Client/Supervisor and stop
+        reconnecting.
+
+        """
+        self._closing = True
+        if self._io_loop is not None:
+            self._io_loop.add_callback(self._close_conn)
+
+    def _close_conn(self):
+        if self._conn is not None:
+            self._conn.close()
+
+    @tornado.gen.coroutine
+    def _connect(self):
+        retry_delay = UPLOAD_BACKOFF_BASE
+        while not self._closing:
+            # Tornado does not match the hostname against the certificate
+            request = tornado.httpclient.HTTPRequest(self.ws_url.url,
+                            ssl_options=self.tls.client_ssl_context(check_hostname=True))
+            try:
+                conn = yield tornado.websocket.websocket_connect(request)
+            except (IOError, tornado.httpclient.HTTPError) as e:
+                retry_delay = min(retry_delay * 2, UPLOAD_BACKOFF_MAX)
+                print("Client/Supervisor unreachable (" + repr(e) + "). "
+                      "Retrying connection in " + str(retry_delay) + " seconds")
+                yield tornado.gen.sleep(retry_delay)
+                continue
+
+            if self._closing:
+                conn.close()
                 break
+
+            stream = getattr(conn, "stream", None) or conn.protocol.stream
+            self._client_identity = self.tls.extract_peer_identity(stream.socket)
+            self._conn = conn
+            self.register_to_client()
+            while self._backlog and self._conn is not None:
+                self._write(self._backlog.popleft())
+
+            while True:
+                text = yield conn.read_message()
+                if text is None:
+                    break
+                retry_delay = UPLOAD_BACKOFF_BASE
+                self._handle_text(text)
+
+            self._conn = None
+            if self._closing:
+                break
+            print("Connection to Client/Supervisor lost, reconnecting in " +
+                  str(retry_delay) + " seconds")
+            yield tornado.gen.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, UPLOAD_BACKOFF_MAX)
+
+    def register_to_client(self, caps=None):
+        """
+        Sends a list of capabilities to the Client (by default, all
+        those authorized to it), in order to register them
+
+        """
+        env = mplane.model.Envelope()
+        if caps is None:
+            caps = [self.scheduler.capability_for_key(key)
+                    for key in self.scheduler.capability_keys()]
+        for cap in caps:
+            if self.scheduler.azn.check(cap, self._client_identity):
+                env.append_message(cap)
+
+        if len(env) == 0 and self._supervisor == False:
+            print("\nNo Capabilities are being exposed to " + self._client_identity + ", check permissions in config file.")
+        self._send(env)
+
+    def _handle_text(self, text):
+        try:
+            msg = mplane.model.parse_json(text)
+        except ValueError as e:
+            print("Invalid message from Client/Supervisor: " + repr(e))
+            return
+
+        if isinstance(msg, mplane.model.Envelope):
+            msgs = list(msg.messages())
         else:
-            if isinstance(reply, mplane.model.Exception):
-                print("Exception for " + reply.get_token() + " successfully returned!")
-                return
+            msgs = [msg]
+        for spec in msgs:
+            reply = self.scheduler.process_message(self._client_identity, spec,
+                                                   callback=self.return_results)
+            self._write(reply)
 
-            label = reply.get_label()
-        if res.status == 200:
-            print("Result for " + label + " successfully returned!")
+    def return_results(self, receipt):
+        """
+        Checks if a job is complete, and in case sends it to the Client/Supervisor
+
+        """
+        job = self.scheduler.job_for_message(receipt)
+        if job.finished() or job.failed():
+            self._send(job.get_reply())
+
+    def _send(self, msg):
+        # may be called from job threads: write from the IOLoop
+        if self._io_loop is None:
+            self._backlog.append(msg)
         else:
-            print("Error returning Result for " + label)
-            print("Client/Supervisor said: " + str(res.status) + " - " + res.data.decode("utf-8"))
-        pass
+            self._io_loop.add_callback(self._write, msg)
+
+    def _write(self, msg):
+        if self._conn is not None:
+            try:
+                self._conn.write_message(mplane.model.unparse_json(msg))
+                return
+            except tornado.websocket.WebSocketClosedError:
+                self._conn = None
+        self._backlog.append(msg)
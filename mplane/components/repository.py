@@ -0,0 +1,632 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Measurement repository component code
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Implements a measurement repository: a component which collects the
+results other components export to it (mplane-https indirect export),
+and answers queries over them.
+
+Collected results are kept in a columnar store on disk, one directory
+per schema hash and, below it, one per set of parameter values,
+partitioned by time, with one file per result column in each partition.
+Rows are appended in blocks sorted by time, which a time index
+(mplane.timeindex) locates by parameter values and temporal scope; a
+query reads only the blocks it needs, and only the columns it asks for,
+through memory maps.
+
+"""
+
+import array
+import hashlib
+import ipaddress
+import json
+import math
+import mmap
+import os
+import threading
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import mplane.model
+import mplane.scheduler
+import mplane.timeindex
+import mplane.utils
+import mplane.components.ping
+
+from mplane.timeindex import to_us, from_us
+
+TIME_COLUMN = "time"
+SCHEMA_FILE = "schema.json"
+KEY_FILE = "key.json"
+BLOCKS_FILE = "blocks"
+COLUMN_SUFFIX = ".col"
+DICT_SUFFIX = ".dict"
+PARTITION_FORMAT = "%Y%m%dT%H%M%S"
+
+DEFAULT_PARTITION_SECONDS = 3600
+
+# null values for fixed-width columns
+_NULL_INT = -2 ** 63
+_NULL_BOOL = -1
+
+# storage typecode by primitive; values of every other primitive
+# (strings, addresses, URLs) are stored as codes into a per-partition
+# dictionary of their string representations, with code 0 for None
+_typecodes = {"natural": "q", "time": "q", "real": "d", "boolean": "b"}
+_DICT_TYPECODE = "i"
+
+# predicate values selecting the addresses within a network
+_NETWORK_TYPES = (ipaddress.IPv4Network, ipaddress.IPv6Network)
+
+def _encoder(prim):
+    if prim.name == "time":
+        return lambda v: _NULL_INT if v is None else to_us(v)
+    elif prim.name == "natural":
+        return lambda v: _NULL_INT if v is None else int(v)
+    elif prim.name == "real":
+        return lambda v: math.nan if v is None else float(v)
+    elif prim.name == "boolean":
+        return lambda v: _NULL_BOOL if v is None else int(v)
+    else:
+        return prim.unparse
+
+def _decoder(prim):
+    if prim.name == "time":
+        return lambda v: None if v == _NULL_INT else from_us(v)
+    elif prim.name == "natural":
+        return lambda v: None if v == _NULL_INT else v
+    elif prim.name == "real":
+        return lambda v: None if math.isnan(v) else v
+    elif prim.name == "boolean":
+        return lambda v: None if v == _NULL_BOOL else bool(v)
+    else:
+        return prim.parse
+
+def _itemsize(primname):
+    return array.array(_typecodes.get(primname, _DICT_TYPECODE)).itemsize
+
+def _map_column(path, primname, rows):
+    """
+    Map the first rows values of a column file read-only. Returns a
+    numpy array if numpy is available, a memoryview otherwise. The
+    mapping is released when the returned object is.
+
+    """
+    typecode = _typecodes.get(primname, _DICT_TYPECODE)
+    if rows == 0:
+        return array.array(typecode)
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if numpy is not None:
+        return numpy.frombuffer(mm, dtype=numpy.dtype(typecode), count=rows)
+    return memoryview(mm)[:rows * _itemsize(primname)].cast(typecode)
+
+def _match_addresses(svals, network):
+    """
+    Return the indices of the address strings in svals (which may
+    contain VALUE_NONE) lying within the given network.
+
+    """
+    col = mplane.model.ResultColumn(mplane.model.Element("address",
+                                                         mplane.model.prim_address))
+    col._set_values(mplane.model.prim_address.parse_many(svals))
+    return col.match_network(network)
+
+class _Block(object):
+    """Location of a block of rows: partition directory, first row, row count."""
+    __slots__ = ("pdir", "first", "rows")
+
+    def __init__(self, pdir, first, rows):
+        self.pdir = pdir
+        self.first = first
+        self.rows = rows
+
+class ColumnarStore(object):
+    """
+    On-disk, time-partitioned columnar store of result rows.
+
+    Each schema (identified by the schema hash of the statements whose
+    results it holds) stores the statement's result columns, plus a time
+    column: the result's own time column if it has one, otherwise the
+    start of the result's temporal scope. Parameter values are not
+    stored per row: rows with the same parameter values share a
+    directory, and are found through the time index. append() may be
+    called from any thread, and query() concurrently with it.
+
+    """
+    def __init__(self, directory, partition_seconds=DEFAULT_PARTITION_SECONDS):
+        self._dir = directory
+        self._partition_us = int(partition_seconds * 1000000)
+        self._lock = threading.Lock()
+        self._index = mplane.timeindex.TimeIndex()
+
+        # {"parameters": {name: primitive name}, "results": {...}}, by schema hash
+        self._schemas = {}
+        # directory, by index key
+        self._keydirs = {}
+        # rows in each partition directory
+        self._rows = {}
+        # partition directories checked for rows written past the last block
+        self._checked = set()
+        # string -> code, by (partition directory, column name)
+        self._dicts = {}
+
+        os.makedirs(directory, exist_ok=True)
+        for schema in os.listdir(directory):
+            path = os.path.join(directory, schema, SCHEMA_FILE)
+            if os.path.exists(path):
+                with open(path) as f:
+                    self._schemas[schema] = json.load(f)
+                self._load_keys(schema)
+
+    def _load_keys(self, schema):
+        for name in os.listdir(os.path.join(self._dir, schema)):
+            keydir = os.path.join(self._dir, schema, name)
+            if not os.path.exists(os.path.join(keydir, KEY_FILE)):
+                continue
+            with open(os.path.join(keydir, KEY_FILE)) as f:
+                key = (schema, tuple(tuple(kv) for kv in json.load(f)))
+            self._keydirs[key] = keydir
+
+            # later records of a block supersede earlier ones
+            blocks = {}
+            try:
+                with open(os.path.join(keydir, BLOCKS_FILE)) as f:
+                    for line in f:
+                        try:
+                            (partition, first, rows, tmin, tmax) = json.loads(line)
+                        except ValueError:
+                            # torn last record
+                            break
+                        blocks[(partition, first)] = (rows, tmin, tmax)
+            except FileNotFoundError:
+                pass
+            for ((partition, first), (rows, tmin, tmax)) in sorted(blocks.items()):
+                pdir = os.path.join(keydir, partition)
+                self._index.add(key, tmin, tmax, _Block(pdir, first, rows))
+                self._rows[pdir] = max(self._rows.get(pdir, 0), first + rows)
+
+    def add_schema(self, statement):
+        """
+        Prepare the store to hold results with the schema of the given
+        statement. Returns the schema hash.
+
+        """
+        schema = statement._schema_hash()
+        params = {}
+        for name in statement.parameter_names():
+            params[name] = mplane.model.element(name).primitive_name()
+        results = {TIME_COLUMN: mplane.model.prim_time.name}
+        for name in statement.result_column_names():
+            results[name] = mplane.model.element(name).primitive_name()
+
+        with self._lock:
+            if schema not in self._schemas:
+                os.makedirs(os.path.join(self._dir, schema), exist_ok=True)
+                stored = {"parameters": params, "results": results}
+                with open(os.path.join(self._dir, schema, SCHEMA_FILE), "w") as f:
+                    json.dump(stored, f)
+                self._schemas[schema] = stored
+        return schema
+
+    def schemas(self):
+        """Return the schema hashes this store holds results for."""
+        return list(self._schemas.keys())
+
+    def columns(self, schema):
+        """Return the names of the parameters and columns stored for a schema."""
+        stored = self._schemas[schema]
+        return list(stored["parameters"].keys()) + list(stored["results"].keys())
+
+    def _keydir(self, key):
+        # must hold the lock
+        if key not in self._keydirs:
+            name = hashlib.md5(json.dumps(key[1]).encode("utf-8")).hexdigest()[:16]
+            keydir = os.path.join(self._dir, key[0], name)
+            os.makedirs(keydir, exist_ok=True)
+            with open(os.path.join(keydir, KEY_FILE), "w") as f:
+                json.dump(key[1], f)
+            self._keydirs[key] = keydir
+        return self._keydirs[key]
+
+    def _dict_for(self, pdir, column):
+        # must hold the lock
+        key = (pdir, column)
+        if key not in self._dicts:
+            codes = {}
+            try:
+                with open(os.path.join(pdir, column + DICT_SUFFIX)) as f:
+                    for line in f:
+                        codes[json.loads(line)] = len(codes) + 1
+            except FileNotFoundError:
+                pass
+            self._dicts[key] = codes
+        return self._dicts[key]
+
+    def _open_partition(self, pdir, results):
+        # must hold the lock; returns the number of rows in the partition,
+        # after cutting off any rows written past its last indexed block
+        rows = self._rows.get(pdir, 0)
+        if pdir not in self._checked:
+            os.makedirs(pdir, exist_ok=True)
+            for (name, primname) in results.items():
+                path = os.path.join(pdir, name + COLUMN_SUFFIX)
+                size = rows * _itemsize(primname)
+                if os.path.exists(path) and os.path.getsize(path) > size:
+                    print("Repository: discarding unindexed rows in " + path)
+                    os.truncate(path, size)
+            self._checked.add(pdir)
+        return rows
+
+    def append(self, result):
+        """
+        Append the rows of a result to the store. Raises KeyError if
+        the store does not hold results with the result's schema.
+        Returns the number of rows stored.
+
+        """
+        schema = result._schema_hash()
+        results = self._schemas[schema]["results"]
+        nrows = result.count_result_rows()
+        if nrows == 0:
+            return 0
+
+        params = {name: result.get_parameter_value(name)
+                  for name in result.parameter_names()}
+        key = mplane.timeindex.index_key(schema, params)
+
+        # values of each column, row by row
+        values = {}
+        for name in result.result_column_names():
+            col = list(result._resultcolumns[name])
+            values[name] = col + [None] * (nrows - len(col))
+        if TIME_COLUMN not in values or None in values[TIME_COLUMN]:
+            start = result.when().datetimes()[0]
+            values[TIME_COLUMN] = [start if t is None else t
+                                   for t in values.get(TIME_COLUMN, [None] * nrows)]
+        times = [to_us(t) for t in values[TIME_COLUMN]]
+
+        # write rows in time order, one block per partition
+        order = sorted(range(nrows), key=times.__getitem__)
+        with self._lock:
+            keydir = self._keydir(key)
+            i = 0
+            while i < nrows:
+                partition = times[order[i]] // self._partition_us
+                j = i
+                while j < nrows and times[order[j]] // self._partition_us == partition:
+                    j += 1
+                self._append_block(key, keydir, results, partition,
+                                   order[i:j], values, times)
+                i = j
+        return nrows
+
+    def _append_block(self, key, keydir, results, partition, rows, values, times):
+        # must hold the lock
+        pname = from_us(partition * self._partition_us).strftime(PARTITION_FORMAT)
+        pdir = os.path.join(keydir, pname)
+        first = self._open_partition(pdir, results)
+        for (name, primname) in results.items():
+            self._append_column(pdir, name, primname,
+                                [values[name][r] for r in rows])
+        self._rows[pdir] = first + len(rows)
+
+        # rows following on from the key's latest block extend it
+        (tmin, tmax) = (times[rows[0]], times[rows[-1]])
+        last = self._index.last(key)
+        if last is not None and last[2].pdir == pdir and \
+           last[2].first + last[2].rows == first and last[1] <= tmin:
+            block = last[2]
+            block.rows += len(rows)
+            self._index.grow(key, tmax)
+            tmin = last[0]
+        else:
+            block = _Block(pdir, first, len(rows))
+            self._index.add(key, tmin, tmax, block)
+
+        with open(os.path.join(keydir, BLOCKS_FILE), "a") as f:
+            f.write(json.dumps([pname, block.first, block.rows, tmin, tmax]) + "\n")
+
+    def _append_column(self, pdir, name, primname, vals):
+        # must hold the lock
+        prim = mplane.model._prim[primname]
+        typecode = _typecodes.get(primname)
+        if typecode is None:
+            typecode = _DICT_TYPECODE
+            codes = self._dict_for(pdir, name)
+            new = []
+            encoded = []
+            for sval in map(prim.unparse, vals):
+                if sval == mplane.model.VALUE_NONE:
+                    encoded.append(0)
+                    continue
+                if sval not in codes:
+                    codes[sval] = len(codes) + 1
+                    new.append(sval)
+                encoded.append(codes[sval])
+            if new:
+                # write the dictionary before any code referring to it
+                with open(os.path.join(pdir, name + DICT_SUFFIX), "a") as f:
+                    f.write("".join(json.dumps(s) + "\n" for s in new))
+        else:
+            encoded = list(map(_encoder(prim), vals))
+        with open(os.path.join(pdir, name + COLUMN_SUFFIX), "ab") as f:
+            f.write(array.array(typecode, encoded).tobytes())
+
+    def query(self, schema, start=None, end=None, columns=None, predicates=None):
+        """
+        Return the rows of a schema whose time lies between start and
+        end inclusive (either may be None for an open range) and whose
+        values equal those given in predicates (a dictionary of column
+        or parameter name to value), as a dictionary of column name to
+        list of values. The predicate value for an address column or
+        parameter may also be an ip_network, selecting the addresses
+        within it. Only the given columns (all by default) are
+        returned. Rows come in time order for each set of parameter
+        values.
+
+        """
+        stored = self._schemas[schema]
+        (params, results) = (stored["parameters"], stored["results"])
+        if columns is None:
+            columns = self.columns(schema)
+        predicates = predicates or {}
+        start_us = None if start is None else to_us(start)
+        end_us = None if end is None else to_us(end)
+
+        for (name, val) in predicates.items():
+            if isinstance(val, _NETWORK_TYPES) and \
+               params.get(name, results.get(name)) != "address":
+                raise ValueError("cannot match "+name+" against a network")
+
+        # parameter values select index keys; other predicates filter rows
+        key_preds = {k: v for (k, v) in predicates.items()
+                     if k in params and not isinstance(v, _NETWORK_TYPES)}
+        net_preds = {k: v for (k, v) in predicates.items()
+                     if k in params and isinstance(v, _NETWORK_TYPES)}
+        row_preds = {k: v for (k, v) in predicates.items() if k not in params}
+
+        # snapshot the blocks to read, and the dictionaries to read them with
+        with self._lock:
+            keys = list(self._index.keys(schema, key_preds))
+            for (name, net) in net_preds.items():
+                svals = [dict(key[1]).get(name, mplane.model.VALUE_NONE) for key in keys]
+                keys = [keys[i] for i in _match_addresses(svals, net)]
+            blocks = []
+            dicts = {}
+            for key in keys:
+                for (tmin, tmax, block) in self._index.blocks(key, start_us, end_us):
+                    blocks.append((key, tmin, tmax, block.pdir, block.first,
+                                   block.rows, self._rows[block.pdir]))
+                    for name in set(columns) | set(row_preds):
+                        if name in results and results[name] not in _typecodes:
+                            dicts[(block.pdir, name)] = dict(self._dict_for(block.pdir, name))
+
+        out = {name: [] for name in columns}
+        maps = {}
+        netcodes = {}
+        def mapped(pdir, name, prows):
+            if (pdir, name) not in maps:
+                maps[(pdir, name)] = _map_column(os.path.join(pdir, name + COLUMN_SUFFIX),
+                                                 results[name], prows)
+            return maps[(pdir, name)]
+
+        for (key, tmin, tmax, pdir, first, rows, prows) in blocks:
+            (lo, hi) = (first, first + rows)
+            if (start_us is not None and tmin < start_us) or \
+               (end_us is not None and tmax > end_us):
+                (lo, hi) = mplane.timeindex.find_rows(mapped(pdir, TIME_COLUMN, prows),
+                                                      start_us, end_us, lo, hi)
+            if lo >= hi:
+                continue
+
+            # row filters, as indices into [lo, hi)
+            select = None
+            for (name, val) in row_preds.items():
+                prim = mplane.model._prim[results[name]]
+                col = mapped(pdir, name, prows)[lo:hi]
+                if isinstance(val, _NETWORK_TYPES):
+                    # match the partition's distinct addresses, then their codes
+                    if (pdir, name) not in netcodes:
+                        codes = dicts[(pdir, name)]
+                        svals = sorted(codes, key=codes.get)
+                        netcodes[(pdir, name)] = [codes[svals[i]] for i in
+                                                  _match_addresses(svals, val)]
+                    codes = netcodes[(pdir, name)]
+                    if numpy is not None:
+                        hits = numpy.nonzero(numpy.isin(col, codes))[0]
+                    else:
+                        codes = set(codes)
+                        match = lambda v: v in codes
+                else:
+                    if results[name] in _typecodes:
+                        val = _encoder(prim)(val)
+                    else:
+                        val = dicts[(pdir, name)].get(prim.unparse(val))
+                    if numpy is not None:
+                        hits = numpy.nonzero(col == val)[0]
+                    else:
+                        match = lambda v: v == val
+                if numpy is not None:
+                    select = hits if select is None else numpy.intersect1d(select, hits)
+                else:
+                    candidates = range(hi - lo) if select is None else select
+                    select = [i for i in candidates if match(col[i])]
+            count = hi - lo if select is None else len(select)
+            if count == 0:
+                continue
+
+            for name in columns:
+                if name in params:
+                    prim = mplane.model._prim[params[name]]
+                    out[name].extend([prim.parse(dict(key[1])[name])] * count)
+                    continue
+                prim = mplane.model._prim[results[name]]
+                col = mapped(pdir, name, prows)[lo:hi]
+                if select is None:
+                    vals = col.tolist()
+                elif numpy is not None:
+                    vals = col[select].tolist()
+                else:
+                    vals = [col[i] for i in select]
+                if results[name] in _typecodes:
+                    out[name].extend(map(_decoder(prim), vals))
+                else:
+                    strings = [None] * (len(dicts[(pdir, name)]) + 1)
+                    for (sval, code) in dicts[(pdir, name)].items():
+                        strings[code] = prim.parse(sval)
+                    out[name].extend(strings[code] for code in vals)
+        return out
+
+def _templates(schemas=None):
+    """
+    Return capabilities with the schemas of the results this repository
+    collects: those in the JSON file schemas (a capability, or an
+    envelope of capabilities, e.g. as advertised by the probes which
+    export to it), or by default the ping schemas.
+
+    """
+    if schemas is None:
+        allvals = mplane.model.constraint_all
+        return [mplane.components.ping.ping4_aggregate_capability(allvals),
+                mplane.components.ping.ping4_singleton_capability(allvals),
+                mplane.components.ping.ping6_aggregate_capability(allvals),
+                mplane.components.ping.ping6_singleton_capability(allvals)]
+
+    with open(mplane.utils.search_path(schemas)) as f:
+        msg = mplane.model.parse_json(f.read())
+    if isinstance(msg, mplane.model.Envelope):
+        templates = list(msg.messages())
+    else:
+        templates = [msg]
+    for template in templates:
+        if not isinstance(template, mplane.model.Capability):
+            raise ValueError("Repository schemas must be capabilities, got " +
+                             repr(template))
+        if template.get_label() is None:
+            raise ValueError("Repository schema " + repr(template) +
+                             " needs a label")
+    return templates
+
+def collect_capability(template, export):
+    """
+    Build a capability advertising that this repository collects results
+    with the schema of the template, exported to the given URL.
+
+    """
+    cap = mplane.model.Capability(label=template.get_label() + "-collect",
+                                  verb=mplane.model.VERB_COLLECT,
+                                  when="now ... future")
+    for name in template.parameter_names():
+        cap.add_parameter(name)
+    for name in template.result_column_names():
+        cap.add_result_column(name)
+    cap.set_export(export)
+    return cap
+
+def query_capability(template):
+    """
+    Build a capability for querying stored results with the schema of
+    the template. The query's parameter values select rows; a time
+    column is always returned.
+
+    """
+    cap = mplane.model.Capability(label=template.get_label() + "-query",
+                                  verb=mplane.model.VERB_QUERY,
+                                  when="past ... now")
+    for name in template.parameter_names():
+        cap.add_parameter(name)
+    if not template.has_result_column(TIME_COLUMN):
+        cap.add_result_column(TIME_COLUMN)
+    for name in template.result_column_names():
+        cap.add_result_column(name)
+    return cap
+
+def services(directory, export, partition_seconds=None, schemas=None):
+    store = ColumnarStore(directory, int(partition_seconds or DEFAULT_PARTITION_SECONDS))
+    services = []
+    for template in _templates(schemas):
+        collector = CollectService(collect_capability(template, export), store)
+        services.append(collector)
+        services.append(QueryService(query_capability(template), store,
+                                     collector.schema()))
+    return services
+
+class CollectService(mplane.scheduler.Service):
+    """
+    Stores results with the schema of its capability as they arrive.
+    The scheduler hands every result exported to this component to the
+    collect() method of the service with the result's schema.
+
+    """
+    def __init__(self, cap, store):
+        super(CollectService, self).__init__(cap)
+        self._store = store
+        self._schema = store.add_schema(cap)
+
+    def schema(self):
+        """Returns the schema hash of the results this service stores."""
+        return self._schema
+
+    def collect(self, result):
+        """Store the rows of a result; returns the number of rows stored."""
+        return self._store.append(result)
+
+    def run(self, spec, check_interrupt):
+        # results arrive by export, not as the result of a specification;
+        # acknowledge collect specifications with an empty result
+        return mplane.model.Result(specification=spec)
+
+class QueryService(mplane.scheduler.Service):
+    """
+    Answers query specifications from a ColumnarStore: returns the stored
+    rows within the specification's temporal scope whose parameters have
+    the specification's parameter values.
+
+    """
+    def __init__(self, cap, store, schema):
+        super(QueryService, self).__init__(cap)
+        self._store = store
+        self._schema = schema
+
+    def run(self, spec, check_interrupt):
+        (start, end) = spec.when().datetimes()
+        columns = list(spec.result_column_names())
+        params = {name: spec.get_parameter_value(name)
+                  for name in spec.parameter_names()}
+        values = self._store.query(self._schema, start, end,
+                                   columns=columns, predicates=params)
+
+        res = mplane.model.Result(specification=spec)
+        times = values[TIME_COLUMN]
+        if len(times):
+            res.set_when(mplane.model.When(a=min(times), b=max(times)), force=True)
+        else:
+            res.set_when(mplane.model.When(a=start or from_us(0), b=end or datetime.utcnow()),
+                         force=True)
+        for name in columns:
+            res._resultcolumns[name]._set_values(values[name])
+        return res
@@ -0,0 +1,234 @@
+# mPlane Protocol Reference Implementation
+# Indirect export of results
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Indirect export of results to collectors.
+
+A specification with an export section asks the component to send its
+results to a collector using the protocol named by the export URL's
+scheme, and to return only a receipt. Exporters for each protocol are
+registered here by scheme; the scheduler asks exporter_for() for the
+exporter matching a specification's export URL, and hands it every
+result the specification produces.
+
+"""
+
+import collections
+import gzip
+import queue
+import threading
+import time
+
+import urllib3
+
+import mplane.model
+
+EXPORT_SCHEME_MPLANE_HTTPS = "mplane-https"
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# exporter classes by export scheme
+_exporter_classes = {}
+
+# exporter instances by export URL
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+def register_exporter(scheme, cls):
+    """
+    Register an Exporter subclass for an export scheme. cls is called
+    with the export URL, the component's TlsState, and any options
+    given to exporter_for().
+
+    """
+    _exporter_classes[scheme] = cls
+
+def exporter_for(export, tls_state=None, **options):
+    """
+    Return the exporter for an export URL, creating it on first use.
+    Exporters are shared by all specifications exporting to the same
+    URL. Raises ValueError if no exporter handles the URL's scheme.
+
+    """
+    with _exporters_lock:
+        if export not in _exporters:
+            scheme = mplane.model.export_scheme(export)
+            if scheme not in _exporter_classes:
+                raise ValueError("Unsupported export scheme "+str(scheme))
+            _exporters[export] = _exporter_classes[scheme](export, tls_state, **options)
+        return _exporters[export]
+
+def export_schemes():
+    """Return the export schemes this component can export with."""
+    return list(_exporter_classes.keys())
+
+class Exporter(object):
+    """
+    Abstract exporter. Subclasses implement export(), and may
+    override flush() and close().
+
+    """
+    def __init__(self, export, tls_state=None):
+        self._export = export
+        self._tls = tls_state
+
+    def export(self, msg):
+        """
+        Export a result (or an envelope of results). May return before
+        the result has been delivered.
+
+        """
+        raise NotImplementedError("Cannot instantiate an abstract Exporter")
+
+    def flush(self):
+        """Wait until every result exported so far has been handled."""
+        pass
+
+    def close(self):
+        """Flush and release any resources held by this exporter."""
+        self.flush()
+
+    def __repr__(self):
+        return "<"+self.__class__.__name__+" to "+self._export+">"
+
+class HttpsExporter(Exporter):
+    """
+    Exports results by POSTing mPlane result messages to the collector
+    (mplane-https export). Results are queued and sent from a
+    background thread, in envelopes of up to batch_size results or
+    whatever arrived within flush_interval seconds, gzip-compressed,
+    and retried with exponential backoff on connection errors and 5xx
+    responses.
+
+    """
+    def __init__(self, export, tls_state=None,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 retries=DEFAULT_RETRIES, compress=True):
+        super().__init__(export, tls_state)
+        if tls_state is None:
+            raise ValueError("mplane-https export needs TLS state")
+        url = urllib3.util.parse_url(export)
+        if not url.host:
+            raise ValueError("mplane-https export needs a collector URL, got "+export)
+        self._url = url._replace(scheme="https")
+
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval
+        self._retries = retries
+        self._compress = compress
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+
+        t = threading.Thread(target=self._work, name="export-"+str(url.host))
+        t.daemon = True
+        t.start()
+
+    def export(self, msg):
+        # a full queue blocks the job producing results
+        self._queue.put(msg)
+        self._count("exported")
+
+    def flush(self):
+        self._queue.join()
+
+    def stats(self):
+        """
+        Return a dictionary of counters: results exported, delivered,
+        and dropped; batches, bytes and retries sent; and queue depth.
+
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self._post(batch)
+            except Exception as e:
+                print("Error exporting to " + self._export + ": " + repr(e))
+                self._count("dropped", len(batch))
+            for i in range(len(batch)):
+                self._queue.task_done()
+
+    def _post(self, batch):
+        if len(batch) == 1:
+            msg = batch[0]
+        else:
+            msg = mplane.model.Envelope()
+            for result in batch:
+                msg.append_message(result)
+        body = mplane.model.unparse_json(msg).encode("utf-8")
+        headers = {"content-type": "application/x-mplane+json"}
+        if self._compress:
+            body = gzip.compress(body)
+            headers["content-encoding"] = "gzip"
+
+        for attempt in range(self._retries + 1):
+            if attempt > 0:
+                self._count("retries")
+                time.sleep(min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX))
+            # the pool may have been replaced while we were backing off
+            pool = self._tls.pool_for(self._url.scheme, self._url.host, self._url.port)
+            try:
+                res = pool.urlopen('POST', self._url.path or "/", body=body,
+                                   headers=headers)
+            except urllib3.exceptions.HTTPError as e:
+                print("Collector " + self._export + " unreachable (" + repr(e) + ")")
+                continue
+
+            if res.status == 200:
+                self._count("delivered", len(batch))
+                self._count("batches")
+                self._count("bytes", len(body))
+                return
+            print("Collector " + self._export + " said: " + str(res.status) +
+                  " - " + res.data.decode("utf-8"))
+            if res.status < 500:
+                break
+
+        print("Dropping " + str(len(batch)) + " results for " + self._export)
+        self._count("dropped", len(batch))
+
+register_exporter(EXPORT_SCHEME_MPLANE_HTTPS, HttpsExporter)
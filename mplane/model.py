@@ -309,18 +309,28 @@ The client receives the Envelope and decomposes the encapsulated messages:
 """
 
 try:
-    from ipaddress import ip_address
+    from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address
 except ImportError:
     from ipaddr import IPAddress as ip_address
+    from ipaddr import IPNetwork as ip_network
+    from ipaddr import IPv4Address, IPv6Address
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from datetime import datetime, timedelta, timezone
 from copy import copy, deepcopy
 import urllib.request
+import urllib.error
 import urllib.parse
 import collections
+import array
 import functools
 import operator
 import hashlib
+import pickle
 import json
 import yaml
 import re
@@ -351,6 +361,10 @@ TIME_FUTURE = "future"
 #FIX ME
 MAX_TIME = 100000
 
+# Number of distinct addresses to keep interned
+ADDRESS_INTERN_SIZE = 4096
+_UINT64_MASK = 2 ** 64 - 1
+
 WHEN_REPEAT = "repeat "
 WHEN_CRON = " cron "
 
@@ -470,6 +484,23 @@ def parse_time(valstr):
         else:
             raise ValueError(repr(valstr)+" does not appear to be an mPlane timestamp")
 
+_iso8601_full_re = re.compile('(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?$')
+
+def _parse_time_fast(valstr):
+    """
+    Parse a timestamp in the full format produced by unparse_time()
+    without going through strptime(); falls back to parse_time()
+    for everything else.
+
+    """
+    m = _iso8601_full_re.match(valstr)
+    if m:
+        y, mo, d, h, mi, s, us = m.groups()
+        return datetime(int(y), int(mo), int(d), int(h), int(mi), int(s),
+                        int(us.ljust(6, "0")) if us else 0)
+    else:
+        return parse_time(valstr)
+
 def unparse_time(valts, precision="us"):
     if isinstance(valts, datetime):
         return valts.strftime(_iso8601_fmt[precision])
@@ -577,6 +608,9 @@ def _unparse_wdayset(valset):
 
 
 class _Crontab(object):
+    __slots__ = ("_months", "_days", "_weekdays", "_hours", "_minutes",
+                 "_seconds")
+
     def __init__(self):
         super().__init__()
         self._months = set()
@@ -625,6 +659,9 @@ class When(object):
     single measurement specifications.
 
     """
+    __slots__ = ("_a", "_b", "_duration", "_period", "_repeated",
+                 "_inner_duration", "_inner_period", "_crontab")
+
     def __init__(self, valstr=None, a=None, b=None, duration=None, period=None,
                  repeated=False, inner_duration=None, inner_period=None, crontab=None):
         super().__init__()
@@ -1293,6 +1330,25 @@ class _Primitive(object):
         else:
             return str(val)
 
+    def parse_many(self, svals):
+        """
+        Converts a sequence of strings to a list of values, as by
+        parse(). Used to convert whole result columns at once.
+
+        """
+        return [None if sval == VALUE_NONE else sval for sval in svals]
+
+    def unparse_many(self, vals):
+        """
+        Converts a sequence of values to a list of strings, as by
+        unparse(). Used to convert whole result columns at once.
+
+        """
+        if None in vals:
+            return [VALUE_NONE if val is None else str(val) for val in vals]
+        else:
+            return list(map(str, vals))
+
 class _StringPrimitive(_Primitive):
     """
     Represents a string. Uses the default implementation.
@@ -1329,6 +1385,33 @@ class _NaturalPrimitive(_Primitive):
             # also converts values like 100.0 or 10E2
             return int(float(sval))
 
+    def parse_many(self, svals):
+        """Convert a sequence of strings to a list of natural values."""
+        if None not in svals and VALUE_NONE not in svals:
+            if numpy is not None:
+                try:
+                    vals = numpy.asarray(svals, dtype=numpy.float64)
+                except (ValueError, TypeError):
+                    vals = None
+                # astype() wraps values outside int64 (e.g. 64-bit
+                # counters) without raising, so range-check first
+                if vals is not None and \
+                        numpy.all(numpy.abs(vals) < 2.0 ** 63):
+                    return vals.astype(numpy.int64).tolist()
+            return [int(float(sval)) for sval in svals]
+        return [None if sval is None or sval == VALUE_NONE
+                else int(float(sval)) for sval in svals]
+
+    def unparse_many(self, vals):
+        """Convert a sequence of natural values to a list of strings."""
+        if numpy is not None and len(vals) and None not in vals:
+            try:
+                return numpy.asarray(vals, dtype=numpy.int64)\
+                            .astype(str).tolist()
+            except (ValueError, TypeError, OverflowError):
+                pass
+        return super().unparse_many(vals)
+
 class _RealPrimitive(_Primitive):
     """
     Represents a real number (floating point).
@@ -1351,6 +1434,18 @@ class _RealPrimitive(_Primitive):
         else:
             return float(sval)
 
+    def parse_many(self, svals):
+        """Convert a sequence of strings to a list of floating point values."""
+        if None not in svals and VALUE_NONE not in svals:
+            if numpy is not None:
+                try:
+                    return numpy.asarray(svals, dtype=numpy.float64).tolist()
+                except (ValueError, TypeError):
+                    pass
+            return list(map(float, svals))
+        return [None if sval is None or sval == VALUE_NONE
+                else float(sval) for sval in svals]
+
 class _BooleanPrimitive(_Primitive):
     """
     Represents a real number (floating point).
@@ -1384,6 +1479,17 @@ class _BooleanPrimitive(_Primitive):
         else:
             raise ValueError("Invalid boolean value "+sval)
 
+    def parse_many(self, svals):
+        """Convert a sequence of strings to a list of boolean values."""
+        try:
+            return [_bool_values[sval] for sval in svals]
+        except KeyError as e:
+            raise ValueError("Invalid boolean value "+str(e.args[0]))
+
+_bool_values = { None: None, VALUE_NONE: None,
+                 'True': True, 'False': False, '1': True, '0': False,
+                 True: True, False: False }
+
 class _AddressPrimitive(_Primitive):
     """
     Represents a IPv4 or IPv6 host or network address.
@@ -1399,11 +1505,50 @@ class _AddressPrimitive(_Primitive):
         return "mplane.model.prim_address"
 
     def parse(self, sval):
-        """Convert a string to an address value."""
+        """
+        Convert a string to an address value. Frequently seen
+        addresses are interned, so repeated parsing of the same
+        address returns the same object.
+
+        """
         if sval is None or sval == VALUE_NONE:
             return None
         else:
-            return ip_address(sval)
+            return _intern_address(sval)
+
+    def parse_many(self, svals):
+        """Convert a sequence of strings to a list of address values."""
+        intern = _intern_address
+        return [None if sval is None or sval == VALUE_NONE
+                else intern(sval) for sval in svals]
+
+    def unparse_many(self, vals):
+        """
+        Convert a sequence of address values to a list of strings;
+        for address columns, each distinct address is converted once.
+
+        """
+        if isinstance(vals, _AddressVector):
+            strs = {None: VALUE_NONE}
+            out = []
+            for val in vals:
+                try:
+                    out.append(strs[val])
+                except KeyError:
+                    strs[val] = str(val)
+                    out.append(strs[val])
+            return out
+        return super().unparse_many(vals)
+
+@functools.lru_cache(maxsize=ADDRESS_INTERN_SIZE)
+def _intern_address(sval):
+    return ip_address(sval)
+
+@functools.lru_cache(maxsize=ADDRESS_INTERN_SIZE)
+def _address_from_int(version, n):
+    if version == 4:
+        return IPv4Address(n)
+    return IPv6Address(n)
 
 class _URLPrimitive(_Primitive):
     """
@@ -1435,6 +1580,26 @@ class _TimePrimitive(_Primitive):
     def unparse(self, val):
         return unparse_time(val)
 
+    def parse_many(self, svals):
+        """Convert a sequence of strings to a list of timestamps."""
+        # numpy accepts more formats than parse_time() does, and reads
+        # them differently; only hand it timestamps in the full format
+        full = _iso8601_full_re.match
+        if numpy is not None and len(svals) and \
+           all(sval.__class__ is str and full(sval) for sval in svals):
+            try:
+                return numpy.asarray(svals, dtype="datetime64[us]").tolist()
+            except (ValueError, TypeError):
+                pass
+        return [_parse_time_fast(sval) if sval.__class__ is str
+                else sval for sval in svals]
+
+    def unparse_many(self, vals):
+        """Convert a sequence of timestamps to a list of strings."""
+        return [val.isoformat(" ", "microseconds")
+                if val.__class__ is datetime and val.tzinfo is None
+                else unparse_time(val) for val in vals]
+
 prim_string = _StringPrimitive()
 prim_natural = _NaturalPrimitive()
 prim_real = _RealPrimitive()
@@ -1467,6 +1632,8 @@ def test_primitives():
     assert prim_address.unparse(ip_address("10.0.27.101")) == '10.0.27.101'
     assert prim_address.parse("2001:db8:1:33::c0:ffee") == \
            ip_address('2001:db8:1:33::c0:ffee')
+    assert prim_address.parse("10.0.27.101") is \
+           prim_address.parse("10.0.27.101")
     assert prim_address.unparse(ip_address("2001:db8:1:33::c0:ffee")) == \
            '2001:db8:1:33::c0:ffee'
     assert prim_time.parse("2013-07-30 23:19:42") == \
@@ -1480,6 +1647,46 @@ def test_primitives():
     assert prim_time.unparse(time_past) == "past"
     assert prim_time.unparse(time_future) == "future"
 
+def test_primitives_many():
+    global numpy
+    saved_numpy = numpy
+    # check both the numpy and the pure-python conversion paths
+    for numpy in set([saved_numpy, None]):
+        assert prim_string.parse_many(["foo", "*"]) == ["foo", None]
+        assert prim_string.unparse_many(["foo", None]) == ["foo", "*"]
+        assert prim_natural.parse_many(["42", "100.0", "1e3"]) == [42, 100, 1000]
+        assert prim_natural.parse_many(["42", "*"]) == [42, None]
+        assert prim_natural.parse_many(["18446744073709551615", "1"]) == \
+               [prim_natural.parse("18446744073709551615"), 1]
+        assert prim_natural.unparse_many([27, 28]) == ["27", "28"]
+        assert prim_natural.unparse_many([27, None]) == ["27", "*"]
+        assert prim_real.parse_many(["4.2e6", "0.5"]) == [4200000.0, 0.5]
+        assert prim_real.parse_many(["*", "0.5"]) == [None, 0.5]
+        assert prim_boolean.parse_many(["True", "0", "*"]) == [True, False, None]
+        assert prim_boolean.unparse_many([True, None]) == ["True", "*"]
+        assert prim_address.parse_many(["10.0.27.101", "*"]) == \
+               [ip_address('10.0.27.101'), None]
+        assert prim_time.parse_many(["2013-07-30 23:19:42",
+                                     "2013-07-30 23:19:42.5",
+                                     "2013-07-30"]) == \
+               [datetime(2013, 7, 30, 23, 19, 42),
+                datetime(2013, 7, 30, 23, 19, 42, 500000),
+                datetime(2013, 7, 30)]
+        assert prim_time.parse_many(["now", "2013-07-30 23:19:42"]) == \
+               [time_now, datetime(2013, 7, 30, 23, 19, 42)]
+        for sval in ("2015-01-01T10:00:00", "2015-01-01 10:00:00.5+01:00"):
+            assert prim_time.parse_many([sval, "2013-07-30 23:19:42"]) == \
+                   [prim_time.parse(sval), datetime(2013, 7, 30, 23, 19, 42)]
+        for sval in ("NaT", "2015", "2015-01", "today"):
+            try:
+                prim_time.parse_many([sval])
+                assert False, sval
+            except ValueError:
+                pass
+        assert prim_time.unparse_many([datetime(2013, 7, 30, 23, 19, 42), time_now]) == \
+               ["2013-07-30 23:19:42.000000", "now"]
+    numpy = saved_numpy
+
 #######################################################################
 # Elements and registries
 #######################################################################
@@ -1498,6 +1705,8 @@ class Element(object):
     elements; use initialize_registry() to use these.
 
     """
+    __slots__ = ("_name", "_prim", "_desc", "_qualname")
+
     def __init__(self, name, prim, desc=None, namespace=REGURI_DEFAULT):
         super().__init__()
         self._name = name
@@ -1608,54 +1817,112 @@ class Registry(object):
         if d[KEY_REGFMT] != REGFMT_FLAT:
             raise ValueError("Unsupported registry format "+str(d[KEY_REGFMT]))
 
+        # reduce the registry to plain tuples, which can be
+        # stored in a snapshot, then load it from those
+        compiled = collections.OrderedDict()
+        compiled[KEY_REGREV] = int(d[KEY_REGREV])
+        compiled[KEY_REGURI] = d[KEY_REGURI]
+        compiled[KEY_REGINCLUDE] = list(d.get(KEY_REGINCLUDE, []))
+        compiled[KEY_ELEMENTS] = [(elem[KEY_ELEMNAME],
+                                   elem[KEY_ELEMPRIM],
+                                   elem.get(KEY_ELEMDESC, None))
+                                  for elem in d[KEY_ELEMENTS]]
+        self._load_compiled(compiled)
+        return compiled
+
+    def _load_compiled(self, compiled):
         # stash revision
-        self._revision = int(d[KEY_REGREV])
+        self._revision = compiled[KEY_REGREV]
 
         # get namespace, store it and check for loops
-        self._uri = d[KEY_REGURI]
+        self._uri = compiled[KEY_REGURI]
 
         if self._uri in self._namespaces:
             raise ValueError("Registry include loop at "+self._uri)
         self._namespaces.add(self._uri)
 
         # now parse includes depth-first
-        if KEY_REGINCLUDE in d:
-            for incuri in d[KEY_REGINCLUDE]:
-                self._include_registry(registry_for_uri(incuri))
+        for incuri in compiled[KEY_REGINCLUDE]:
+            self._include_registry(registry_for_uri(incuri))
 
         # finally, iterate over elements and add them to the table
-        for elem in d[KEY_ELEMENTS]:
-            name = elem[KEY_ELEMNAME]
-            prim = _prim[elem[KEY_ELEMPRIM]]
-            if KEY_ELEMDESC in elem:
-                desc = elem[KEY_ELEMDESC]
-            else:
-                desc = None
+        for (name, primname, desc) in compiled[KEY_ELEMENTS]:
             # Add the element in the subordinate in the parent namespace --
             # FIXME probably want to check to make sure this is the right
             # thing to do
-            self._add_element(Element(name, prim, desc, self._uri))
+            self._add_element(Element(name, _prim[primname], desc, self._uri))
 
     def _parse_from_file(self, filename=None):
         if filename is None:
             filename = os.path.join(os.path.dirname(__file__), "registry.json")
+        key = os.path.abspath(filename)
+
+        try:
+            st = os.stat(key)
+            validator = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            validator = None
+
+        snapshot = _load_registry_snapshot(key)
+        if snapshot is not None and \
+           (snapshot["validator"] == validator or
+            (validator is None and _registry_offline)):
+            self._load_compiled(snapshot["registry"])
+            return
+
         with open(filename, "r") as stream:
-            self._parse_json_bytestream(stream)
+            compiled = self._parse_json_bytestream(stream)
+        _store_registry_snapshot(key, validator, compiled)
+
+    def _parse_from_url(self, uri):
+        snapshot = _load_registry_snapshot(uri)
+        if snapshot is not None and _registry_offline:
+            self._load_compiled(snapshot["registry"])
+            return
+
+        # revalidate the snapshot, if any, with a conditional GET
+        req = urllib.request.Request(uri)
+        if snapshot is not None:
+            (etag, modified) = snapshot["validator"]
+            if etag is not None:
+                req.add_header("If-None-Match", etag)
+            if modified is not None:
+                req.add_header("If-Modified-Since", modified)
+
+        try:
+            with urllib.request.urlopen(req) as stream:
+                compiled = self._parse_json_bytestream(stream)
+                validator = (stream.headers.get("ETag"),
+                             stream.headers.get("Last-Modified"))
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and snapshot is not None:
+                self._load_compiled(snapshot["registry"])
+                return
+            raise
+        except urllib.error.URLError as e:
+            if snapshot is not None:
+                print("Registry "+uri+" unreachable ("+str(e.reason)+
+                      "), using cached snapshot")
+                self._load_compiled(snapshot["registry"])
+                return
+            raise
+
+        _store_registry_snapshot(uri, validator, compiled)
 
     def _parse_from_uri(self, uri):
         if uri == REGURI_DEFAULT:
-            with open(os.path.join(os.path.dirname(__file__), "registry.json"), "r") as stream:
-                self._parse_json_bytestream(stream)
+            self._parse_from_file()
         else:
             # normalize path if is a file or if no scheme is given
             # (we assume that is is a file)
-            scheme = urllib.parse.urlparse(uri).scheme
-            if scheme == "file" or scheme == "":
-                uri = "file://" + normalize_path(uri)
-
+            parsed = urllib.parse.urlparse(uri)
             try:
-                with urllib.request.urlopen(uri) as stream:
-                    self._parse_json_bytestream(stream)
+                if parsed.scheme == "file":
+                    self._parse_from_file(urllib.request.url2pathname(parsed.path))
+                elif parsed.scheme == "":
+                    self._parse_from_file(normalize_path(uri))
+                else:
+                    self._parse_from_url(uri)
             except:
                 raise ValueError("Invalid Registry uri: " + uri)
 
@@ -1685,11 +1952,98 @@ class Registry(object):
 
 _base_registry = None
 _registries = collections.OrderedDict()
+_element_index = None
+
+_registry_cache_dir = None
+_registry_offline = False
+
+REGISTRY_SNAPSHOT_FORMAT = 1
+
+def set_registry_cache(directory, offline=False):
+    """
+    Enables the compiled registry cache in the given directory.
+    Parsed registries are stored there as snapshots, and reused as
+    long as the source file is unchanged (by mtime and size) or the
+    registry URL answers a conditional GET with 304 Not Modified.
+
+    In offline mode, a cached snapshot is used without trying to
+    revalidate it. Without offline mode, a snapshot is still used
+    (with a warning) when the registry URL is unreachable.
+
+    Call this before preloading or initializing registries.
+
+    """
+    global _registry_cache_dir
+    global _registry_offline
+    _registry_cache_dir = directory
+    _registry_offline = offline
+
+def _registry_snapshot_path(key):
+    return os.path.join(_registry_cache_dir,
+                        hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle")
+
+def _load_registry_snapshot(key):
+    if _registry_cache_dir is None:
+        return None
+    try:
+        with open(_registry_snapshot_path(key), "rb") as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError,
+            AttributeError, pickle.UnpicklingError):
+        return None
+    if not isinstance(snapshot, dict) or \
+       snapshot.get("format") != REGISTRY_SNAPSHOT_FORMAT or \
+       snapshot.get("key") != key:
+        return None
+    return snapshot
+
+def _store_registry_snapshot(key, validator, compiled):
+    if _registry_cache_dir is None:
+        return
+    snapshot = { "format": REGISTRY_SNAPSHOT_FORMAT,
+                 "key": key,
+                 "revision": compiled[KEY_REGREV],
+                 "validator": validator,
+                 "registry": compiled }
+    path = _registry_snapshot_path(key)
+    tmppath = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(_registry_cache_dir, exist_ok=True)
+        with open(tmppath, "wb") as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+    except OSError as e:
+        print("Cannot store registry snapshot for "+key+": "+str(e))
+
+def _invalidate_element_index():
+    global _element_index
+    _element_index = None
+
+def _build_element_index():
+    """
+    Builds the merged element index. Plain names map to the Element
+    found first in the loaded registries (in load order, then the base
+    registry); (name, registry URI) pairs map to the Element as defined
+    by that registry, under both the URI it was loaded from and the URI
+    it declares.
+
+    """
+    index = {}
+    for (reguri, reg) in _registries.items():
+        for (name, elem) in reg._elements.items():
+            index.setdefault(name, elem)
+            index.setdefault((name, reguri), elem)
+            index.setdefault((name, reg._uri), elem)
+    if _base_registry is not None:
+        for (name, elem) in _base_registry._elements.items():
+            index.setdefault(name, elem)
+    return index
 
 def preload_registry(filename=None):
     global _registries
     preloaded = Registry(filename=filename)
     _registries[preloaded.uri()] = preloaded
+    _invalidate_element_index()
 
 def registry_for_uri(uri):
     """
@@ -1701,6 +2055,7 @@ def registry_for_uri(uri):
 
     if uri not in _registries:
         _registries[uri] = Registry(uri=uri)
+        _invalidate_element_index()
 
     return _registries[uri]
 
@@ -1714,21 +2069,28 @@ def initialize_registry(uri=REGURI_DEFAULT):
     """
     global _base_registry
     _base_registry = registry_for_uri(uri)
+    _invalidate_element_index()
 
 def element(name, reguri=None):
     """
     Returns the Element with the given name.
-    If reguri is given, searches the speficied Registry,
-    otherwise searches the base Registry.
+    If reguri is given and names a loaded Registry defining the
+    element, returns that Registry's definition; otherwise returns
+    the first definition found in the loaded registries.
     """
-    global _base_registry
-    global _registries
+    global _element_index
 
-    for reg in _registries:
-        if _registries[reg][name] != None:
-            return _registries[reg][name]
-    if _base_registry[name] != None:
-        return _base_registry[name]
+    index = _element_index
+    if index is None:
+        index = _element_index = _build_element_index()
+
+    if reguri is not None:
+        elem = index.get((name, reguri))
+        if elem is not None:
+            return elem
+    elem = index.get(name)
+    if elem is not None:
+        return elem
 
     # fall-through: no results
     raise KeyError("Key error: " + name + " not present in registries")
@@ -1766,6 +2128,44 @@ def test_registry():
     assert element("start").primitive_name() == "time"
     assert element("start").desc() == "Start time of an event/flow that may have a non-zero duration"
 
+    # namespaced lookup through the element index
+    saved_registries = _registries.copy()
+    preload_registry(os.path.join(os.path.dirname(__file__), os.pardir, "testdata", "registry_with_parent.json"))
+    assert element("end", reguri=test_registry.uri()).desc() == "overwritten end"
+    assert element("end").qualified_name() == REGURI_DEFAULT + "#end"
+    assert element("end", reguri=REGURI_DEFAULT).qualified_name() == REGURI_DEFAULT + "#end"
+    assert element("testName").name() == "testName"
+    _registries.clear()
+    _registries.update(saved_registries)
+    _invalidate_element_index()
+    try:
+        element("testName")
+        assert False
+    except KeyError:
+        pass
+
+    # compiled registry snapshots
+    import tempfile
+    with tempfile.TemporaryDirectory() as cachedir:
+        set_registry_cache(cachedir)
+        try:
+            parsed = Registry()
+            assert len(os.listdir(cachedir)) == 1
+            cached = Registry()
+            assert cached._revision == parsed._revision
+            assert list(cached._elements.keys()) == list(parsed._elements.keys())
+            assert repr(cached["start"]) == repr(parsed["start"])
+            # a stale snapshot is not used
+            key = os.path.abspath(os.path.join(os.path.dirname(__file__), "registry.json"))
+            snapshot = _load_registry_snapshot(key)
+            snapshot["validator"] = (0, 0)
+            snapshot["registry"][KEY_ELEMENTS] = []
+            with open(_registry_snapshot_path(key), "wb") as f:
+                pickle.dump(snapshot, f)
+            assert len(Registry()) == len(parsed)
+        finally:
+            set_registry_cache(None)
+
 #######################################################################
 # Constraints
 #######################################################################
@@ -1780,6 +2180,8 @@ class _Constraint(object):
     Constraint classes through Parameters.
 
     """
+    __slots__ = ("_prim",)
+
     def __init__(self, prim):
         super().__init__()
         self._prim = prim
@@ -1808,6 +2210,7 @@ constraint_all = _Constraint(None)
 
 class _RangeConstraint(_Constraint):
     """Represents acceptable values for an element as an inclusive range"""
+    __slots__ = ("a", "b")
 
     def __init__(self, prim, sval=None, a=None, b=None):
         super().__init__(prim)
@@ -1847,6 +2250,8 @@ class _RangeConstraint(_Constraint):
 
 class _SetConstraint(_Constraint):
     """Represents acceptable values as a discrete set."""
+    __slots__ = ("vs",)
+
     def __init__(self, prim, sval=None, vs=None):
         super().__init__(prim)
         if sval is not None:
@@ -1916,6 +2321,8 @@ class Parameter(Element):
     values.
 
     """
+    __slots__ = ("_val", "_constraint")
+
     def __init__(self, parent_element, constraint=constraint_all, val=None):
         super().__init__(parent_element._name, parent_element._prim)
         self._val = None
@@ -2015,6 +2422,8 @@ class Metavalue(Element):
     Metavalues are used in statement metadata sections.
 
     """
+    __slots__ = ("_val",)
+
     def __init__(self, parent_element, val):
         super().__init__(parent_element._name, parent_element._prim)
         self.set_value(val)
@@ -2039,6 +2448,121 @@ class Metavalue(Element):
     def _as_tuple(self):
         return (self._name, self._prim.unparse(self._val))
 
+class _AddressVector(object):
+    """
+    Compact list-like storage for the values of an address ResultColumn.
+
+    Each row is stored as its IP version (0 for None) and its integer
+    value: a uint32 per row while the column holds only IPv4 addresses,
+    two uint64s per row once an IPv6 address appears. Address objects
+    are only built on access, through a bounded intern cache. Prefix
+    matching runs over the integer arrays, vectorized with numpy when
+    it is available.
+
+    """
+    __slots__ = ("_ver", "_lo", "_hi")
+
+    def __init__(self):
+        super().__init__()
+        self.clear()
+
+    def _widen(self):
+        # first IPv6 address: switch to two uint64s per row
+        self._lo = array.array("Q", self._lo)
+        self._hi = array.array("Q", bytes(8 * len(self._lo)))
+
+    def _split(self, val):
+        if val is None:
+            return (0, 0, 0)
+        n = int(val)
+        if val.version == 6 and self._hi is None:
+            self._widen()
+        return (val.version, n & _UINT64_MASK, n >> 64)
+
+    def _value(self, i):
+        ver = self._ver[i]
+        if ver == 0:
+            return None
+        n = self._lo[i]
+        if self._hi is not None:
+            n |= self._hi[i] << 64
+        return _address_from_int(ver, n)
+
+    def __len__(self):
+        return len(self._ver)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._value(i) for i in range(*key.indices(len(self)))]
+        return self._value(key)
+
+    def __setitem__(self, key, val):
+        (ver, lo, hi) = self._split(val)
+        self._ver[key] = ver
+        self._lo[key] = lo
+        if self._hi is not None:
+            self._hi[key] = hi
+
+    def __delitem__(self, key):
+        del(self._ver[key])
+        del(self._lo[key])
+        if self._hi is not None:
+            del(self._hi[key])
+
+    def __iter__(self):
+        return (self._value(i) for i in range(len(self)))
+
+    def append(self, val):
+        (ver, lo, hi) = self._split(val)
+        self._ver.append(ver)
+        self._lo.append(lo)
+        if self._hi is not None:
+            self._hi.append(hi)
+
+    def extend(self, vals):
+        for val in vals:
+            self.append(val)
+
+    def clear(self):
+        self._ver = array.array("B")
+        self._lo = array.array("I")
+        self._hi = None
+
+    def match_network(self, net):
+        """
+        Return the indices of all rows containing an address
+        within the given network (an ip_network).
+
+        """
+        netval = int(net.network_address)
+        shift = net.max_prefixlen - net.prefixlen
+        (hiwords, nethi) = (None, 0)
+        if net.version == 4:
+            (words, netword) = (self._lo, netval)
+        elif shift >= 64:
+            # prefixes of up to /64 only look at the high word
+            (words, netword, shift) = (self._hi, netval >> 64, shift - 64)
+        else:
+            (words, netword) = (self._lo, netval & _UINT64_MASK)
+            (hiwords, nethi) = (self._hi, netval >> 64)
+        if words is None:
+            # no IPv6 address in this column
+            return []
+        # a shift by the whole word width matches any value
+        whole = shift >= words.itemsize * 8
+        if numpy is not None:
+            mask = numpy.frombuffer(self._ver, dtype=numpy.uint8) == net.version
+            if not whole:
+                w = numpy.frombuffer(words, dtype=numpy.dtype(words.typecode))
+                mask &= (w >> shift) == (netword >> shift)
+            if hiwords is not None:
+                mask &= numpy.frombuffer(hiwords, dtype=numpy.uint64) == nethi
+            return numpy.nonzero(mask)[0].tolist()
+        return [i for i in range(len(self))
+                if self._ver[i] == net.version and
+                   (whole or words[i] >> shift == netword >> shift) and
+                   (hiwords is None or hiwords[i] == nethi)]
+
 class ResultColumn(Element):
     """
     A ResultColumn is an element which can take an array of values.
@@ -2046,10 +2570,18 @@ class ResultColumn(Element):
     Results it has one or more values, such that all the ResultColumns
     in the Result have the same number of values.
 
+    Columns of address type store their values compactly as codes
+    into a per-column table of distinct addresses.
+
     """
+    __slots__ = ("_vals",)
+
     def __init__(self, parent_element):
         super().__init__(parent_element._name, parent_element._prim)
-        self._vals = []
+        if self._prim is prim_address:
+            self._vals = _AddressVector()
+        else:
+            self._vals = []
 
     def __repr__(self):
         return "<ResultColumn "+str(self)+" "+repr(self._prim)+\
@@ -2086,6 +2618,65 @@ class ResultColumn(Element):
         """ Clears values. """
         self._vals.clear()
 
+    def _set_values(self, vals):
+        self._vals.clear()
+        self._vals.extend(vals)
+
+    def match_network(self, network):
+        """
+        Return the indices of all rows in this column whose address
+        lies within the given network (an ip_network or a string in
+        CIDR notation). Only valid for columns of address type.
+
+        """
+        if self._prim is not prim_address:
+            raise ValueError("column "+self._name+" does not contain addresses")
+        if isinstance(network, str):
+            network = ip_network(network, strict=False)
+        return self._vals.match_network(network)
+
+def test_address_column():
+    col = ResultColumn(Element("source.ip4", prim_address))
+    col[0] = "10.0.27.1"
+    col[1] = "10.0.28.1"
+    col[3] = "192.0.2.1"
+    col[4] = "10.0.27.1"
+    assert len(col) == 5
+    assert col[2] is None
+    assert col[4] is col[0]
+    assert list(col) == [ip_address("10.0.27.1"), ip_address("10.0.28.1"),
+                         None, ip_address("192.0.2.1"), ip_address("10.0.27.1")]
+    assert col.match_network("10.0.0.0/16") == [0, 1, 4]
+    assert col.match_network("10.0.27.0/24") == [0, 4]
+    assert col.match_network("2001:db8::/32") == []
+    col[1] = "2001:db8::1"
+    assert col.match_network("2001:db8::/32") == [1]
+    assert col.match_network("2001:db8::1/128") == [1]
+    assert col.match_network("2001:db8:0:1::/64") == []
+    assert col.match_network("::/0") == [1]
+    assert col.match_network("0.0.0.0/0") == [0, 3, 4]
+    assert col.match_network("10.0.27.0/24") == [0, 4]
+    assert col[0] is col[4]
+    del col[0]
+    assert col.match_network("10.0.27.0/24") == [3]
+    assert deepcopy(col)[2] == ip_address("192.0.2.1")
+
+def export_scheme(export):
+    """
+    Return the protocol identifier of an export section (the scheme of
+    the export URL, or the whole section if it is a bare scheme), or
+    None if there is no export section.
+
+    >>> export_scheme("mplane-https://collector.example.com:4343/result")
+    'mplane-https'
+    >>> export_scheme("ipfix")
+    'ipfix'
+
+    """
+    if export is None:
+        return None
+    return export.split(":", 1)[0]
+
 class Statement(object):
     """
     A Statement is an assertion about the properties of a measurement
@@ -2096,6 +2687,9 @@ class Statement(object):
     and :class:`mplane.model.Result` classes instead.
 
     """
+    __slots__ = ("_version", "_params", "_metadata", "_resultcolumns",
+                 "_verb", "_label", "_token", "_link", "_export", "_when",
+                 "_reguri")
 
     def __init__(self, dictval=None, verb=VERB_MEASURE, label=None, token=None, when=None, reguri=None):
         super().__init__()
@@ -2379,17 +2973,15 @@ class Statement(object):
       return self._mpcv_hash()
 
     def _result_rows(self):
-        rows = []
-        for row_index in range(self.count_result_rows()):
-            row = []
-            rows.append(row)
-            for col in self._resultcolumns.values():
-                try:
-                    valstr = col._prim.unparse(col[row_index])
-                except IndexError:
-                    valstr = VALUE_NONE
-                row.append(valstr)
-        return rows
+        # unparse column by column, then transpose into rows
+        row_count = self.count_result_rows()
+        cols = []
+        for col in self._resultcolumns.values():
+            svals = col._prim.unparse_many(col._vals)
+            if len(svals) < row_count:
+                svals.extend([VALUE_NONE] * (row_count - len(svals)))
+            cols.append(svals)
+        return [list(row) for row in zip(*cols)]
 
     def to_dict(self, token_only=False):
         """
@@ -2470,7 +3062,7 @@ class Statement(object):
           self._link = d[KEY_LINK]
 
         if KEY_EXPORT in d:
-          self._link = d[KEY_EXPORT]
+          self._export = d[KEY_EXPORT]
 
         if KEY_TOKEN in d:
           self._token = d[KEY_TOKEN]
@@ -2507,6 +3099,7 @@ class Capability(Statement):
     methods, or by reading from a JSON object using parse_json().
 
     """
+    __slots__ = ()
 
     def __init__(self, dictval=None, verb=VERB_MEASURE, label=None, token=None, when=None, registry_uri=None):
         super().__init__(dictval=dictval, verb=verb, label=label, token=token, when=when, reguri=registry_uri)
@@ -2560,6 +3153,7 @@ class Specification(Statement):
     the constructor, or by reading from a JSON object (see model.parse_json()).
 
     """
+    __slots__ = ()
 
     def __init__(self, dictval=None, capability=None, verb=VERB_MEASURE, label=None, token=None, when=None, schedule=None):
         super().__init__(dictval=dictval, verb=verb, label=label, token=token, when=when)
@@ -2572,6 +3166,7 @@ class Specification(Statement):
             self._params = deepcopy(capability._params)
             self._resultcolumns = deepcopy(capability._resultcolumns)
             self._reguri = capability._reguri
+            self._export = capability._export
 
             # inherit from capability only when necessary
             if when is None:
@@ -2600,6 +3195,11 @@ class Specification(Statement):
         if not self._when.follows(capability.when()):
             return False
 
+        # Capabilities with an export section only take specifications
+        # exporting over the same protocol, and vice versa
+        if export_scheme(self._export) != export_scheme(capability.get_export()):
+            return False
+
         # Works for me.
         return True
 
@@ -2667,6 +3267,8 @@ class Result(Statement):
     Results are generally created by passing the specification the new result responds to as the specification= argument to the constructor. A result inherits its token from the specification it responds to.
 
     """
+    __slots__ = ()
+
     def __init__(self, dictval=None, specification=None, verb=VERB_MEASURE, label=None, token=None, when=None):
         super().__init__(dictval=dictval, verb=verb, label=label, token=token, when=when)
         if dictval is None and specification is not None:
@@ -2717,12 +3319,20 @@ class Result(Statement):
         """
         super()._from_dict(d)
 
-        column_key = list(self._resultcolumns.keys())
-
         if KEY_RESULTVALUES in d:
-            for i, row in enumerate(d[KEY_RESULTVALUES]):
-                for j, val in enumerate(row):
-                    self._resultcolumns[column_key[j]][i] = val
+            rows = d[KEY_RESULTVALUES]
+            ncols = len(self._resultcolumns)
+            for row in rows:
+                if len(row) > ncols:
+                    raise ValueError("result row has "+str(len(row))+
+                                     " values for "+str(ncols)+" columns")
+            for j, col in enumerate(self._resultcolumns.values()):
+                try:
+                    svals = list(map(operator.itemgetter(j), rows))
+                except IndexError:
+                    # ragged rows; missing values are None
+                    svals = [row[j] if j < len(row) else None for row in rows]
+                col._set_values(col._prim.parse_many(svals))
 
     def set_result_value(self, elem_name, val, row_index=0):
         """
@@ -2760,6 +3370,8 @@ class BareNotification(object):
     or Specification.
 
     """
+    __slots__ = ("_token",)
+
     def __init__(self, dictval=None, token=None):
         super().__init__()
         if dictval is not None:
@@ -2778,6 +3390,8 @@ class Exception(BareNotification):
     client and component frameworks.
 
     """
+    __slots__ = ("_errmsg", "status")
+
     def __init__(self, token=None, dictval=None, errmsg=None, status=None):
         super().__init__(dictval=dictval, token=token)
         if dictval is None:
@@ -2823,6 +3437,8 @@ class _StatementNotification(Statement):
     directly
 
     """
+    __slots__ = ()
+
     def __init__(self, dictval=None, statement=None, verb=VERB_MEASURE, token=None):
         super().__init__(dictval=dictval, verb=verb, token=token)
         if dictval is None and statement is not None:
@@ -2859,6 +3475,8 @@ class Receipt(_StatementNotification):
     A component presents a receipt to a Client in lieu of a result, when the
     result will not be available in a reasonable amount of time; or to confirm
     a Specification """
+    __slots__ = ()
+
     def __init__(self, dictval=None, specification=None, token=None):
         super().__init__(dictval=dictval, statement=specification, token=token)
 
@@ -2878,6 +3496,8 @@ class Redemption(_StatementNotification):
     a Receipt in order to get the associated Result.
 
     """
+    __slots__ = ()
+
     def __init__(self, dictval=None, receipt=None, token=None):
         super().__init__(dictval=dictval, statement=receipt, token=token)
         if receipt is not None and token is None:
@@ -2894,6 +3514,8 @@ class Redemption(_StatementNotification):
 
 class Withdrawal(_StatementNotification):
     """A Withdrawal cancels a Capability"""
+    __slots__ = ()
+
     def __init__(self, dictval=None, capability=None, token=None):
         super().__init__(dictval=dictval, statement=capability, token=token)
 
@@ -2908,6 +3530,8 @@ class Withdrawal(_StatementNotification):
 
 class Interrupt(_StatementNotification):
     """An Interrupt cancels a Specification"""
+    __slots__ = ()
+
     def __init__(self, dictval=None, specification=None, token=None):
         super().__init__(dictval=dictval, statement=specification, token=token)
 
@@ -3073,6 +3697,16 @@ def unparse_json(msg, token_only=False):
     return json.dumps(msg.to_dict(token_only=token_only),
                       sort_keys=True, indent=2, separators=(',',': '))
 
+def unparse_json_chunks(msg, token_only=False):
+    """
+    Like unparse_json(), but return an iterator over pieces of the JSON
+    text, so that large messages can be written out while they are
+    being serialized.
+
+    """
+    encoder = json.JSONEncoder(sort_keys=True, indent=2, separators=(',',': '))
+    return encoder.iterencode(msg.to_dict(token_only=token_only))
+
 def parse_yaml(ystr):
     return mplane.model.message_from_dict(yaml.load(ystr))
 
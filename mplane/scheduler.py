@@ -29,9 +29,18 @@ results within the mPlane reference component.
 """
 
 from datetime import datetime
+import hashlib
+import os
+import re
+import tempfile
 import threading
+import time
 import mplane.model
 import mplane.azn
+import mplane.exporter
+
+# Seconds between looks for finished jobs redeemed by other processes
+JOB_PRUNE_INTERVAL = 10
 
 class Service(object):
     """
@@ -46,6 +55,7 @@ class Service(object):
     def __init__(self, capability):
         super(Service, self).__init__()
         self._capability = capability
+        self._capability_listeners = []
 
     def run(self, specification, check_interrupt):
         """
@@ -71,14 +81,121 @@ class Service(object):
         """Returns the capability belonging to this service"""
         return self._capability
 
+    def add_capability_listener(self, fn):
+        """Call fn with this service whenever its capability changes"""
+        self._capability_listeners.append(fn)
+
     def set_capability_link(self, link):
         """Sets the link section in the capability schema"""
         self._capability.set_link(link)
+        for fn in self._capability_listeners:
+            fn(self)
 
     def __repr__(self):
         return "<Service for "+repr(self._capability)+">"
 
 
+class JobStore(object):
+    """
+    Keeps the latest reply of each job (its receipt, then its result or
+    exception) in a directory, one file per token, so that schedulers
+    in several processes of one component can answer redemptions and
+    interrupts for each other's jobs.
+
+    Interrupts for a job running in another process are left as marker
+    files, which the job notices when it next checks for interrupts.
+    Jobs whose results are exported only ever reply with their receipt;
+    a marker file tells other processes when such a job has finished.
+    A process claims a job before running it, by creating a claim file
+    exclusively, so that the same specification reaching two processes
+    at once only runs in one of them.
+
+    """
+    _token_re = re.compile(r"^[0-9A-Za-z_\-]+$")
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+
+    def _path(self, token, suffix=""):
+        # tokens come from clients; refuse anything that is not a name
+        if token is None or not self._token_re.match(token):
+            return None
+        return os.path.join(self._dir, token + suffix)
+
+    def claim(self, token):
+        """
+        Claim a job for this process. Returns False if another process
+        (or this one) claimed it first, and the job has not been removed.
+
+        """
+        path = self._path(token, ".claim")
+        if path is None:
+            return False
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def put(self, token, msg):
+        """Store the latest reply for a job."""
+        path = self._path(token)
+        if path is None:
+            return
+        (fd, tmp) = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(mplane.model.unparse_json(msg))
+        os.replace(tmp, path)
+
+    def get(self, token):
+        """Return the latest reply stored for a job, or None."""
+        path = self._path(token)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return mplane.model.parse_json(f.read())
+        except FileNotFoundError:
+            return None
+
+    def holds(self, token):
+        """Return True if a job is known (not yet redeemed or removed)."""
+        path = self._path(token)
+        return path is not None and os.path.exists(path)
+
+    def remove(self, token):
+        """Forget a job."""
+        for suffix in ("", ".interrupt", ".done", ".claim"):
+            path = self._path(token, suffix)
+            if path is not None:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def interrupt(self, token):
+        """Ask the process running a job to interrupt it."""
+        path = self._path(token, ".interrupt")
+        if path is not None:
+            open(path, "w").close()
+
+    def interrupted(self, token):
+        """Return True if a job was asked to be interrupted."""
+        path = self._path(token, ".interrupt")
+        return path is not None and os.path.exists(path)
+
+    def finish(self, token):
+        """Mark a job whose results were exported as finished."""
+        path = self._path(token, ".done")
+        if path is not None:
+            open(path, "w").close()
+
+    def finished(self, token):
+        """Return True if a job was marked as finished."""
+        path = self._path(token, ".done")
+        return path is not None and os.path.exists(path)
+
 class Job(object):
     """
     A Job binds some running code to an mPlane.model.Specification
@@ -86,7 +203,9 @@ class Job(object):
     instance of a Service presently running, or ready to run at some
     point in the future.
 
-    Each Job will result in a single Result.
+    Each Job will result in a single Result. If the Job has an exporter,
+    the Result is handed to it (indirect export) rather than returned,
+    and the Job only ever replies with its Receipt.
     """
     result = None
     exception = None
@@ -101,7 +220,8 @@ class Job(object):
     receipt = None
     _interrupt = None
 
-    def __init__(self, service, specification, session=None, callback=None):
+    def __init__(self, service, specification, session=None, callback=None,
+                 exporter=None, job_store=None, interrupted=None):
         super(Job, self).__init__()
         self.service = service
         self.session = session
@@ -109,6 +229,13 @@ class Job(object):
         self.receipt = mplane.model.Receipt(specification=specification)
         self._interrupt = threading.Event()
         self._callback = callback
+        self._exporter = exporter
+        self._job_store = job_store
+        # tells whether another process asked to interrupt this job
+        self._interrupted = interrupted
+        if job_store is not None and interrupted is None:
+            token = self.receipt.get_token()
+            self._interrupted = lambda: job_store.interrupted(token)
 
     def __repr__(self):
         return "<Job for "+repr(self.specification)+">"
@@ -126,10 +253,23 @@ class Job(object):
             self._exception_at = datetime.utcnow()
         self._ended_at = datetime.utcnow()
 
+        if self._exporter is not None and self.exception is None:
+            # exported results never go back to the client; the stored
+            # receipt is the job's last reply
+            self._exporter.export(self.result)
+            if self._job_store is not None:
+                self._job_store.finish(self.receipt.get_token())
+            return
+
+        if self._job_store is not None:
+            self._job_store.put(self.receipt.get_token(), self._reply())
+
         if self._callback:
             self._callback(self.receipt)
 
     def _check_interrupt(self):
+        if self._interrupted is not None and self._interrupted():
+            self._interrupt.set()
         return self._interrupt.is_set()
 
     def _schedule_now(self):
@@ -186,9 +326,12 @@ class Job(object):
 
         """
         self._replied_at = datetime.utcnow()
+        return self._reply()
+
+    def _reply(self):
         if self.failed():
             return self.exception
-        elif self.finished():
+        elif self.finished() and self._exporter is None:
             return self.result
         else:
             return self.receipt
@@ -211,7 +354,8 @@ class MultiJob(object):
     _scheduling_finished = False
     _subspec_iterator = None
 
-    def __init__(self, service, specification, session=None, max_results=0, callback=None):
+    def __init__(self, service, specification, session=None, max_results=0, callback=None,
+                 exporter=None, job_store=None):
         super(MultiJob, self).__init__()
         self.service = service
         self.session = session
@@ -223,6 +367,9 @@ class MultiJob(object):
         self._subspec_iterator = specification.subspec_iterator()
         self._max_results = int(max_results)
         self._callback = callback
+        self._exporter = exporter
+        self._job_store = job_store
+        self._lock = threading.Lock()
 
     def __repr__(self):
         return "<MultiJob for "+repr(self.specification)+">"
@@ -231,10 +378,16 @@ class MultiJob(object):
         """
         Schedule a job.
         """
+        interrupted = None
+        if self._job_store is not None:
+            token = self.receipt.get_token()
+            interrupted = lambda: self._job_store.interrupted(token)
         new_job = Job(service=self.service,
                       specification=self._subspec,
                       session=self.session,
-                      callback=self._job_callback)
+                      callback=self._job_callback,
+                      exporter=self._exporter,
+                      interrupted=interrupted)
 
         self.jobs.append(new_job)
         new_job.schedule()
@@ -312,12 +465,15 @@ class MultiJob(object):
 
     def _collect_results(self):
         """Stores the last self.max_results results."""
-        for job in self.jobs[:]:
-            if job.failed() or job.finished():
-                self.results.append_message(job.get_reply())
-                self.jobs.remove(job)
+        with self._lock:
+            for job in self.jobs[:]:
+                if job.failed() or job.finished():
+                    # exported results are not kept; exceptions are
+                    if self._exporter is None or job.failed():
+                        self.results.append_message(job.get_reply())
+                    self.jobs.remove(job)
 
-        self.results.trim(self._max_results)
+            self.results.trim(self._max_results)
 
     def get_reply(self):
         """
@@ -325,14 +481,19 @@ class MultiJob(object):
         Otherwise, create a receipt from the Specification and return that.
 
         """
-        self._collect_results()
         self._replied_at = datetime.utcnow()
+        return self._reply()
+
+    def _reply(self):
+        self._collect_results()
         if len(self.results) > 0:
             return self.results
         else:
             return self.receipt
 
     def _job_callback(self, arg):
+        if self._job_store is not None:
+            self._job_store.put(self.receipt.get_token(), self._reply())
         if self._callback:
             self._callback(self.receipt)
 
@@ -345,9 +506,12 @@ class Scheduler(object):
     submit_job().
 
     """
-    def __init__(self, config=None):
+    def __init__(self, config=None, tls_state=None):
         super(Scheduler, self).__init__()
 
+        # used by exporters to reach collectors
+        self._tls_state = tls_state
+
         if config:
             self.azn = mplane.azn.Authorization(config)
 
@@ -361,10 +525,23 @@ class Scheduler(object):
             self._max_results = 0
             self.azn = mplane.azn.Authorization()
 
+        # job replies shared with the other processes of this component
+        self._job_store = None
+        if config and "component" in config.sections() and \
+                "job_dir" in config["component"]:
+            self._job_store = JobStore(config["component"]["job_dir"])
+        self._next_prune = 0
+
         self.services = []
         self.jobs = {}
         self._capability_cache = {}
 
+        # capabilities serialized to JSON, by token, and envelopes of
+        # them, by the tokens they hold; rebuilt when capabilities change
+        self._capability_json = {}
+        self._envelope_cache = {}
+        self._capability_lock = threading.Lock()
+
     def process_message(self, user, msg, session=None, callback=None):
         """
         Process a message. If msg is a mplane.model.Specification and
@@ -374,16 +551,31 @@ class Scheduler(object):
         Returns a message to send in reply.
 
         """
+        if self._job_store is not None and time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + JOB_PRUNE_INTERVAL
+            self.prune_jobs()
+
         reply = None
         if isinstance(msg, mplane.model.Specification):
             reply = self.submit_job(user, specification=msg, session=session, callback=callback)
         elif isinstance(msg, mplane.model.Redemption):
             job_key = msg.get_token()
+            if self._redeemed_elsewhere(job_key):
+                # its result was handed out by another process
+                self.jobs.pop(job_key, None)
             if job_key in self.jobs:
                 job = self.jobs[job_key]
                 reply = job.get_reply()
                 if job.finished():
                     self.jobs.pop(job_key, None)
+                    if self._job_store is not None:
+                        self._job_store.remove(job_key)
+            elif self._stored_reply(job_key) is not None:
+                # a job of another process of this component
+                reply = self._stored_reply(job_key)
+                if isinstance(reply, (mplane.model.Result, mplane.model.Exception)) or \
+                   self._job_store.finished(job_key):
+                    self._job_store.remove(job_key)
             else:
                 reply = mplane.model.Exception(token=job_key,
                 errmsg="Unknown job")
@@ -394,9 +586,20 @@ class Scheduler(object):
                 print("Interrupting " + job.specification.get_label())
                 job.interrupt()
                 reply = job.get_reply()
+            elif self._stored_reply(job_key) is not None:
+                print("Interrupting job " + job_key + " in another process")
+                self._job_store.interrupt(job_key)
+                reply = self._stored_reply(job_key)
             else:
                 reply = mplane.model.Exception(token=job_key,
                 errmsg="Unknown job")
+        elif isinstance(msg, mplane.model.Result):
+            reply = self.collect(user, msg)
+        elif isinstance(msg, mplane.model.Envelope):
+            if all(isinstance(m, mplane.model.Result) for m in msg.messages()):
+                reply = self.collect(user, msg)
+            else:
+                reply = self._process_envelope(user, msg, session, callback)
         else:
             print("exception")
             reply = mplane.model.Exception(token=msg.get_token(),
@@ -404,12 +607,83 @@ class Scheduler(object):
 
         return reply
 
+    def _stored_reply(self, job_key):
+        if self._job_store is None:
+            return None
+        return self._job_store.get(job_key)
+
+    def _redeemed_elsewhere(self, job_key):
+        # jobs are stored before they are scheduled, so a finished job
+        # missing from the store has been redeemed through the store
+        job = self.jobs.get(job_key)
+        return (self._job_store is not None and job is not None and
+                job.finished() and not self._job_store.holds(job_key))
+
+    def _process_envelope(self, user, msg, session=None, callback=None):
+        """
+        Process each message in an Envelope (e.g. a batch of
+        Redemptions), and return the replies in one Envelope, in order.
+
+        """
+        reply = mplane.model.Envelope()
+        for imsg in msg.messages():
+            ireply = self.process_message(user, imsg, session=session, callback=callback)
+            if ireply is not None:
+                reply.append_message(ireply)
+        return reply
+
+    def collect(self, user, msg):
+        """
+        Hand a Result exported to this component, or each Result in an
+        Envelope of them, to the service collecting results with its
+        schema (a service with a collect() method, e.g. in a repository).
+
+        Returns None, or an Exception for the first result which could
+        not be collected.
+
+        """
+        if isinstance(msg, mplane.model.Envelope):
+            results = [m for m in msg.messages() if isinstance(m, mplane.model.Result)]
+        else:
+            results = [msg]
+
+        for result in results:
+            schema = result._schema_hash()
+            for service in self.services:
+                if hasattr(service, 'collect') and \
+                   service.capability()._schema_hash() == schema:
+                    if not self.azn.check(service.capability(), user):
+                        print("Not allowed to export to this capability: " + repr(result))
+                        return mplane.model.Exception(token=result.get_token(),
+                                    errmsg="User has no permission to export these results")
+                    try:
+                        service.collect(result)
+                    except (KeyError, ValueError) as e:
+                        print("Cannot collect "+repr(result)+": "+repr(e))
+                        return mplane.model.Exception(token=result.get_token(),
+                                    errmsg="Cannot collect result: "+str(e))
+                    break
+            else:
+                print("No collector for "+repr(result))
+                return mplane.model.Exception(token=result.get_token(),
+                            errmsg="No service collects results with this schema")
+        return None
+
     def add_service(self, service):
         """Add a service to this Scheduler"""
         print("Added "+repr(service))
         self.services.append(service)
+        service.add_capability_listener(self._cache_capability)
+        self._cache_capability(service)
+
+    def _cache_capability(self, service):
+        # serialize a service's capability once, when added or changed
         cap = service.capability()
-        self._capability_cache[cap.get_token()] = cap
+        body = mplane.model.unparse_json(cap).encode("utf-8")
+        with self._capability_lock:
+            self._capability_cache[cap.get_token()] = cap
+            self._capability_json[cap.get_token()] = body
+            self._envelope_cache.clear()
 
     def capability_keys(self):
         """
@@ -425,6 +699,34 @@ class Scheduler(object):
         """
         return self._capability_cache[key]
 
+    def capability_json(self, key):
+        """
+        Return the capability for a given key serialized to mPlane
+        JSON, as bytes ready to send.
+        """
+        return self._capability_json[key]
+
+    def capability_envelope(self, user):
+        """
+        Return the capabilities the given user may invoke as an
+        Envelope serialized to mPlane JSON, and an ETag for it, as a
+        (body, etag) tuple. Each distinct set of capabilities is
+        serialized once, and kept until a capability changes.
+
+        """
+        tokens = tuple(key for (key, cap) in list(self._capability_cache.items())
+                       if self.azn.check(cap, user))
+        with self._capability_lock:
+            entry = self._envelope_cache.get(tokens)
+            if entry is None:
+                env = mplane.model.Envelope(content_type=mplane.model.ENVELOPE_STATEMENT)
+                for key in tokens:
+                    env.append_message(self._capability_cache[key])
+                body = mplane.model.unparse_json(env).encode("utf-8")
+                entry = (body, '"' + hashlib.md5(body).hexdigest() + '"')
+                self._envelope_cache[tokens] = entry
+        return entry
+
     def submit_job(self, user, specification, session=None, callback=None):
         """
         Search the available Services for one which can
@@ -438,6 +740,20 @@ class Scheduler(object):
                 if self.azn.check(service.capability(), user):
                     # Found. Create a new job.
                     print(repr(service)+" matches "+repr(specification))
+
+                    # results of specifications with an export section
+                    # go to the collector instead
+                    exporter = None
+                    if specification.get_export() is not None:
+                        try:
+                            exporter = mplane.exporter.exporter_for(
+                                            specification.get_export(),
+                                            tls_state=self._tls_state)
+                        except ValueError as e:
+                            print("Cannot export "+repr(specification)+": "+str(e))
+                            return mplane.model.Exception(token=specification.get_token(),
+                                        errmsg="Cannot export: "+str(e))
+
                     if (specification.when().is_repeated() and
                         # the service is not a RelayService from supervisor.py,
                         # handle it as a normal multijob
@@ -446,12 +762,16 @@ class Scheduler(object):
                                            specification=specification,
                                            session=session,
                                            max_results=self._max_results,
-                                           callback=callback)
+                                           callback=callback,
+                                           exporter=exporter,
+                                           job_store=self._job_store)
                     else:
                         new_job = Job(service=service,
                                       specification=specification,
                                       session=session,
-                                      callback=callback)
+                                      callback=callback,
+                                      exporter=exporter,
+                                      job_store=self._job_store)
 
                     # Key by the receipt's token, and return
                     job_key = new_job.receipt.get_token()
@@ -459,10 +779,17 @@ class Scheduler(object):
                         # Job already running. Return receipt
                         print(repr(self.jobs[job_key])+" already running")
                         return self.jobs[job_key].receipt
-
-                    # Keep track of the job and return receipt
-                    new_job.schedule()
+                    if self._job_store is not None and \
+                       not self._job_store.claim(job_key):
+                        print("Job " + job_key + " already running in another process")
+                        return new_job.receipt
+
+                    # Keep track of the job and return receipt; other
+                    # processes learn of it before it can finish
+                    if self._job_store is not None:
+                        self._job_store.put(job_key, new_job.receipt)
                     self.jobs[job_key] = new_job
+                    new_job.schedule()
                     print("Returning "+repr(new_job.receipt))
                     return new_job.receipt
 
@@ -479,16 +806,23 @@ class Scheduler(object):
     def job_for_message(self, msg):
         """
         Given a message (generally a Redemption),
-        return the Job matching its token.
+        return the Job matching its token, or None if the
+        job runs in another process of this component.
 
         """
-        return self.jobs[msg.get_token()]
+        job_key = msg.get_token()
+        if job_key not in self.jobs and self._stored_reply(job_key) is not None:
+            return None
+        return self.jobs[job_key]
 
     def prune_jobs(self):
         """
-        Currently does nothing. Will remove Jobs which are
-        finished and whose Results have been retrieved
-        from the scheduler in a future version.
+        Remove finished Jobs whose Results have been retrieved
+        through another process of this component. Jobs whose
+        Results are retrieved from this scheduler are removed
+        as they are retrieved.
 
         """
-        pass
+        for job_key in list(self.jobs):
+            if self._redeemed_elsewhere(job_key):
+                self.jobs.pop(job_key, None)
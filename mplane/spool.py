@@ -0,0 +1,268 @@
+# mPlane Protocol Reference Implementation
+# Store-and-forward spool for outgoing messages
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+On-disk spool of mPlane messages waiting to be sent to a peer.
+
+Messages are appended to segment files in a spool directory. Each
+record is a big-endian (length, crc32) header followed by the
+destination URL, a newline, and the message in JSON. A checkpoint file
+records the position of the oldest record not yet acknowledged; records
+are read back in the order they were written, and segments are deleted
+once every record in them has been acknowledged, or when the spool
+grows past its size or age caps.
+
+"""
+
+import os
+import struct
+import time
+import zlib
+from threading import Lock
+
+import mplane.model
+
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+
+# Start a new segment once the current one reaches this size
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+# Drop the oldest segments once the spool holds this many bytes
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Drop segments whose newest record is older than this many seconds
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+_header = struct.Struct(">II")
+
+class Spool(object):
+    """
+    Append-only, on-disk queue of (url, message) pairs.
+
+    append() is safe to call from any thread. peek() returns records
+    from the oldest unacknowledged one onward, each with a position to
+    pass to ack() once it has been delivered. With sync=False (the
+    default) records are flushed to the operating system but not fsynced,
+    so they survive the component crashing but not the host.
+
+    """
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE,
+                 sync=False):
+        self._dir = directory
+        self._segment_bytes = segment_bytes
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._sync = sync
+        self._lock = Lock()
+        self._dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # sizes of the segments on disk, by sequence number
+        self._segments = {}
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)], 16)
+                self._segments[seq] = os.path.getsize(self._path(seq))
+
+        # always write to a fresh segment, never after a possibly torn tail
+        self._write_seq = max(self._segments) + 1 if self._segments else 0
+        self._writer = None
+        self._open_writer()
+
+        self._checkpoint = self._read_checkpoint()
+        self._normalize()
+
+    def _path(self, seq):
+        return os.path.join(self._dir, "%016x%s" % (seq, SEGMENT_SUFFIX))
+
+    def _open_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = open(self._path(self._write_seq), "ab")
+        self._segments[self._write_seq] = 0
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self._dir, CHECKPOINT_FILE)) as f:
+                (seq, offset) = f.read().split()
+            return (int(seq, 16), int(offset))
+        except (OSError, ValueError):
+            return (min(self._segments), 0)
+
+    def _write_checkpoint(self):
+        path = os.path.join(self._dir, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("%x %d\n" % self._checkpoint)
+        os.replace(path + ".tmp", path)
+
+    def _normalize(self):
+        """
+        Move the checkpoint past fully read segments, and delete
+        segments wholly before it.
+
+        """
+        (seq, offset) = self._checkpoint
+        first = min(self._segments)
+        if seq < first:
+            (seq, offset) = (first, 0)
+        while (seq != self._write_seq and
+               (seq not in self._segments or offset >= self._segments[seq])):
+            (seq, offset) = (seq + 1, 0)
+        self._checkpoint = (seq, offset)
+
+        for old in sorted(self._segments):
+            if old >= seq:
+                break
+            self._remove_segment(old)
+
+    def _remove_segment(self, seq):
+        del self._segments[seq]
+        try:
+            os.remove(self._path(seq))
+        except FileNotFoundError:
+            pass
+
+    def append(self, url, msg):
+        """
+        Append a message bound for url (a string) to the spool.
+
+        """
+        payload = (str(url) + "\n" + mplane.model.unparse_json(msg)).encode("utf-8")
+        record = _header.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._segments[self._write_seq] >= self._segment_bytes:
+                # caps are only checked when starting a new segment,
+                # to keep appends cheap
+                self._write_seq += 1
+                self._open_writer()
+                self._enforce_caps()
+            self._writer.write(record)
+            self._writer.flush()
+            if self._sync:
+                os.fsync(self._writer.fileno())
+            self._segments[self._write_seq] += len(record)
+
+    def pending(self):
+        """
+        Return True if there are unacknowledged records in the spool.
+
+        """
+        with self._lock:
+            return self._checkpoint < (self._write_seq, self._segments[self._write_seq])
+
+    def peek(self, count):
+        """
+        Return up to count unacknowledged records, oldest first, as
+        (position, url, message) tuples.
+
+        """
+        records = []
+        with self._lock:
+            (seq, offset) = self._checkpoint
+            while len(records) < count and seq in self._segments:
+                end = self._segments[seq]
+                with open(self._path(seq), "rb") as f:
+                    f.seek(offset)
+                    while len(records) < count and offset < end:
+                        head = f.read(_header.size)
+                        (length, crc) = _header.unpack(head) if len(head) == _header.size else (0, 0)
+                        payload = f.read(length)
+                        if not length or len(payload) < length or zlib.crc32(payload) != crc:
+                            # torn or corrupt tail: forget the rest of the segment
+                            print("Spool segment " + self._path(seq) +
+                                  " truncated at " + str(offset))
+                            if seq != self._write_seq:
+                                self._segments[seq] = offset
+                                self._normalize()
+                            break
+                        offset += _header.size + length
+                        (url, text) = payload.decode("utf-8").split("\n", 1)
+                        records.append(((seq, offset), url,
+                                        mplane.model.parse_json(text)))
+                if seq == self._write_seq:
+                    break
+                (seq, offset) = (seq + 1, 0)
+        return records
+
+    def ack(self, position):
+        """
+        Acknowledge every record up to and including the one at position.
+
+        """
+        with self._lock:
+            if position <= self._checkpoint:
+                return
+            self._checkpoint = position
+            # everything acknowledged: start over in a new segment
+            if self._checkpoint == (self._write_seq, self._segments[self._write_seq]):
+                self._write_seq += 1
+                self._open_writer()
+            self._normalize()
+            self._write_checkpoint()
+
+    def compact(self):
+        """
+        Delete acknowledged segments and apply the size and age caps,
+        including to the segment being written to, which append() only
+        does when a segment fills up.
+
+        """
+        with self._lock:
+            self._normalize()
+            if self._segments[self._write_seq] and self._over_caps(self._write_seq):
+                # the caps never drop the write segment: start a new one
+                self._write_seq += 1
+                self._open_writer()
+            self._enforce_caps()
+            self._write_checkpoint()
+
+    def _over_caps(self, seq):
+        if sum(self._segments.values()) > self._max_bytes:
+            return True
+        try:
+            return time.time() - os.path.getmtime(self._path(seq)) > self._max_age
+        except OSError:
+            return True
+
+    def _enforce_caps(self):
+        for seq in sorted(self._segments):
+            if seq == self._write_seq or not self._over_caps(seq):
+                break
+            print("Spool full or stale, dropping segment " + self._path(seq))
+            self._dropped += 1
+            self._remove_segment(seq)
+            if self._checkpoint[0] <= seq:
+                self._checkpoint = (seq + 1, 0)
+                self._write_checkpoint()
+
+    def stats(self):
+        """
+        Return a dictionary with the spool's size on disk, number of
+        segments, and number of segments dropped by the caps.
+
+        """
+        with self._lock:
+            return {"bytes": sum(self._segments.values()),
+                    "segments": len(self._segments),
+                    "segments_dropped": self._dropped}
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
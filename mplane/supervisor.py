@@ -27,21 +27,224 @@ import mplane.component
 import mplane.utils
 import mplane.tls
 
+import collections
+import concurrent.futures
 import queue
 import re
+import time
 import tornado.web
-from time import sleep
 import threading
 from threading import Thread
 
+# how often a relay waiting for a result checks for interrupts, in seconds
+RELAY_INTERRUPT_POLL = 1
+# how long, in seconds, and how many results arriving before their relay
+# waits for them are kept
+EARLY_COMPLETION_GRACE = 30
+EARLY_COMPLETION_MAX = 1000
+
+class CompletionRegistry(object):
+    """
+    Results and exceptions relayed specifications are waiting for, keyed
+    by the identity of the component answering and the token of the
+    forwarded specification. The supervisor resolves an entry as soon as
+    the message arrives, waking the relay waiting on it.
+
+    Only entries registered with expect() are resolved. A message may
+    arrive just before its relay registers; such early messages are
+    kept for up to grace seconds (at most max_early of them), and
+    handed over if the entry is registered in time. Anything else is
+    dropped.
+
+    """
+    def __init__(self, grace=EARLY_COMPLETION_GRACE, max_early=EARLY_COMPLETION_MAX):
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._early = collections.OrderedDict()
+        self._grace = grace
+        self._max_early = max_early
+
+    def _expire_early(self):
+        # must hold the lock
+        now = time.monotonic()
+        while self._early:
+            (key, (msg, arrived)) = next(iter(self._early.items()))
+            if now - arrived < self._grace and len(self._early) <= self._max_early:
+                break
+            self._early.popitem(last=False)
+
+    def _future(self, identity, token):
+        # must hold the lock
+        key = (identity, token)
+        if key not in self._futures:
+            self._futures[key] = concurrent.futures.Future()
+            self._expire_early()
+            if key in self._early:
+                self._futures[key].set_result(self._early.pop(key)[0])
+        return self._futures[key]
+
+    def expect(self, identity, token):
+        """Register interest in the message for a token from identity."""
+        with self._lock:
+            self._future(identity, token)
+
+    def resolve(self, identity, msg):
+        """
+        Complete the entry for msg's token from identity, or keep msg
+        for a while if the entry is not registered yet. Returns False
+        if msg is dropped because it has already arrived.
+
+        """
+        key = (identity, msg.get_token())
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                self._expire_early()
+                if key in self._early:
+                    return False
+                self._early[key] = (msg, time.monotonic())
+                self._expire_early()
+                return True
+            if future.done():
+                return False
+            future.set_result(msg)
+            return True
+
+    def wait(self, identity, token, timeout=None):
+        """
+        Wait up to timeout seconds for the message for a token from
+        identity (registering interest in it if need be), and remove it
+        from the registry. Raises concurrent.futures.TimeoutError if it
+        has not arrived.
+
+        """
+        with self._lock:
+            future = self._future(identity, token)
+        msg = future.result(timeout)
+        self.discard(identity, token)
+        return msg
+
+    def discard(self, identity, token):
+        """Forget the entry for a token from identity."""
+        with self._lock:
+            self._futures.pop((identity, token), None)
+            self._early.pop((identity, token), None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._futures)
+
+DEFAULT_DISPATCH_WORKERS = 4
+DEFAULT_DISPATCH_QUEUE_SIZE = 1000
+
+# Seconds between crawls of the components' capabilities (client-initiated)
+DEFAULT_CRAWL_INTERVAL = 5
+
+class MessageDispatcher(object):
+    """
+    Hands the messages a supervisor's client receives from components
+    to a handler function, from a pool of worker threads.
+
+    Each worker has its own bounded queue, and all messages from an
+    identity go to the same worker, so messages from one component are
+    handled in the order they arrived while different components are
+    handled in parallel. Used as the client's exporter: put() blocks
+    while the queue is full, put_nowait() raises queue.Full, which
+    HttpListenerClient turns into a 503 so the component retries later.
+
+    """
+    def __init__(self, handler, workers=DEFAULT_DISPATCH_WORKERS,
+                 queue_size=DEFAULT_DISPATCH_QUEUE_SIZE):
+        self._handler = handler
+        self._queues = [queue.Queue(maxsize=queue_size)
+                        for i in range(max(1, workers))]
+
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._wait_max = 0.0
+
+        self._workers = []
+        for q in self._queues:
+            t = Thread(target=self._work, args=(q,),
+                       name="dispatch-" + str(len(self._workers)))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _queue_for(self, identity):
+        return self._queues[hash(identity) % len(self._queues)]
+
+    def put(self, item, block=True, timeout=None):
+        """Queue a [message, identity] pair for handling."""
+        (msg, identity) = item
+        self._queue_for(identity).put((msg, identity, time.monotonic()),
+                                      block, timeout)
+
+    def put_nowait(self, item):
+        try:
+            self.put(item, block=False)
+        except queue.Full:
+            self._count("rejected")
+            raise
+
+    def room_for(self, identity, count):
+        """
+        Return True if count more messages from identity can be queued
+        without blocking (or, for more messages than a queue holds, if
+        the queue is empty).
+
+        """
+        q = self._queue_for(identity)
+        if q.maxsize <= 0:
+            return True
+        return q.maxsize - q.qsize() >= min(count, q.maxsize)
+
+    def stats(self):
+        """
+        Return a dictionary of dispatch counters, the number of messages
+        queued, and mean/max queue wait (seconds from put() to handling).
+
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            handled = stats.get("handled", 0)
+            total = stats.pop("wait_total", 0)
+            stats["wait_mean"] = total / handled if handled else 0.0
+            stats["wait_max"] = self._wait_max
+        stats["queue_depth"] = sum(q.qsize() for q in self._queues)
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def wait(self):
+        """Block the calling thread for as long as the workers run."""
+        for t in self._workers:
+            t.join()
+
+    def _work(self, q):
+        while True:
+            (msg, identity, queued_at) = q.get()
+            waited = time.monotonic() - queued_at
+            with self._stats_lock:
+                self._stats["handled"] += 1
+                self._stats["wait_total"] += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                self._handler(msg, identity)
+            except Exception as e:
+                print("Error handling " + repr(msg) + " from " + str(identity) + ": " + repr(e))
+                self._count("errors")
+            q.task_done()
+
 class RelayService(mplane.scheduler.Service):
 
-    def __init__(self, cap, identity, client, lock, messages):
+    def __init__(self, cap, identity, client, completions):
         self.relay = True
         self._identity = identity
         self._client = client
-        self._lock = lock
-        self._messages = messages
+        self._completions = completions
         super(RelayService, self).__init__(cap)
 
     def run(self, spec, check_interrupt):
@@ -49,25 +252,25 @@ class RelayService(mplane.scheduler.Service):
         trunc_pos = pattern.search(spec.get_label())
         trunc_label = spec.get_label()[:trunc_pos.start()]
         fwd_spec = self._client.invoke_capability(trunc_label, spec.when(), spec.parameter_values())
+        token = fwd_spec.get_token()
+        self._completions.expect(self._identity, token)
         result = None
         pending = False
         while result is None:
             if check_interrupt() and not pending:
-                self._client.interrupt_capability(fwd_spec.get_token())
+                self._client.interrupt_capability(token)
                 pending = True
-            sleep(1)
-            with self._lock:
-                if self._identity in self._messages:
-                    for msg in self._messages[self._identity]:
-                        if msg.get_token() == fwd_spec.get_token():
-                            if (isinstance(msg, mplane.model.Result) or
-                                isinstance(msg, mplane.model.Envelope)):
-                                print("Received result for " + trunc_label + " from " + self._identity)
-                            elif isinstance(msg, mplane.model.Exception):
-                                print("Received exception for " + trunc_label + " from " + self._identity)
-                            result = msg
-                            self._messages[self._identity].remove(msg)
-                            break
+            try:
+                result = self._completions.wait(self._identity, token,
+                                                timeout=RELAY_INTERRUPT_POLL)
+            except concurrent.futures.TimeoutError:
+                continue
+
+        if (isinstance(result, mplane.model.Result) or
+            isinstance(result, mplane.model.Envelope)):
+            print("Received result for " + trunc_label + " from " + self._identity)
+        elif isinstance(result, mplane.model.Exception):
+            print("Received exception for " + trunc_label + " from " + self._identity)
 
         if (not isinstance(result, mplane.model.Exception)
            and not isinstance(result, mplane.model.Envelope)):
@@ -81,6 +284,12 @@ class BaseSupervisor(object):
         self._caps = []
         self.config = config
 
+        # compiled registry cache
+        if "registry_cache" in config["component"]:
+            mplane.model.set_registry_cache(
+                config["component"]["registry_cache"],
+                offline=config["component"].getboolean("registry_offline", fallback=False))
+
         # preload any registries necessary
         if "registry_preload" in config["component"]:
             mplane.model.preload_registry(
@@ -93,11 +302,19 @@ class BaseSupervisor(object):
             registry_uri = None
         mplane.model.initialize_registry(registry_uri)
 
-        tls_state = mplane.tls.TlsState(config)
+        tls_state = mplane.tls.TlsState(
+            config,
+            num_pools=int(config["client"].get("connection-pools",
+                                               mplane.tls.POOL_NUM_POOLS)))
 
-        self.from_cli = queue.Queue()
-        self._lock = threading.RLock()
-        self._spec_messages = dict()
+        self._completions = CompletionRegistry()
+        self._caps_lock = threading.Lock()
+        self.from_cli = MessageDispatcher(
+            self.handle_message,
+            workers=int(config["client"].get("dispatch-workers",
+                                             DEFAULT_DISPATCH_WORKERS)),
+            queue_size=int(config["client"].get("dispatch-queue-size",
+                                                DEFAULT_DISPATCH_QUEUE_SIZE)))
         self._io_loop = tornado.ioloop.IOLoop.instance()
         if self.config["client"]["workflow"] == "component-initiated":
             self.cli_workflow = "component-initiated"
@@ -107,15 +324,21 @@ class BaseSupervisor(object):
                                                             io_loop=self._io_loop)
         elif self.config["client"]["workflow"] == "client-initiated":
             self.cli_workflow = "client-initiated"
-            self._client = mplane.client.HttpInitiatorClient(tls_state=tls_state, supervisor=True,
+            self._client = mplane.client.HttpInitiatorClient(config=config,
+                                                             tls_state=tls_state, supervisor=True,
                                                              exporter=self.from_cli)
             self._urls = self.config["client"]["component-urls"].split(",")
+            self._crawl_interval = float(config["client"].get("crawl-interval",
+                                                              DEFAULT_CRAWL_INTERVAL))
         else:
             raise ValueError("workflow setting in " + args.CONF + " can only be 'client-initiated' or 'component-initiated'")
 
         if self.config["component"]["workflow"] == "component-initiated":
             self.comp_workflow = "component-initiated"
-            self._component = mplane.component.InitiatorHttpComponent(config, supervisor=True)
+            if self.config["component"].get("transport", "http") == "websocket":
+                self._component = mplane.component.InitiatorWebSocketComponent(config, supervisor=True)
+            else:
+                self._component = mplane.component.InitiatorHttpComponent(config, supervisor=True)
         elif self.config["component"]["workflow"] == "client-initiated":
             self.comp_workflow = "client-initiated"
             self._component = mplane.component.ListenerHttpComponent(config, io_loop=self._io_loop)
@@ -133,31 +356,35 @@ class BaseSupervisor(object):
             t_poll = Thread(target=self.poll_in_background)
             t_poll.daemon = True
             t_poll.start()
-        while True:
-            if not self.from_cli.empty():
-                [msg, identity] = self.from_cli.get()
-                self.handle_message(msg, identity)
-            sleep(0.1)
+        # messages are handled by the dispatcher's workers
+        self.from_cli.wait()
 
     def handle_message(self, msg, identity):
+        """
+        Handle a message received by the client. Called from the
+        dispatcher's worker threads, so possibly concurrently for
+        messages from different identities.
+
+        """
         if isinstance(msg, mplane.model.Capability):
-            if [msg.get_label(), identity] not in self._caps:
+            with self._caps_lock:
+                if [msg.get_label(), identity] in self._caps:
+                    return
                 self._caps.append([msg.get_label(), identity])
                 serv = RelayService(msg, identity, self._client,
-                                    self._lock, self._spec_messages)
+                                    self._completions)
                 if self.comp_workflow == "client-initiated":
                     serv.set_capability_link(self.config["component"]["listen-cap-link"])
                 self._component.scheduler.add_service(serv)
-                if self.comp_workflow == "component-initiated":
-                    self._component.register_to_client([serv.capability()])
+            if self.comp_workflow == "component-initiated":
+                self._component.register_to_client([serv.capability()])
 
         elif isinstance(msg, mplane.model.Receipt):
             pass
             
         elif (isinstance(msg, mplane.model.Result) or
             isinstance(msg, mplane.model.Exception)):
-            with self._lock:
-                mplane.utils.add_value_to(self._spec_messages, identity, msg)
+            self._completions.resolve(identity, msg)
             
         elif isinstance(msg, mplane.model.Withdrawal):
             # not yet implemented
@@ -166,7 +393,7 @@ class BaseSupervisor(object):
         elif isinstance(msg, mplane.model.Envelope):
             for imsg in msg.messages():
                 if isinstance(imsg, mplane.model.Result):
-                    mplane.utils.add_value_to(self._spec_messages, identity, msg)
+                    self._completions.resolve(identity, msg)
                     break
                 else:
                     self.handle_message(imsg, identity)
@@ -178,25 +405,21 @@ class BaseSupervisor(object):
         self._io_loop.start()
 
     def poll_in_background(self):
-        """ Periodically poll components """
-        while True:
-            for url in self._urls:
-                try:
-                    self._client.retrieve_capabilities(url)
-                except:
-                    print(str(url) + " unreachable. Retrying in 5 seconds")
-
-            # poll for results
-            for label in self._client.receipt_labels():
-                self._client.result_for(label)
-
-            for token in self._client.receipt_tokens():
-                self._client.result_for(token)
+        """
+        Periodically crawl components for capabilities, and redeem
+        outstanding receipts as they come due.
 
-            for label in self._client.result_labels():
-                self._client.result_for(label)
-
-            for token in self._client.result_tokens():
-                self._client.result_for(token)
+        """
+        next_crawl = 0
+        while True:
+            if time.monotonic() >= next_crawl:
+                for url in self._urls:
+                    try:
+                        self._client.retrieve_capabilities(url)
+                    except:
+                        print(str(url) + " unreachable. Retrying in " +
+                              str(self._crawl_interval) + " seconds")
+                next_crawl = time.monotonic() + self._crawl_interval
 
-            sleep(5)
\ No newline at end of file
+            self._client.redeem_due()
+            self._client.wait_for_redemptions(next_crawl - time.monotonic())
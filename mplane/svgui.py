@@ -23,9 +23,9 @@ import traceback
 import urllib3
 import argparse
 import configparser
+import time
 from time import sleep
 
-import queue
 import re
 import tornado.web
 from time import sleep
@@ -38,6 +38,7 @@ import mplane.tls
 import mplane.utils
 import mplane.client
 import mplane.component
+import mplane.supervisor
 import mplane.svgui_handlers
 
 DUMMY_DN = "Identity.Unauthenticated.Default"
@@ -66,48 +67,6 @@ GUI_LISTPENDINGS_PATH = "gui/list/pendings"
 GUI_LISTRESULTS_PATH = "gui/list/results"
 GUI_GETRESULT_PATH = "gui/get/result"
 
-class RelayService(mplane.scheduler.Service):
-
-    def __init__(self, cap, identity, client, lock, messages):
-        self.relay = True
-        self._identity = identity
-        self._client = client
-        self._lock = lock
-        self._messages = messages
-        super(RelayService, self).__init__(cap)
-
-    def run(self, spec, check_interrupt):
-        pattern = re.compile("-\d+$")
-        trunc_pos = pattern.search(spec.get_label())
-        trunc_label = spec.get_label()[:trunc_pos.start()]
-        fwd_spec = self._client.invoke_capability(trunc_label, spec.when(), spec.parameter_values())
-        result = None
-        pending = False
-        while result is None:
-            if check_interrupt() and not pending:
-                self._client.interrupt_capability(fwd_spec.get_token())
-                pending = True
-            sleep(1)
-            with self._lock:
-                if self._identity in self._messages:
-                    for msg in self._messages[self._identity]:
-                        if msg.get_token() == fwd_spec.get_token():
-                            if (isinstance(msg, mplane.model.Result) or
-                                isinstance(msg, mplane.model.Envelope)):
-                                print("Received result for " + trunc_label + " from " + self._identity)
-                            elif isinstance(msg, mplane.model.Exception):
-                                print("Received exception for " + trunc_label + " from " + self._identity)
-                            result = msg
-                            self._messages[self._identity].remove(msg)
-                            break
-
-        if (not isinstance(result, mplane.model.Exception)
-           and not isinstance(result, mplane.model.Envelope)):
-            result.set_label(spec.get_label())
-        result.set_token(spec.get_token())
-        return result
-
-
 class ClientShell(cmd.Cmd):
 
     intro = 'mPlane client shell (rev 20.1.2015, sdk branch)\n'\
@@ -136,6 +95,12 @@ class ClientShell(cmd.Cmd):
         # don't print tracebacks by default
         self._print_tracebacks = False
 
+        # compiled registry cache
+        if "registry_cache" in config["component"]:
+            mplane.model.set_registry_cache(
+                config["component"]["registry_cache"],
+                offline=config["component"].getboolean("registry_offline", fallback=False))
+
         # preload any registries necessary
         # from_begin supervisor
         # preload any registries necessary
@@ -161,7 +126,10 @@ class ClientShell(cmd.Cmd):
         #? kell ez? from svgui/clientshell
         super().__init__()
         
-        tls_state = mplane.tls.TlsState(config)
+        tls_state = mplane.tls.TlsState(
+            config,
+            num_pools=int(config["client"].get("connection-pools",
+                                               mplane.tls.POOL_NUM_POOLS)))
         # tls_state.onesided_https = True;
 
         # default workflow is client-initiated
@@ -170,9 +138,14 @@ class ClientShell(cmd.Cmd):
 
         # from_begin supervisor.py
         
-        self.from_cli = queue.Queue()
-        self._lock = threading.RLock()
-        self._spec_messages = dict()
+        self._completions = mplane.supervisor.CompletionRegistry()
+        self._caps_lock = threading.Lock()
+        self.from_cli = mplane.supervisor.MessageDispatcher(
+            self.handle_message,
+            workers=int(config["client"].get("dispatch-workers",
+                                             mplane.supervisor.DEFAULT_DISPATCH_WORKERS)),
+            queue_size=int(config["client"].get("dispatch-queue-size",
+                                                mplane.supervisor.DEFAULT_DISPATCH_QUEUE_SIZE)))
         self._io_loop = tornado.ioloop.IOLoop.instance()
         
         if self.config["client"]["workflow"] == "component-initiated":
@@ -183,15 +156,21 @@ class ClientShell(cmd.Cmd):
                                                             io_loop=self._io_loop)
         elif self.config["client"]["workflow"] == "client-initiated":
             self.cli_workflow = "client-initiated"
-            self._client = mplane.client.HttpInitiatorClient(tls_state=tls_state, supervisor=True,
+            self._client = mplane.client.HttpInitiatorClient(config=config,
+                                                             tls_state=tls_state, supervisor=True,
                                                              exporter=self.from_cli)
             self._urls = self.config["client"]["component-urls"].split(",")
+            self._crawl_interval = float(config["client"].get("crawl-interval",
+                                         mplane.supervisor.DEFAULT_CRAWL_INTERVAL))
         else:
             raise ValueError("workflow setting in " + args.CONF + " can only be 'client-initiated' or 'component-initiated'")
 
         if self.config["component"]["workflow"] == "component-initiated":
             self.comp_workflow = "component-initiated"
-            self._component = mplane.component.InitiatorHttpComponent(config, supervisor=True)
+            if self.config["component"].get("transport", "http") == "websocket":
+                self._component = mplane.component.InitiatorWebSocketComponent(config, supervisor=True)
+            else:
+                self._component = mplane.component.InitiatorHttpComponent(config, supervisor=True)
         elif self.config["component"]["workflow"] == "client-initiated":
             self.comp_workflow = "client-initiated"
             self._component = mplane.component.ListenerHttpComponent(config, io_loop=self._io_loop)
@@ -223,31 +202,30 @@ class ClientShell(cmd.Cmd):
             t_poll = Thread(target=self.poll_in_background)
             t_poll.daemon = True
             t_poll.start()
-        while True:
-            if not self.from_cli.empty():
-                [msg, identity] = self.from_cli.get()
-                self.handle_message(msg, identity)
-            sleep(0.1)
+        # messages are handled by the dispatcher's workers
+        self.from_cli.wait()
 
     def handle_message(self, msg, identity):
+        # called from the dispatcher's worker threads
         if isinstance(msg, mplane.model.Capability):
-            if [msg.get_label(), identity] not in self._caps:
+            with self._caps_lock:
+                if [msg.get_label(), identity] in self._caps:
+                    return
                 self._caps.append([msg.get_label(), identity])
-                serv = RelayService(msg, identity, self._client,
-                                    self._lock, self._spec_messages)
+                serv = mplane.supervisor.RelayService(msg, identity, self._client,
+                                                      self._completions)
                 if self.comp_workflow == "client-initiated":
                     serv.set_capability_link(self.config["component"]["listen-cap-link"])
                 self._component.scheduler.add_service(serv)
-                if self.comp_workflow == "component-initiated":
-                    self._component.register_to_client([serv.capability()])
+            if self.comp_workflow == "component-initiated":
+                self._component.register_to_client([serv.capability()])
 
         elif isinstance(msg, mplane.model.Receipt):
             pass
             
         elif (isinstance(msg, mplane.model.Result) or
             isinstance(msg, mplane.model.Exception)):
-            with self._lock:
-                mplane.utils.add_value_to(self._spec_messages, identity, msg)
+            self._completions.resolve(identity, msg)
             
         elif isinstance(msg, mplane.model.Withdrawal):
             # not yet implemented
@@ -256,7 +234,7 @@ class ClientShell(cmd.Cmd):
         elif isinstance(msg, mplane.model.Envelope):
             for imsg in msg.messages():
                 if isinstance(imsg, mplane.model.Result):
-                    mplane.utils.add_value_to(self._spec_messages, identity, msg)
+                    self._completions.resolve(identity, msg)
                     break
                 else:
                     self.handle_message(imsg, identity)
@@ -268,28 +246,24 @@ class ClientShell(cmd.Cmd):
         self._io_loop.start()
 
     def poll_in_background(self):
-        """ Periodically poll components """
-        while True:
-            for url in self._urls:
-                try:
-                    self._client.retrieve_capabilities(url)
-                except:
-                    print(str(url) + " unreachable. Retrying in 5 seconds")
-
-            # poll for results
-            for label in self._client.receipt_labels():
-                self._client.result_for(label)
-
-            for token in self._client.receipt_tokens():
-                self._client.result_for(token)
-
-            for label in self._client.result_labels():
-                self._client.result_for(label)
-
-            for token in self._client.result_tokens():
-                self._client.result_for(token)
+        """
+        Periodically crawl components for capabilities, and redeem
+        outstanding receipts as they come due.
 
-            sleep(5)                                                            
+        """
+        next_crawl = 0
+        while True:
+            if time.monotonic() >= next_crawl:
+                for url in self._urls:
+                    try:
+                        self._client.retrieve_capabilities(url)
+                    except:
+                        print(str(url) + " unreachable. Retrying in " +
+                              str(self._crawl_interval) + " seconds")
+                next_crawl = time.monotonic() + self._crawl_interval
+
+            self._client.redeem_due()
+            self._client.wait_for_redemptions(next_crawl - time.monotonic())
                                                             
     """
     this is ClientShell stuff
@@ -359,21 +359,11 @@ def filterlist(self, reguri=None):
     _filterlist = {}
     _qlist = self.request.arguments
     
-    _uri = reguri
-    _r = mplane.model.Registry(_uri)
-    _regjson = _r._dump_json()
+    # registries are cached by the model, don't parse one per request
+    _r = mplane.model.registry_for_uri(reguri)
     for _qname in self.request.arguments:
-        # print( _qname + ": " + self.get_query_argument( _qname, None, True ) )
-        found = False
-        for _name in _r._elements:
-            # print( "compare against " + str( _name ), end="")
-            if found == False:
-                if ( _name == _qname ):
-                    _filterlist.update( { _qname: self.get_argument( _qname, default=None ) } )
-                    found = True
-                    # print( _qname + " FOUND, filterlist = " + str(_filterlist))
-            else:
-                break
+        if _qname in _r._elements:
+            _filterlist.update( { _qname: self.get_argument( _qname, default=None ) } )
     # print("filterlist: " + str( _filterlist) )
     # !!!!! HACK IS HERE !!!!!
     del _filterlist["start"]
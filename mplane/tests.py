@@ -28,15 +28,35 @@ from nose.tools import *
 from mplane import azn
 from mplane import tls
 from mplane import model
+from mplane import client
 from mplane import scheduler
+from mplane import component
+from mplane import spool
+from mplane import exporter
 from mplane import utils
+from mplane import supervisor
+from mplane import timeindex
+from mplane.components import ping
+from mplane.components import repository
+import asyncio
+import concurrent.futures
 import configparser
+import io
+import os
+import gzip
+import tempfile
+from datetime import datetime
+from ipaddress import ip_network
 from os import path
 
+import tornado.gen
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.testing
 import tornado.web
 import threading
+import queue
 import urllib3
 import time
 import ssl
@@ -87,6 +107,24 @@ def test_AuthorizationOn():
     assert_false(res.check(cap, id_false_role))
 
 
+def test_AuthorizationOn_labels():
+    model.initialize_registry()
+    config = get_config(config_path)
+    res = azn.AuthorizationOn(config)
+    # labels with a serial number suffix match the authorized label
+    cap = model.Capability(label="test-log_tcp_complete-end_to_end-3")
+    assert_true(res.check(cap, id_true_role))
+    assert_true(res.check(cap, "org.mplane.SSB.Supervisors.Supervisor-1"))
+    cap = model.Capability(label="test-log_tcp_complete-unknown")
+    assert_false(res.check(cap, id_true_role))
+    # cached decisions are dropped on reload
+    config["Authorizations"]["test-log_tcp_complete-end_to_end"] = "admin"
+    res.reload(config)
+    cap = model.Capability(label="test-log_tcp_complete-end_to_end-3")
+    assert_false(res.check(cap, id_true_role))
+    assert_true(res.check(cap, "org.mplane.SSB.Supervisors.Supervisor-1"))
+
+
 def test_AuthorizationOff():
     model.initialize_registry()
     cap = model.Capability(label="test-log_tcp_complete-core")
@@ -140,6 +178,26 @@ def test_TLSState_pool_for_no_scheme():
     assert_true(isinstance(http_pool, urllib3.HTTPConnectionPool))
 
 
+def test_TLSState_pool_for_bounded():
+    state = tls.TlsState(config=get_config(config_path_no_tls), num_pools=2)
+    first_pool = state.pool_for("http", host, 8001)
+    assert_true(state.pool_for("http", host, 8001) is first_pool)
+    state.pool_for("http", host, 8002)
+    state.pool_for("http", host, 8003)
+    assert_equal(state.connection_stats()["pools_evicted"], 1)
+    assert_false(state.pool_for("http", host, 8001) is first_pool)
+
+def test_TLSState_pool_for_evicted():
+    state = tls.TlsState(config=get_config(config_path_no_tls), num_pools=1)
+    first_pool = state.pool_for("http", host, 8001)
+    state.pool_for("http", host, 8002)
+    assert_equal(state.connection_stats()["pools_evicted"], 1)
+    # a caller still holding an evicted pool can keep using it
+    conn = first_pool._get_conn()
+    first_pool._put_conn(conn)
+    assert_true(first_pool.pool is not None)
+
+
 @raises(ValueError)
 def test_TLSState_pool_for_fallback():
     fallback_http_pool = tls_with_file_no_tls.pool_for("https", host, port)
@@ -172,6 +230,20 @@ def test_TLSState_get_ssl_options():
     assert_equal(tls_with_file_no_tls.get_ssl_options(), None)
 
 
+def test_TLSState_client_ssl_context():
+    state = tls.TlsState(config=get_config(config_path))
+    # the test certificates are signed with a digest too weak to load
+    state._load_client_context = lambda context: context
+    # urllib3 matches hostnames itself, Tornado needs the context to
+    context = state.client_ssl_context()
+    assert_false(context.check_hostname)
+    assert_true(state.client_ssl_context() is context)
+    context = state.client_ssl_context(check_hostname=True)
+    assert_true(context.check_hostname)
+    assert_true(state.client_ssl_context(check_hostname=True) is context)
+    assert_equal(tls_with_file_no_tls.client_ssl_context(check_hostname=True), None)
+
+
 def test_TLSState_extract_local_identity():
     local_identity = tls_with_file.extract_local_identity()
     assert_equal(local_identity, identity)
@@ -182,6 +254,20 @@ def test_TLSState_extract_local_identity():
     assert_equal(local_identity, forged_identity)
 
 
+def test_TLSState_peer_identity_cache():
+    peer_url = urllib3.util.url.parse_url("https://peer.example.org:8443")
+    peer_cert = {'subject': ((('organizationName', 'org'),),
+                             (('commonName', 'Peer-1'),))}
+    state = tls.TlsState(config=get_config(config_path))
+    # a remembered identity is returned without connecting
+    state._remember_peer(("peer.example.org", 8443), peer_cert)
+    assert_equal(state.extract_peer_identity(peer_url), "org.Peer-1")
+    # expired identities are dropped
+    state._peer_identity_ttl = -1
+    state._remember_peer(("peer.example.org", 8443), peer_cert)
+    assert_equal(state._cached_peer_identity(("peer.example.org", 8443)), None)
+
+
 s_cert = utils.search_path(path.join(conf_dir, "Supervisor-SSB.crt"))
 s_key = utils.search_path(path.join(conf_dir, "Supervisor-SSB-plaintext.key"))
 s_ca_chain = utils.search_path(path.join(conf_dir, "root-ca.crt"))
@@ -380,6 +466,830 @@ def test_Job_get_reply_failed():
     # Job has failed.
     assert_true(isinstance(job_failure.get_reply(), model.Exception))
 
+def test_Scheduler_envelope():
+    sched = scheduler.Scheduler()
+    sched.add_service(SchedulerTestService(st_cap))
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    receipt = sched.process_message(None, spec)
+    job = sched.job_for_message(receipt)
+    for i in range(50):
+        if job.finished():
+            break
+        time.sleep(0.1)
+
+    # redemptions in one envelope get their replies in one envelope
+    env = model.Envelope()
+    env.append_message(model.Redemption(receipt=receipt))
+    env.append_message(model.Redemption(receipt=st_receipt))
+    reply = sched.process_message(None, env)
+    assert_true(isinstance(reply, model.Envelope))
+    replies = list(reply.messages())
+    assert_equal(len(replies), 2)
+    assert_equal(replies[0], st_res)
+    assert_true(isinstance(replies[1], model.Exception))
+    assert_equal(replies[1].get_token(), st_receipt.get_token())
+
+def test_Scheduler_job_store():
+    config = configparser.ConfigParser()
+    config["component"] = {"job_dir": tempfile.mkdtemp()}
+    # two processes of one component, sharing their jobs
+    scheds = [scheduler.Scheduler(config), scheduler.Scheduler(config)]
+    for sched in scheds:
+        sched.add_service(SchedulerTestService(st_cap))
+
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.3")
+    receipt = scheds[0].process_message(None, spec)
+    assert_true(isinstance(scheds[1].submit_job(None, spec), model.Receipt))
+    assert_equal(len(scheds[1].jobs), 0)
+    store = scheduler.JobStore(config["component"]["job_dir"])
+    for i in range(50):
+        if isinstance(store.get(receipt.get_token()), model.Result):
+            break
+        time.sleep(0.1)
+
+    reply = scheds[1].process_message(None, model.Redemption(receipt=receipt))
+    assert_equal(reply.get_token(), st_res.get_token())
+    # the result was handed out, so the job is gone from the store,
+    # and from the process which ran it
+    reply = scheds[1].process_message(None, model.Redemption(receipt=receipt))
+    assert_true(isinstance(reply, model.Exception))
+    reply = scheds[0].process_message(None, model.Redemption(receipt=receipt))
+    assert_true(isinstance(reply, model.Exception))
+    assert_equal(len(scheds[0].jobs), 0)
+
+    # which also forgets such jobs without being asked for them
+    spec.set_parameter_value("destination.ip4", "10.0.37.4")
+    other = scheds[0].process_message(None, spec)
+    while not scheds[0].jobs[other.get_token()].finished():
+        time.sleep(0.1)
+    store.remove(other.get_token())
+    scheds[0].prune_jobs()
+    assert_equal(len(scheds[0].jobs), 0)
+
+    # of two processes getting a specification at once, only one runs it
+    spec.set_parameter_value("destination.ip4", "10.0.37.6")
+    token = model.Receipt(specification=spec).get_token()
+    assert_true(store.claim(token))
+    assert_false(store.claim(token))
+    assert_true(isinstance(scheds[0].submit_job(None, spec), model.Receipt))
+    assert_false(token in scheds[0].jobs)
+    store.remove(token)
+    assert_true(store.claim(token))
+    assert_false(store.claim("../" + token))
+    store.remove(token)
+
+    # interrupts reach jobs in the other process
+    store.put(receipt.get_token(), receipt)
+    interrupted = scheduler.Job(service, spec, job_store=store)
+    assert_false(interrupted._check_interrupt())
+    scheds[1].process_message(None, model.Interrupt(specification=receipt))
+    assert_true(interrupted._check_interrupt())
+    assert_equal(store.get("../" + receipt.get_token()), None)
+
+def test_MessagePostHandler_job_store():
+    config = configparser.ConfigParser()
+    config["component"] = {"job_dir": tempfile.mkdtemp()}
+    scheds = [scheduler.Scheduler(config), scheduler.Scheduler(config)]
+    for sched in scheds:
+        sched.add_service(SchedulerTestService(st_cap))
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.5")
+    receipt = scheds[0].process_message(None, spec)
+
+    # the same specification reaches the other process over HTTP
+    (sock, port) = tornado.testing.bind_unused_port()
+    application = tornado.web.Application([
+        (r"/", component.MessagePostHandler,
+         {'scheduler': scheds[1], 'tlsState': tls.TlsState(config)})])
+
+    @tornado.gen.coroutine
+    def post():
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets([sock])
+        http = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        res = yield http.fetch("http://127.0.0.1:%d/" % port, method="POST",
+                               headers={"Content-Type": "application/x-mplane+json"},
+                               body=model.unparse_json(spec), raise_error=False)
+        http.close()
+        server.stop()
+        return res
+
+    loop = tornado.ioloop.IOLoop()
+    res = loop.run_sync(post)
+    loop.close()
+    # answered with the receipt, without waiting for the job
+    assert_equal(res.code, 200)
+    reply = model.parse_json(res.body.decode("utf-8"))
+    assert_true(isinstance(reply, model.Receipt))
+    assert_equal(reply.get_token(), receipt.get_token())
+
+class ThreadTestScheduler(scheduler.Scheduler):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def process_message(self, user, msg, session=None, callback=None):
+        self.threads.append(("process", threading.current_thread().name))
+        return super().process_message(user, msg, session, callback)
+
+    def collect(self, user, msg):
+        self.threads.append(("collect", threading.current_thread().name))
+        return None
+
+def test_MessagePostHandler_off_loop():
+    sched = ThreadTestScheduler()
+    sched.add_service(SchedulerTestService(st_cap))
+    (sock, port) = tornado.testing.bind_unused_port()
+    application = tornado.web.Application([
+        (r"/", component.MessagePostHandler,
+         {'scheduler': sched, 'tlsState': tls.TlsState(configparser.ConfigParser()),
+          'immediate_ms': 0, 'parse_inline_max': 0})])
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.6")
+    specs = model.Envelope()
+    specs.append_message(spec)
+    results = model.Envelope()
+    results.append_message(st_res)
+
+    @tornado.gen.coroutine
+    def post():
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets([sock])
+        http = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        codes = []
+        for env in (specs, results):
+            res = yield http.fetch("http://127.0.0.1:%d/" % port, method="POST",
+                                   headers={"Content-Type": "application/x-mplane+json"},
+                                   body=model.unparse_json(env), raise_error=False)
+            codes.append(res.code)
+        http.close()
+        server.stop()
+        return codes
+
+    loop = tornado.ioloop.IOLoop()
+    assert_equal(loop.run_sync(post), [200, 200])
+    loop.close()
+    # jobs are only handled on the IOLoop; results are collected off it
+    assert_equal(sched.threads[0], ("process", threading.current_thread().name))
+    assert_equal(sched.threads[-1][0], "collect")
+    assert_true(sched.threads[-1][1].startswith("mplane-parse"))
+
+def test_Scheduler_capability_envelope():
+    sched = scheduler.Scheduler()
+    sched.add_service(SchedulerTestService(st_cap))
+    (body, etag) = sched.capability_envelope(None)
+    env = model.parse_json(body.decode("utf-8"))
+    assert_true(isinstance(env, model.Envelope))
+    assert_equal([cap.get_token() for cap in env.messages()], [st_cap.get_token()])
+    assert_true(sched.capability_envelope(None)[0] is body)
+
+    # a new service changes the envelope
+    cap = create_test_capability()
+    cap.set_when("now ... future / 5s")
+    sched.add_service(SchedulerTestService(cap))
+    (body, new_etag) = sched.capability_envelope(None)
+    assert_not_equal(new_etag, etag)
+    assert_equal(len(model.parse_json(body.decode("utf-8"))), 2)
+
+    # serialized capabilities follow changes to their links
+    serv = sched.services[-1]
+    serv.set_capability_link("http://127.0.0.1:8888/")
+    cap_json = sched.capability_json(cap.get_token()).decode("utf-8")
+    assert_equal(model.parse_json(cap_json).get_link(), "http://127.0.0.1:8888/")
+    assert_not_equal(sched.capability_envelope(None)[1], new_etag)
+
+# Indirect export tests:
+
+class ExportTestExporter(exporter.Exporter):
+    def __init__(self, export, tls_state=None):
+        super().__init__(export, tls_state)
+        self.exported = []
+
+    def export(self, msg):
+        self.exported.append(msg)
+
+exporter.register_exporter("test-export", ExportTestExporter)
+
+def test_Scheduler_export():
+    cap = create_test_capability()
+    cap.set_export("test-export")
+    sched = scheduler.Scheduler()
+    sched.add_service(SchedulerTestService(cap))
+
+    # specifications without a matching export section don't match
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    assert_false(spec.fulfills(cap))
+
+    spec = model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    spec.set_export("test-export://collector.example.com/result")
+    assert_true(spec.fulfills(cap))
+    assert_false(spec.fulfills(st_cap))
+
+    reply = sched.process_message(None, spec)
+    assert_true(isinstance(reply, model.Receipt))
+    job = sched.job_for_message(reply)
+    for i in range(50):
+        if job.finished():
+            break
+        time.sleep(0.1)
+    # the result went to the exporter; the job only ever returns a receipt
+    exp = exporter.exporter_for("test-export://collector.example.com/result")
+    assert_equal(exp.exported, [st_res])
+    assert_true(isinstance(job.get_reply(), model.Receipt))
+
+    # with several processes, another one hands out the final receipt
+    config = configparser.ConfigParser()
+    config["component"] = {"job_dir": tempfile.mkdtemp()}
+    scheds = [scheduler.Scheduler(config), scheduler.Scheduler(config)]
+    for s in scheds:
+        s.add_service(SchedulerTestService(cap))
+    spec.set_parameter_value("destination.ip4", "10.0.37.3")
+    reply = scheds[0].process_message(None, spec)
+    job = scheds[0].job_for_message(reply)
+    store = scheduler.JobStore(config["component"]["job_dir"])
+    for i in range(50):
+        if store.finished(reply.get_token()):
+            break
+        time.sleep(0.1)
+    assert_true(job.finished())
+    assert_true(isinstance(scheds[1].process_message(None, model.Redemption(receipt=reply)),
+                           model.Receipt))
+    assert_false(store.holds(reply.get_token()))
+    scheds[0].prune_jobs()
+    assert_equal(len(scheds[0].jobs), 0)
+
+    # unknown export protocols are refused
+    cap.set_export("nonesuch")
+    spec.set_export("nonesuch://collector.example.com/")
+    assert_true(isinstance(sched.submit_job(None, spec), model.Exception))
+
+def test_HttpsExporter():
+    pool = UploadTestPool([200])
+    pool.release.set()
+    exp = exporter.HttpsExporter("mplane-https://127.0.0.1:4343/collect",
+                                 tls_state=UploadTestTls(pool), flush_interval=0.5)
+    for i in range(3):
+        exp.export(st_res)
+    exp.flush()
+    (path, env) = pool.posts[0]
+    assert_equal(path, "/collect")
+    assert_equal(len(env), 3)
+    assert_equal(exp.stats()["delivered"], 3)
+
+def test_TimeIndex():
+    idx = timeindex.TimeIndex()
+    key = timeindex.index_key("schema", {"destination.ip4": "10.0.37.2"})
+    idx.add(key, 100, 199, "a")
+    idx.add(key, 300, 399, "c")
+    # a long block starting early overlaps everything after it
+    idx.add(key, 50, 1000, "long")
+    idx.add(key, 200, 299, "b")
+    assert_equal([b for (tmin, tmax, b) in idx.blocks(key, 250, 320)], ["long", "b", "c"])
+    assert_equal([b for (tmin, tmax, b) in idx.blocks(key, 1001, None)], [])
+    idx.grow(key, 450)
+    assert_equal([b for (tmin, tmax, b) in idx.blocks(key, 420, 430)], ["long", "c"])
+    assert_equal(list(idx.keys("schema", {"destination.ip4": "10.0.37.3"})), [])
+    assert_equal(list(idx.keys("schema", {})), [key])
+    assert_equal(timeindex.find_rows(list(range(0, 100, 10)), 15, 50), (2, 6))
+
+def test_repository():
+    probe_cap = ping.ping4_aggregate_capability("10.0.27.2")
+    sched = scheduler.Scheduler()
+    store_dir = tempfile.mkdtemp()
+    for service in repository.services(store_dir, "mplane-https://127.0.0.1:4343/"):
+        sched.add_service(service)
+
+    # results exported from two probes over two hours arrive together
+    env = model.Envelope()
+    for (dest, start, mean) in (("10.0.37.2", "2016-05-01 10:00:00", 100),
+                                ("10.0.37.3", "2016-05-01 10:30:00", 200),
+                                ("10.0.37.2", "2016-05-01 11:00:00", 300)):
+        spec = model.Specification(capability=probe_cap)
+        spec.set_parameter_value("destination.ip4", dest)
+        res = model.Result(specification=spec)
+        res.set_when(start + " ... " + start[:-5] + "01:00")
+        res.set_result_value("delay.twoway.icmp.us.min", mean - 10)
+        res.set_result_value("delay.twoway.icmp.us.mean", mean)
+        res.set_result_value("delay.twoway.icmp.us.max", mean + 10)
+        res.set_result_value("delay.twoway.icmp.count", 60)
+        env.append_message(res)
+    assert_equal(sched.process_message(None, env), None)
+
+    query_cap = [cap for cap in map(sched.capability_for_key, sched.capability_keys())
+                 if cap.get_label() == "ping-average-ip4-query"][0]
+    query_service = [s for s in sched.services if s.capability() is query_cap][0]
+    spec = model.Specification(capability=query_cap)
+    spec.set_parameter_value("source.ip4", "10.0.27.2")
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    spec.set_when("2016-05-01 09:00:00 ... 2016-06-01 12:00:00")
+    res = query_service.run(spec, lambda: False)
+    assert_equal([row["delay.twoway.icmp.us.mean"] for row in res.schema_dict_iterator()],
+                 [100, 300])
+    assert_equal(res.when().datetimes()[0], datetime(2016, 5, 1, 10, 0, 0))
+
+    spec.set_when("2016-05-01 10:15:00 ... 2016-06-01 12:00:00", force=True)
+    res = query_service.run(spec, lambda: False)
+    assert_equal(res.count_result_rows(), 1)
+    spec.set_parameter_value("destination.ip4", "10.0.37.9")
+    assert_equal(query_service.run(spec, lambda: False).count_result_rows(), 0)
+
+    # the index is rebuilt from disk
+    store = repository.ColumnarStore(store_dir)
+    values = store.query(query_service._schema, columns=["destination.ip4", "time"])
+    assert_equal(sorted(map(str, values["destination.ip4"])),
+                 ["10.0.37.2", "10.0.37.2", "10.0.37.3"])
+
+    # parameters and address columns can be matched against networks
+    values = store.query(query_service._schema, columns=["destination.ip4"],
+                         predicates={"destination.ip4": ip_network("10.0.37.3/32")})
+    assert_equal(list(map(str, values["destination.ip4"])), ["10.0.37.3"])
+    assert_raises(ValueError, store.query, query_service._schema,
+                  predicates={"delay.twoway.icmp.us.mean": ip_network("10.0.0.0/8")})
+
+    cap = model.Capability()
+    cap.set_when("past ... now")
+    cap.add_parameter("source.ip4", "10.0.27.2")
+    cap.add_result_column("time")
+    cap.add_result_column("destination.ip4")
+    cap.add_result_column("delay.twoway.icmp.us")
+    schema = store.add_schema(cap)
+    res = model.Result(specification=model.Specification(capability=cap))
+    res.set_when("2016-05-01 10:00:00 ... 2016-05-01 10:00:03")
+    for (i, dest) in enumerate(("10.0.37.2", "192.0.2.1", "10.0.38.2", "10.0.37.9")):
+        res.set_result_value("time", "2016-05-01 10:00:0" + str(i), i)
+        res.set_result_value("destination.ip4", dest, i)
+        res.set_result_value("delay.twoway.icmp.us", i, i)
+    assert_equal(store.append(res), 4)
+    values = store.query(schema, columns=["delay.twoway.icmp.us"],
+                         predicates={"destination.ip4": ip_network("10.0.37.0/24"),
+                                     "source.ip4": ip_network("10.0.0.0/8")})
+    assert_equal(values["delay.twoway.icmp.us"], [0, 3])
+    values = store.query(schema, columns=["delay.twoway.icmp.us"],
+                         predicates={"destination.ip4": ip_network("10.0.0.0/8"),
+                                     "delay.twoway.icmp.us": 2})
+    assert_equal(values["delay.twoway.icmp.us"], [2])
+
+def test_repository_schemas():
+    cap = create_test_capability()
+    cap.set_label("test-probe")
+    env = model.Envelope()
+    env.append_message(cap)
+    schemas = path.join(tempfile.mkdtemp(), "schemas.json")
+    with open(schemas, "w") as f:
+        f.write(model.unparse_json(env))
+
+    services = repository.services(tempfile.mkdtemp(), "mplane-https://127.0.0.1:4343/",
+                                   schemas=schemas)
+    assert_equal([s.capability().get_label() for s in services],
+                 ["test-probe-collect", "test-probe-query"])
+    assert_equal(list(services[0].capability().result_column_names()),
+                 list(cap.result_column_names()))
+
+#
+# supervisor tests
+#
+
+class RelayTestClient(object):
+    def __init__(self, completions):
+        self.completions = completions
+
+    def invoke_capability(self, label, when, params):
+        res = model.parse_json(model.unparse_json(st_res))
+        threading.Timer(0.1, self.completions.resolve,
+                        ("org.mplane.probe", res)).start()
+        return st_spec
+
+def test_RelayService():
+    completions = supervisor.CompletionRegistry()
+    relay = supervisor.RelayService(st_cap, "org.mplane.probe",
+                                    RelayTestClient(completions), completions)
+    spec = model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    spec.set_label("ping-average-ip4-1")
+
+    # the relay wakes as soon as the result arrives
+    started = time.time()
+    res = relay.run(spec, lambda: False)
+    assert_true(time.time() - started < 0.9)
+    assert_equal(res.get_token(), spec.get_token())
+    assert_equal(res.get_label(), "ping-average-ip4-1")
+    assert_equal(len(completions), 0)
+
+    # messages arriving before anyone waits are kept for a while
+    assert_true(completions.resolve("org.mplane.probe", st_receipt))
+    assert_false(completions.resolve("org.mplane.probe", st_receipt))
+    assert_equal(len(completions), 0)
+    assert_equal(completions.wait("org.mplane.probe", st_receipt.get_token()), st_receipt)
+    assert_equal(len(completions), 0)
+
+    # but unexpected messages do not accumulate
+    completions = supervisor.CompletionRegistry(grace=0.1, max_early=2)
+    for token in ("a", "b", "c"):
+        completions.resolve("org.mplane.probe", model.Receipt(token=token))
+    assert_equal(len(completions), 0)
+    completions.expect("org.mplane.probe", "a")
+    assert_raises(concurrent.futures.TimeoutError, completions.wait,
+                  "org.mplane.probe", "a", 0.01)
+    time.sleep(0.2)
+    completions.expect("org.mplane.probe", "c")
+    assert_raises(concurrent.futures.TimeoutError, completions.wait,
+                  "org.mplane.probe", "c", 0.01)
+
+def test_MessageDispatcher():
+    handled = []
+    release = threading.Event()
+    def handler(msg, identity):
+        release.wait(5)
+        handled.append((identity, msg))
+
+    dispatcher = supervisor.MessageDispatcher(handler, workers=2, queue_size=2)
+    # one message is being handled, two more fill the queue
+    dispatcher.put_nowait([0, "org.mplane.probe"])
+    for i in range(50):
+        if dispatcher.stats()["queue_depth"] == 0:
+            break
+        time.sleep(0.01)
+    dispatcher.put_nowait([1, "org.mplane.probe"])
+    dispatcher.put_nowait([2, "org.mplane.probe"])
+    assert_false(dispatcher.room_for("org.mplane.probe", 1))
+    assert_raises(queue.Full, dispatcher.put_nowait, [3, "org.mplane.probe"])
+
+    release.set()
+    for i in range(50):
+        if len(handled) == 3:
+            break
+        time.sleep(0.1)
+    # messages from one identity are handled in order
+    assert_equal([msg for (identity, msg) in handled], [0, 1, 2])
+    stats = dispatcher.stats()
+    assert_equal(stats["handled"], 3)
+    assert_equal(stats["rejected"], 1)
+    assert_true("wait_mean" in stats and "wait_max" in stats)
+
+def test_RedemptionSchedule():
+    schedule = client.RedemptionSchedule(min_interval=1, max_interval=4)
+    token = st_receipt.get_token()
+    schedule.add(st_receipt)
+    assert_equal(len(schedule), 1)
+    assert_equal(schedule.due(), [])
+
+    # redemptions which bring nothing back space out, up to the maximum
+    intervals = []
+    for i in range(3):
+        schedule.backoff(token)
+        intervals.append(schedule._due[token][1])
+    assert_equal(intervals, [2, 4, 4])
+    schedule.reset(token)
+    assert_equal(schedule._due[token][1], 1)
+
+    schedule.remove(token)
+    assert_equal(len(schedule), 0)
+    schedule.backoff(token)
+    assert_equal(len(schedule), 0)
+
+def test_AsyncHttpInitiatorClient():
+    (sock, port) = tornado.testing.bind_unused_port()
+    url = "http://127.0.0.1:%d/" % port
+    cap = create_test_capability()
+    cap.set_label("test-fanout")
+    cap.set_link(url)
+    sched = scheduler.Scheduler()
+    sched.add_service(SchedulerTestService(cap))
+    config = configparser.ConfigParser()
+    tls_state = tls.TlsState(config)
+    args = {'scheduler': sched, 'tlsState': tls_state}
+    application = tornado.web.Application([
+        (r"/", component.MessagePostHandler, dict(args, immediate_ms=0)),
+        (r"/capability", component.DiscoveryHandler, args),
+        (r"/capability/.*", component.DiscoveryHandler, args)])
+    cli = client.AsyncHttpInitiatorClient(config, tls_state, concurrency=2)
+
+    @tornado.gen.coroutine
+    def fan_out():
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets([sock])
+        # an unreachable component doesn't hold up the others
+        yield cli.retrieve_capabilities_async([url + "capability",
+                                               "http://127.0.0.1:1/capability"])
+        specs = yield cli.invoke_capabilities_async(
+                    [("test-fanout", "now + 1s / 1s",
+                      {"destination.ip4": "10.0.37.%d" % i}) for i in range(4)])
+        for token in cli._redemptions._due:
+            cli._redemptions._due[token][0] = 0
+        redeemed = yield cli.redeem_due_async()
+        server.stop()
+        return (specs, redeemed)
+
+    loop = tornado.ioloop.IOLoop()
+    (specs, redeemed) = loop.run_sync(fan_out)
+    loop.close()
+    assert_equal(list(cli.capability_tokens()), [cap.get_token()])
+    # the capabilities came in one envelope, which won't be sent again
+    assert_equal(cli._crawl_etags[url + "capability"],
+                 sched.capability_envelope(tls.DUMMY_DN)[1])
+    assert_true(all(isinstance(spec, model.Specification) for spec in specs))
+    assert_equal(len(cli.receipt_tokens()), 4)
+    assert_equal(redeemed, 4)
+
+def test_compression():
+    (sock, port) = tornado.testing.bind_unused_port()
+    url = "http://127.0.0.1:%d/" % port
+    cap = create_test_capability()
+    cap.set_label("test-gzip")
+    cap.set_link(url)
+    sched = scheduler.Scheduler()
+    sched.add_service(SchedulerTestService(cap))
+    config = configparser.ConfigParser()
+    config["client"] = {"compress-min-bytes": "0"}
+    tls_state = tls.TlsState(config)
+    args = {'scheduler': sched, 'tlsState': tls_state}
+    application = tornado.web.Application([
+        (r"/", component.MessagePostHandler, dict(args, immediate_ms=0)),
+        (r"/capability", component.DiscoveryHandler, args)],
+        transforms=utils.compression_transforms(100))
+    cli = client.AsyncHttpInitiatorClient(config, tls_state)
+
+    @tornado.gen.coroutine
+    def exchange():
+        server = tornado.httpserver.HTTPServer(application, decompress_request=True)
+        server.add_sockets([sock])
+        yield cli.retrieve_capabilities_async([url + "capability"])
+        # the component answered in gzip, so it gets gzip back
+        spec = yield cli.invoke_capability_async("test-gzip", "now + 1s / 1s",
+                                                 {"destination.ip4": "10.0.37.1"})
+        server.stop()
+        return spec
+
+    loop = tornado.ioloop.IOLoop()
+    spec = loop.run_sync(exchange)
+    loop.close()
+    assert_true(("127.0.0.1", port) in cli._gzip_peers)
+    assert_true(spec.get_token() in cli.receipt_tokens())
+
+class ChunkTestHandler(object):
+    def __init__(self):
+        self.chunks = []
+        self.flushes = 0
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def flush(self):
+        self.flushes += 1
+
+    def finish(self):
+        pass
+
+def test_write_message():
+    handler = ChunkTestHandler()
+    utils.write_message(handler, st_res, chunk_bytes=256)
+    assert_true(handler.flushes > 1)
+    assert_equal("".join(handler.chunks), model.unparse_json(st_res))
+
+def test_parse_body():
+    body = model.unparse_json(st_res).encode("utf-8")
+    loop = tornado.ioloop.IOLoop()
+    # small bodies are parsed on the IOLoop, large ones in a thread
+    for inline_max in (len(body), 10):
+        msg = loop.run_sync(lambda: utils.parse_body(body, inline_max))
+        assert_equal(msg.get_token(), st_res.get_token())
+        assert_equal(msg.count_result_rows(), st_res.count_result_rows())
+    loop.close()
+
+def test_Result_from_dict():
+    d = st_res.to_dict()
+    # short rows are padded with None, long rows are refused
+    d[model.KEY_RESULTVALUES] = [["33155"]]
+    row = next(model.message_from_dict(d).schema_dict_iterator())
+    assert_equal(row["delay.twoway.icmp.us.min"], 33155)
+    assert_equal(row["delay.twoway.icmp.count"], None)
+    d[model.KEY_RESULTVALUES] = [["1"] * (len(list(st_res.result_column_names())) + 1)]
+    assert_raises(ValueError, model.message_from_dict, d)
+
+#
+# component tests
+#
+
+class UploadTestPool(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.posts = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def urlopen(self, method, path, body=None, headers=None):
+        self.entered.set()
+        self.release.wait(5)
+        headers = {k.lower(): v for (k, v) in headers.items()}
+        self.headers = headers
+        if headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.posts.append((path, model.parse_json(body.decode("utf-8"))))
+        status = self.statuses.pop(0) if self.statuses else 503
+        return urllib3.response.HTTPResponse(body=io.BytesIO(b""), status=status)
+
+class UploadTestTls(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def pool_for(self, scheme, host, port):
+        return self.pool
+
+def test_ResultUploader_batches():
+    pool = UploadTestPool([503, 200, 200])
+    uploader = component.ResultUploader(UploadTestTls(pool), workers=1,
+                                        batch_size=10, retries=2)
+    url = urllib3.util.parse_url("http://127.0.0.1:8888/register/result")
+
+    # the first result is picked up alone; the rest queue up behind it
+    # while its POST is stalled, and go out together afterwards
+    uploader.submit(url, st_res)
+    pool.entered.wait(5)
+    for i in range(3):
+        uploader.submit(url, st_res)
+    pool.release.set()
+    uploader._queue.join()
+
+    assert_equal(len(pool.posts), 3)
+    assert_true(isinstance(pool.posts[1][1], model.Result))
+    (path, env) = pool.posts[2]
+    assert_equal(path, "/register/result")
+    assert_true(isinstance(env, model.Envelope))
+    assert_equal(len(env), 3)
+    stats = uploader.stats()
+    assert_equal(stats["uploaded"], 4)
+    assert_equal(stats["batches"], 2)
+    assert_equal(stats["retries"], 1)
+    assert_equal(stats["queue_depth"], 0)
+
+def test_ResultUploader_compress():
+    pool = UploadTestPool([200, 200])
+    pool.release.set()
+    uploader = component.ResultUploader(UploadTestTls(pool), workers=1,
+                                        compress_min_bytes=100)
+    url = urllib3.util.parse_url("http://127.0.0.1:8888/register/result")
+    assert_true(uploader.send(url, st_res))
+    assert_equal(pool.headers["content-encoding"], "gzip")
+    assert_equal(pool.headers["accept-encoding"], "gzip")
+    assert_equal(pool.posts[-1][1].get_token(), st_res.get_token())
+
+    # short messages are sent as they are
+    uploader = component.ResultUploader(UploadTestTls(pool), workers=1,
+                                        compress_min_bytes=100000)
+    assert_true(uploader.send(url, st_res))
+    assert_false("content-encoding" in pool.headers)
+
+def test_Spool():
+    spool_dir = tempfile.mkdtemp()
+    sp = spool.Spool(spool_dir, segment_bytes=1000)
+    for i in range(5):
+        sp.append("http://127.0.0.1:8888/register/result", st_res)
+    assert_true(sp.pending())
+    records = sp.peek(2)
+    assert_equal(len(records), 2)
+    (position, url, msg) = records[0]
+    assert_equal(url, "http://127.0.0.1:8888/register/result")
+    assert_equal(msg.get_token(), st_res.get_token())
+    sp.ack(records[-1][0])
+    sp.close()
+
+    # acknowledged records are gone after a restart, the rest replay
+    sp = spool.Spool(spool_dir, segment_bytes=1000)
+    records = sp.peek(10)
+    assert_equal(len(records), 3)
+    sp.ack(records[-1][0])
+    assert_false(sp.pending())
+    assert_equal(sp.stats()["bytes"], 0)
+    sp.close()
+
+def test_Spool_caps():
+    spool_dir = tempfile.mkdtemp()
+    sp = spool.Spool(spool_dir, max_age=3600)
+    sp.append("http://127.0.0.1:8888/register/result", st_res)
+    sp.compact()
+    assert_true(sp.pending())
+
+    # a stale record is dropped without its segment ever filling up
+    stale = time.time() - 7200
+    for name in os.listdir(spool_dir):
+        os.utime(path.join(spool_dir, name), (stale, stale))
+    sp.compact()
+    assert_false(sp.pending())
+    assert_equal(sp.peek(10), [])
+    assert_equal(sp.stats()["segments_dropped"], 1)
+
+    # as is anything past the size cap
+    sp = spool.Spool(spool_dir, max_bytes=100)
+    sp.append("http://127.0.0.1:8888/register/result", st_res)
+    sp.compact()
+    assert_false(sp.pending())
+    sp.close()
+
+def test_ResultUploader_spool():
+    pool = UploadTestPool([503])
+    pool.release.set()
+    uploader = component.ResultUploader(UploadTestTls(pool), workers=1, retries=0,
+                                        spool=spool.Spool(tempfile.mkdtemp()))
+    url = urllib3.util.parse_url("http://127.0.0.1:8888/register/result")
+
+    # the peer is down: the receipt and the result behind it are spooled
+    assert_false(uploader.send(url, st_receipt))
+    uploader.submit(url, st_res)
+    uploader._queue.join()
+    assert_equal(uploader.stats()["spooled"], 2)
+
+    # and replayed together, in order, once it is back
+    pool.statuses.append(200)
+    uploader._replay_wakeup.set()
+    for i in range(50):
+        if uploader.stats().get("replayed", 0) == 2:
+            break
+        time.sleep(0.1)
+    assert_equal(uploader.stats()["replayed"], 2)
+    (path, env) = pool.posts[-1]
+    assert_equal([m.kind_str() for m in env.messages()], ["receipt", "result"])
+
+class WebSocketTestService(scheduler.Service):
+    def run(self, specification, check_interrupt):
+        res = model.Result(specification=specification)
+        res.set_when(model.When(a=datetime.utcnow()))
+        res.set_result_value("delay.twoway.icmp.us.min", 33155)
+        return res
+
+class WebSocketTestComponent(component.InitiatorWebSocketComponent):
+    def _services(self):
+        cap = create_test_capability()
+        cap.set_label("test-websocket")
+        return [WebSocketTestService(cap)]
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+def has_result(cli, token):
+    try:
+        return isinstance(cli.result_for(token), model.Result)
+    except KeyError:
+        return False
+
+def test_websocket_loopback():
+    (sock, port) = tornado.testing.bind_unused_port()
+    sock.close()
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config["client"] = {"listen-port": str(port),
+                        "listen-spec-link": "http://127.0.0.1:%d/register/result" % port}
+    config["component"] = {"workflow": "component-initiated",
+                           "transport": "websocket",
+                           "client_host": "127.0.0.1",
+                           "client_port": str(port)}
+
+    # the client listens on its own IOLoop, as a supervisor would
+    started = threading.Event()
+    listener = {}
+    def listen():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        loop = tornado.ioloop.IOLoop.current()
+        listener["loop"] = loop
+        listener["client"] = client.HttpListenerClient(config, tls.TlsState(config),
+                                                       io_loop=loop)
+        started.set()
+        loop.start()
+        loop.close()
+    threading.Thread(target=listen, daemon=True).start()
+    started.wait(5)
+    cli = listener["client"]
+
+    comp = WebSocketTestComponent(config)
+    try:
+        # capabilities are registered as soon as the socket opens
+        assert_true(wait_until(lambda: "test-websocket" in cli.capability_labels()))
+        identity = cli.identity_for("test-websocket")
+        assert_true(wait_until(lambda: identity in cli._websockets))
+
+        # specifications are pushed, and their results sent back
+        spec = cli.invoke_capability("test-websocket", "now + 1s / 1s",
+                                     {"destination.ip4": "10.0.37.1"})
+        assert_true(wait_until(lambda: has_result(cli, spec.get_token())))
+
+        # the component reconnects when the connection drops, and
+        # specifications queued meanwhile still reach it
+        old = cli._websockets[identity]
+        listener["loop"].add_callback(old.close)
+        assert_true(wait_until(lambda: cli._websockets.get(identity) not in (None, old)))
+        spec = cli.invoke_capability("test-websocket", "now + 1s / 1s",
+                                     {"destination.ip4": "10.0.37.2"})
+        assert_true(wait_until(lambda: has_result(cli, spec.get_token())))
+    finally:
+        comp.close()
+        listener["loop"].add_callback(listener["loop"].stop)
+
 #
 # utils tests
 #
@@ -0,0 +1,205 @@
+# mPlane Protocol Reference Implementation
+# Time index over stored result rows
+#
+# (c) 2015 mPlane Consortium (http://www.ict-mplane.eu)
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Time index for answering query specifications over stored results.
+
+Stored rows are grouped in blocks of rows sharing a schema and a set of
+parameter values (an index key), sorted by time within each block. The
+index keeps, per key, the blocks' minimum and maximum times sorted by
+minimum time, so that the blocks a query's temporal scope overlaps are
+found by binary search; find_rows() then narrows each block down to the
+rows in scope, again by binary search.
+
+Times are integers, in microseconds since the epoch (see to_us()).
+
+"""
+
+import bisect
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import mplane.model
+
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+
+def to_us(dt):
+    """Convert a (naive, UTC) datetime to microseconds since the epoch."""
+    return (dt - _EPOCH) // _US
+
+def from_us(us):
+    """Convert microseconds since the epoch to a (naive, UTC) datetime."""
+    return _EPOCH + timedelta(microseconds=us)
+
+def index_key(schema, params):
+    """
+    Return the index key for rows of the given schema hash with the
+    given parameter values (a dictionary of parameter name to value).
+
+    """
+    return (schema, tuple(sorted((name, mplane.model.element(name).unparse(val))
+                                 for (name, val) in params.items())))
+
+def find_rows(times, start=None, end=None, lo=0, hi=None):
+    """
+    Given a sequence of times sorted between lo and hi (a list,
+    memoryview, numpy array...), return the (lo, hi) bounds of the rows
+    with start <= time <= end. start and end may be None.
+
+    """
+    if hi is None:
+        hi = len(times)
+    if numpy is not None and isinstance(times, numpy.ndarray):
+        if start is not None:
+            lo = lo + int(numpy.searchsorted(times[lo:hi], start, "left"))
+        if end is not None:
+            hi = lo + int(numpy.searchsorted(times[lo:hi], end, "right"))
+        return (lo, hi)
+    if start is not None:
+        lo = bisect.bisect_left(times, start, lo, hi)
+    if end is not None:
+        hi = bisect.bisect_right(times, end, lo, hi)
+    return (lo, hi)
+
+class _BlockList(object):
+    """
+    Blocks of one index key, sorted by minimum time. reach[i] is the
+    greatest maximum time among blocks 0..i, which never decreases, so
+    the first block which can reach a start time is found by bisection
+    even when blocks overlap.
+
+    """
+    __slots__ = ("mins", "maxes", "reach", "blocks")
+
+    def __init__(self):
+        self.mins = []
+        self.maxes = []
+        self.reach = []
+        self.blocks = []
+
+    def add(self, tmin, tmax, block):
+        i = bisect.bisect_right(self.mins, tmin)
+        self.mins.insert(i, tmin)
+        self.maxes.insert(i, tmax)
+        self.blocks.insert(i, block)
+        self.reach.insert(i, tmax)
+        self._fix_reach(i)
+
+    def grow(self, tmax):
+        self.maxes[-1] = max(self.maxes[-1], tmax)
+        self._fix_reach(len(self.reach) - 1)
+
+    def _fix_reach(self, i):
+        prev = self.reach[i - 1] if i > 0 else None
+        for j in range(i, len(self.reach)):
+            r = self.maxes[j] if prev is None else max(prev, self.maxes[j])
+            if j > i and r == self.reach[j]:
+                break
+            self.reach[j] = prev = r
+
+    def overlapping(self, start, end):
+        lo = 0 if start is None else bisect.bisect_left(self.reach, start)
+        hi = len(self.mins) if end is None else bisect.bisect_right(self.mins, end)
+        return [(self.mins[j], self.maxes[j], self.blocks[j])
+                for j in range(lo, hi)
+                if start is None or self.maxes[j] >= start]
+
+class TimeIndex(object):
+    """
+    Index of blocks of stored rows by key and time. A block is any
+    object the store uses to locate its rows; the index only keeps it
+    with its key and time bounds.
+
+    The index is not thread safe; the store using it must serialize
+    additions against lookups.
+
+    """
+    def __init__(self):
+        self._keys = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, key, tmin, tmax, block):
+        """Add a block of rows for key with times between tmin and tmax."""
+        if key not in self._keys:
+            self._keys[key] = _BlockList()
+        self._keys[key].add(tmin, tmax, block)
+        self._count += 1
+
+    def last(self, key):
+        """
+        Return the (tmin, tmax, block) of the latest-starting block for
+        key, or None.
+
+        """
+        bl = self._keys.get(key)
+        if bl is None or not bl.blocks:
+            return None
+        return (bl.mins[-1], bl.maxes[-1], bl.blocks[-1])
+
+    def grow(self, key, tmax):
+        """
+        Raise the maximum time of the latest-starting block for key, after
+        the store appended rows to it.
+
+        """
+        self._keys[key].grow(tmax)
+
+    def keys(self, schema=None, params=None):
+        """
+        Iterate over the index keys of a schema (all keys if None) whose
+        parameters have the given values (a dictionary of parameter name
+        to value; parameters not given match any value).
+
+        """
+        want = set(index_key(schema, params or {})[1])
+        for key in self._keys:
+            if (schema is None or key[0] == schema) and want.issubset(key[1]):
+                yield key
+
+    def blocks(self, key, start=None, end=None):
+        """
+        Return (tmin, tmax, block) for each block of key which may hold
+        rows with start <= time <= end, in order of minimum time.
+
+        """
+        bl = self._keys.get(key)
+        if bl is None:
+            return []
+        return bl.overlapping(start, end)
+
+    def lookup(self, schema, params, when):
+        """
+        Return (key, tmin, tmax, block) for each block of the schema with
+        the given parameter values which may hold rows within the
+        temporal scope when (an mplane.model.When).
+
+        """
+        (start, end) = when.datetimes()
+        start = None if start is None else to_us(start)
+        end = None if end is None else to_us(end)
+        return [(key,) + blk for key in self.keys(schema, params)
+                             for blk in self.blocks(key, start, end)]
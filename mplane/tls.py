@@ -34,17 +34,189 @@
 # - SSB will pull this out of existing utils.py and stepenta/RI code.
 
 import urllib3
+import urllib3.connection
+import collections
 import ssl
-import functools
+import threading
+import time
 import tornado.httpserver
-from socket import socket
 import mplane.utils
 
 DUMMY_DN = "Identity.Unauthenticated.Default"
 
+# Seconds for which a peer identity learned from a connection is reused
+PEER_IDENTITY_TTL = 300
+
+# Number of hosts for which connection pools are kept open
+POOL_NUM_POOLS = 64
+# Number of idle connections kept open per host
+POOL_MAXSIZE = 4
+# Seconds after which an idle pooled connection is closed instead of reused
+POOL_IDLE_TIMEOUT = 60
+# Number of peers for which TLS sessions are kept for resumption
+SESSION_CACHE_SIZE = 256
+
+def _identity_from_cert(cert):
+    identity = ""
+    for elem in cert.get('subject'):
+        if identity == "":
+            identity = identity + str(elem[0][1])
+        else:
+            identity = identity + "." + str(elem[0][1])
+    return identity
+
+class _ResumingSSLContext(ssl.SSLContext):
+    """
+    Client-side SSL context shared by all connections made through a
+    TlsState. Offers the last TLS session seen for a peer address for
+    resumption when connecting to it again, and counts handshakes.
+    """
+    def wrap_socket(self, sock, *args, **kwargs):
+        tls_state = self.tls_state
+        try:
+            peer = sock.getpeername()
+        except OSError:
+            peer = None
+
+        session = tls_state._session_for(peer)
+        if session is not None and "session" not in kwargs:
+            try:
+                ssock = super().wrap_socket(sock, *args, session=session, **kwargs)
+            except ValueError:
+                # session not usable with this context, do a full handshake
+                ssock = super().wrap_socket(sock, *args, **kwargs)
+        else:
+            ssock = super().wrap_socket(sock, *args, **kwargs)
+
+        tls_state._count("handshakes")
+        if ssock.session_reused:
+            tls_state._count("sessions_resumed")
+        tls_state._remember_session(peer, ssock.session)
+        return ssock
+
+class _IdentityHTTPSConnection(urllib3.connection.HTTPSConnection):
+    """
+    HTTPS connection which, once connected, records the identity in
+    the peer's certificate with the TlsState that created its pool.
+    """
+    def __init__(self, *args, tls_state=None, **kwargs):
+        self._tls_state = tls_state
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        if self._tls_state is not None and self.ssl_context is None:
+            self.ssl_context = self._tls_state.client_ssl_context()
+        super().connect()
+        if self._tls_state is not None:
+            self._tls_state._remember_peer((self.host, self.port),
+                                           self.sock.getpeercert())
+
+class _PoolInstrumentation:
+    """
+    Mixin for urllib3 connection pools: closes connections which have
+    been idle for too long instead of reusing them, keeps TLS sessions
+    up to date, and counts reuse and saturation in the TlsState.
+    """
+    def _get_conn(self, timeout=None):
+        if self.pool is not None and self.pool.empty():
+            # all connections to this host are in use
+            self._tls_state._count("pool_saturated")
+        conn = super()._get_conn(timeout)
+        if conn.sock is not None:
+            if time.monotonic() - getattr(conn, "_released_at", 0) > self._idle_timeout:
+                conn.close()
+                self._tls_state._count("idle_evicted")
+            else:
+                self._tls_state._count("connections_reused")
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._released_at = time.monotonic()
+            sock = conn.sock
+            if isinstance(sock, ssl.SSLSocket):
+                # TLS 1.3 session tickets arrive after the handshake
+                try:
+                    self._tls_state._remember_session(sock.getpeername(), sock.session)
+                except OSError:
+                    pass
+            if self.pool is not None and self.pool.full():
+                self._tls_state._count("pool_discarded")
+        super()._put_conn(conn)
+
+    def _new_conn(self):
+        self._tls_state._count("connections_opened")
+        return super()._new_conn()
+
+class _HTTPConnectionPool(_PoolInstrumentation, urllib3.HTTPConnectionPool):
+    def __init__(self, *args, tls_state=None, idle_timeout=POOL_IDLE_TIMEOUT, **kwargs):
+        self._tls_state = tls_state
+        self._idle_timeout = idle_timeout
+        super().__init__(*args, **kwargs)
+
+class _HTTPSConnectionPool(_PoolInstrumentation, urllib3.HTTPSConnectionPool):
+    ConnectionCls = _IdentityHTTPSConnection
+
+    def __init__(self, *args, tls_state=None, idle_timeout=POOL_IDLE_TIMEOUT, **kwargs):
+        self._tls_state = tls_state
+        self._idle_timeout = idle_timeout
+        super().__init__(*args, tls_state=tls_state, **kwargs)
+
+class _PoolManager:
+    """
+    Keeps connection pools for at most num_pools hosts, forgetting the
+    least recently used pool when a new host needs one. A forgotten pool
+    is not closed, as callers may still be using it; its connections
+    are closed when they go idle or when the pool is collected.
+    """
+    def __init__(self, tls_state, num_pools, maxsize, idle_timeout):
+        self._tls_state = tls_state
+        self._num_pools = num_pools
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        self._pools = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def pool_for(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                self._pools.move_to_end(key)
+                return pool
+
+            if scheme == "https":
+                pool = _HTTPSConnectionPool(host, port,
+                                            maxsize=self._maxsize,
+                                            tls_state=self._tls_state,
+                                            idle_timeout=self._idle_timeout)
+            else:
+                pool = _HTTPConnectionPool(host, port,
+                                           maxsize=self._maxsize,
+                                           tls_state=self._tls_state,
+                                           idle_timeout=self._idle_timeout)
+            self._pools[key] = pool
+
+            while len(self._pools) > self._num_pools:
+                self._pools.popitem(last=False)
+                self._tls_state._count("pools_evicted")
+            return pool
+
 class TlsState:
 
-    def __init__(self, config, forged_identity=None):
+    def __init__(self, config, forged_identity=None,
+                 num_pools=POOL_NUM_POOLS, pool_maxsize=POOL_MAXSIZE,
+                 pool_idle_timeout=POOL_IDLE_TIMEOUT):
+        # peer identities by (host, port), learned from pooled connections
+        self._peer_identities = {}
+        self._peer_lock = threading.Lock()
+        self._peer_identity_ttl = PEER_IDENTITY_TTL
+
+        # TLS sessions by peer address, and connection statistics
+        self._sessions = collections.OrderedDict()
+        self._stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
         if "TLS" not in config:
             self._cafile = None
             self._certfile = None
@@ -58,39 +230,96 @@ class TlsState:
         # load cert and get DN
         self._identity = self.extract_local_identity(forged_identity)
 
-    @functools.lru_cache()
+        # client SSL contexts (created on first use) and one set
+        # of pools for all connections
+        self._ssl_context = None
+        self._hostname_ssl_context = None
+        self._pools = _PoolManager(self, num_pools, pool_maxsize, pool_idle_timeout)
+
+    def client_ssl_context(self, check_hostname=False):
+        """
+        Returns the SSL context shared by all client connections made
+        with this TLS state, or None if TLS is not configured.
+
+        urllib3 matches the hostname against the certificate itself, so
+        the shared context does not; clients which do not (Tornado's
+        HTTP and WebSocket clients) must ask for check_hostname=True.
+        """
+        if not self._keyfile:
+            return None
+        if check_hostname:
+            if self._hostname_ssl_context is None:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                self._hostname_ssl_context = self._load_client_context(context)
+            return self._hostname_ssl_context
+        if self._ssl_context is None:
+            context = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.tls_state = self
+            context.check_hostname = False
+            self._ssl_context = self._load_client_context(context)
+        return self._ssl_context
+
+    def _load_client_context(self, context):
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(cafile=self._cafile)
+        context.load_cert_chain(self._certfile, self._keyfile)
+        return context
+
     def pool_for(self, scheme, host, port):
         """
         Given a URL (from which a scheme and host can be extracted),
         return a connection pool (potentially with TLS state)
         which can be used to connect to the URL.
+
+        Pools are shared per scheme, host and port, and kept for a
+        bounded number of hosts.
         """
 
         if scheme is None:
             if self._keyfile:
-                return urllib3.HTTPSConnectionPool(host, port,
-                                                    key_file=self._keyfile,
-                                                    cert_file=self._certfile,
-                                                    ca_certs=self._cafile)
+                scheme = "https"
             else:
-                return urllib3.HTTPConnectionPool(host, port)
-        elif scheme == "http":
-            return urllib3.HTTPConnectionPool(host, port)
+                scheme = "http"
         elif scheme == "https":
-            if self._keyfile:
-                return urllib3.HTTPSConnectionPool(host, port,
-                                                    key_file=self._keyfile,
-                                                    cert_file=self._certfile,
-                                                    ca_certs=self._cafile)
-            else:
+            if not self._keyfile:
                 raise ValueError("SSL requested without providing certificate")
-                exit(1)
         elif scheme == "file":
             # FIXME what to do here?
             raise ValueError("Unsupported scheme "+scheme)
-        else:
+        elif scheme != "http":
             raise ValueError("Unsupported scheme "+scheme)
 
+        return self._pools.pool_for(scheme, host, port)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def connection_stats(self):
+        """
+        Returns a dictionary of connection counters: TLS handshakes and
+        resumed sessions, connections opened, reused and evicted when
+        idle, and how often pools were saturated (all connections to a
+        host busy), discarded a connection, or were evicted.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _session_for(self, peer):
+        if peer is None:
+            return None
+        with self._stats_lock:
+            return self._sessions.get(peer)
+
+    def _remember_session(self, peer, session):
+        if peer is None or session is None:
+            return
+        with self._stats_lock:
+            self._sessions[peer] = session
+            self._sessions.move_to_end(peer)
+            while len(self._sessions) > SESSION_CACHE_SIZE:
+                self._sessions.popitem(last=False)
+
     def forged_identity(self):
         if not self._keyfile:
             return self._identity
@@ -136,35 +365,66 @@ class TlsState:
                 identity = forged_identity
         return identity
 
+    def _remember_peer(self, hostport, cert):
+        if cert:
+            with self._peer_lock:
+                self._peer_identities[hostport] = \
+                    (_identity_from_cert(cert),
+                     time.monotonic() + self._peer_identity_ttl)
+
+    def _cached_peer_identity(self, hostport):
+        with self._peer_lock:
+            entry = self._peer_identities.get(hostport)
+            if entry is None:
+                return None
+            (identity, expires) = entry
+            if expires < time.monotonic():
+                del self._peer_identities[hostport]
+                return None
+            return identity
+
+    def _peer_identity_for_url(self, url):
+        pool = self.pool_for(url.scheme, url.host, url.port)
+        if not isinstance(pool, urllib3.HTTPSConnectionPool):
+            raise ValueError("Cannot extract peer identity from non-TLS URL "+str(url))
+
+        hostport = (pool.host, url.port or pool.ConnectionCls.default_port)
+        identity = self._cached_peer_identity(hostport)
+        if identity is None:
+            # No connection to this peer recently: connect one from the
+            # pool, and leave it there for the next request to reuse.
+            conn = pool._get_conn()
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                self._remember_peer(hostport, conn.sock.getpeercert())
+            except:
+                conn.close()
+                raise
+            finally:
+                pool._put_conn(conn)
+            identity = self._cached_peer_identity(hostport)
+        return identity
+
     def extract_peer_identity(self, url_or_req):
         """
         Extract an identity from a Tornado's
-        HTTPRequest, or from a Urllib3's Url
+        HTTPRequest, a Urllib3's Url, or a connected ssl.SSLSocket
+        (e.g. under a WebSocket).
+
+        Identities of Urls are taken from the certificate of the
+        pooled connection to the peer, and cached per host and port
+        for PEER_IDENTITY_TTL seconds.
         """
         if self._keyfile:
             if isinstance(url_or_req,  urllib3.util.url.Url):
-                # extract DN from the certificate retrieved from the url.
-                # Unfortunately, there seems to be no way to do this using urllib3,
-                # thus ssl library is being used
-                s = socket()
-                c = ssl.wrap_socket(s,cert_reqs=ssl.CERT_REQUIRED,
-                                    keyfile=self._keyfile,
-                                    certfile=self._certfile,
-                                    ca_certs=self._cafile)
-                c.connect((url_or_req.host, url_or_req.port))
-                cert = c.getpeercert()
-                c.close()
+                identity = self._peer_identity_for_url(url_or_req)
             elif isinstance(url_or_req, tornado.httpserver.HTTPRequest):
-                cert = url_or_req.get_ssl_certificate()
+                identity = _identity_from_cert(url_or_req.get_ssl_certificate())
+            elif isinstance(url_or_req, ssl.SSLSocket):
+                identity = _identity_from_cert(url_or_req.getpeercert())
             else:
-                raise ValueError("Passed argument is not a urllib3.util.url.Url or tornado.httpserver.HTTPRequest")
-
-            identity = ""
-            for elem in cert.get('subject'):
-                if identity == "":
-                    identity = identity + str(elem[0][1])
-                else:
-                    identity = identity + "." + str(elem[0][1])
+                raise ValueError("Passed argument is not a urllib3.util.url.Url, tornado.httpserver.HTTPRequest or ssl.SSLSocket")
         else:
             identity = DUMMY_DN
         return identity
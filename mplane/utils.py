@@ -20,9 +20,26 @@
 
 import os.path
 import re
+import concurrent.futures
+import functools
+import gzip
 import mplane.model
 import json
 import urllib3
+import tornado.gen
+import tornado.ioloop
+import tornado.web
+
+# Bodies shorter than this are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+# Serialized messages are written out in pieces of about this size
+CHUNK_BYTES = 65536
+# Request bodies larger than this are parsed off the IOLoop thread
+PARSE_INLINE_MAX_BYTES = 65536
+
+# threads parsing (and processing) large request bodies
+_parse_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=2, thread_name_prefix="mplane-parse")
 
 def read_setting(filepath, param):
     """
@@ -118,3 +135,79 @@ def parse_url(url):
     else:
         link = link + "/" + url.path
     return link
+
+class GZipMessageEncoding(tornado.web.GZipContentEncoding):
+    """
+    Output transform compressing mPlane messages (and text) for clients
+    which accept gzip, when longer than min_length or sent in chunks.
+
+    """
+    CONTENT_TYPES = tornado.web.GZipContentEncoding.CONTENT_TYPES | \
+                    {"application/x-mplane+json"}
+
+    def __init__(self, request, min_length=COMPRESS_MIN_BYTES):
+        super().__init__(request)
+        self.MIN_LENGTH = min_length
+
+def compression_transforms(min_length=COMPRESS_MIN_BYTES):
+    """
+    Return the transforms to pass to a tornado.web.Application to
+    compress its responses.
+
+    """
+    return [functools.partial(GZipMessageEncoding, min_length=min_length)]
+
+def write_message(handler, msg, chunk_bytes=CHUNK_BYTES):
+    """
+    Write an mPlane message as the body of a tornado response, and
+    finish it. Messages longer than chunk_bytes go out in chunks
+    (chunked transfer encoding) as they are serialized.
+
+    """
+    pieces = []
+    size = 0
+    for piece in mplane.model.unparse_json_chunks(msg):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_bytes:
+            handler.write("".join(pieces))
+            handler.flush()
+            pieces = []
+            size = 0
+    handler.write("".join(pieces))
+    handler.finish()
+
+def compress_body(body, headers, min_length=COMPRESS_MIN_BYTES):
+    """
+    gzip a request body of at least min_length bytes, setting its
+    Content-Encoding in headers. Returns the body to send.
+
+    """
+    if len(body) < min_length:
+        return body
+    headers["Content-Encoding"] = "gzip"
+    return gzip.compress(body)
+
+def _parse_body(body):
+    return mplane.model.parse_json(body.decode("utf-8"))
+
+@tornado.gen.coroutine
+def parse_body(body, inline_max=PARSE_INLINE_MAX_BYTES):
+    """
+    Parse an mPlane JSON request body into a message. Bodies longer
+    than inline_max bytes are parsed in a worker thread, so that the
+    IOLoop keeps serving other requests meanwhile.
+
+    """
+    if len(body) <= inline_max:
+        return _parse_body(body)
+    msg = yield run_off_loop(_parse_body, body)
+    return msg
+
+def run_off_loop(fn, *args):
+    """
+    Run fn(*args) in the threads parsing large request bodies; returns
+    a future to yield from a coroutine.
+
+    """
+    return tornado.ioloop.IOLoop.current().run_in_executor(_parse_executor, fn, *args)